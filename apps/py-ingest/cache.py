@@ -1,8 +1,16 @@
 from abc import ABC, abstractmethod
 
+import hashlib
+import json
 import os
 import pickle
-from typing import Any, Optional
+import sqlite3
+import time
+from threading import Lock
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence
+import numpy as np
+from utils import get_chunk_id
+from vectors import DTYPE, as_vector
 
 class AbstractCache(ABC):
     @abstractmethod
@@ -50,3 +58,267 @@ class LocalCache(AbstractCache):
     def exists(self, key: str) -> bool:
         cache_path = self._get_cache_path(key)
         return os.path.exists(cache_path)
+
+
+class EmbeddingCache(AbstractCache):
+    """
+    Persistent embedding cache keyed by model and the sha256 of the text that was embedded.
+
+    Vectors are stored as packed float32 bytes in SQLite and returned as float32 arrays. They can be
+    looked up and stored in bulk so a batched `embed` call costs one query. Keys come from
+    `make_key`, which hashes text the same way `utils.get_chunk_id` does.
+    """
+    def __init__(self, path: str = "local_cache/embeddings.sqlite3"):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL) WITHOUT ROWID")
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return f"{model}:{get_chunk_id(text)}"
+
+    @staticmethod
+    def _pack(vector: Sequence[float]) -> bytes:
+        return as_vector(vector).tobytes()
+
+    @staticmethod
+    def _unpack(blob: bytes) -> np.ndarray:
+        return np.frombuffer(blob, dtype=DTYPE)
+
+    def get_many(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        found: Dict[str, bytes] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self.lock:
+            # stay under SQLite's bound parameter limit
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                found.update(self.connection.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch).fetchall())
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return [self._unpack(found[key]) if key in found else None for key in keys]
+
+    def put_many(self, keys: List[str], vectors: List[Sequence[float]]) -> None:
+        with self.lock:
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", [(key, self._pack(vector)) for key, vector in zip(keys, vectors)])
+
+    def save(self, key: str, value: Sequence[float]) -> None:
+        self.put_many([key], [value])
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        return self.get_many([key])[0]
+
+    def delete(self, key: str) -> None:
+        with self.lock:
+            with self.connection:
+                self.connection.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+
+    def exists(self, key: str) -> bool:
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM embeddings WHERE key = ?", (key,)).fetchone() is not None
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+class LLMCache(AbstractCache):
+    """
+    Persistent, size-bounded cache of LLM responses stored as JSON in SQLite.
+
+    Once more than `max_entries` responses are stored, the least recently used ones are evicted.
+    Keys come from `make_key`, which hashes everything that determines a completion.
+    """
+    def __init__(self, path: str = "local_cache/llm.sqlite3", max_entries: int = 100000):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.size = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(**request) -> str:
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def save(self, key: str, value: str) -> None:
+        with self.lock:
+            with self.connection:
+                inserted = self.connection.execute("INSERT OR IGNORE INTO responses (key, value, last_used) VALUES (?, ?, ?)", (key, value, time.time())).rowcount
+                if not inserted:
+                    self.connection.execute("UPDATE responses SET value = ?, last_used = ? WHERE key = ?", (value, time.time(), key))
+                self.size += inserted
+                if self.size > self.max_entries:
+                    # evict down to 90% so we don't pay for an eviction on every insert
+                    evict = self.size - int(self.max_entries * 0.9)
+                    self.connection.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)", (evict,))
+                    self.size -= evict
+
+    def get(self, key: str, recheck: bool = False) -> Optional[str]:
+        """With `recheck`, this is a second look for a key that just missed, so it isn't counted as another lookup."""
+        with self.lock:
+            with self.connection:
+                row = self.connection.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    if not recheck:
+                        self.misses += 1
+                    return None
+                self.hits += 1
+                if recheck:
+                    self.misses -= 1
+                self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+                return row[0]
+
+    def delete(self, key: str) -> None:
+        with self.lock:
+            with self.connection:
+                self.size -= self.connection.execute("DELETE FROM responses WHERE key = ?", (key,)).rowcount
+
+    def exists(self, key: str) -> bool:
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone() is not None
+
+    def record_coalesced(self) -> None:
+        with self.lock:
+            self.coalesced += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "hit_rate": self.hits / lookups if lookups else 0.0, "size": self.size}
+
+class PageState(NamedTuple):
+    """What a re-crawl needs to know about a page it processed before."""
+    etag: Optional[str]
+    last_modified: Optional[str]
+    # sha256 of the page's clean text, see `AbstractDataCleaner.get_clean_text`
+    content_hash: str
+    links: List[str]
+
+    def request_headers(self) -> Dict[str, str]:
+        """Headers that make the request conditional, so an unchanged page comes back as a bodiless 304."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+class PageStateCache(AbstractCache):
+    """
+    Persistent `PageState` per url, stored in SQLite once a page has been processed and saved.
+
+    On the next crawl the stored validators are sent with the request, and the stored clean text
+    hash catches pages whose server doesn't support conditional requests. Either way an unchanged
+    page only has its stored links followed.
+
+    States are kept per `crawl`: a page one crawl saved under its topics is still new to another.
+    """
+    def __init__(self, path: str = "local_cache/pages.sqlite3", crawl: str = "default"):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.crawl = crawl
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS page_states (crawl TEXT NOT NULL, url TEXT NOT NULL, etag TEXT, last_modified TEXT, content_hash TEXT NOT NULL, links TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY (crawl, url)) WITHOUT ROWID")
+        self.not_modified = 0
+        self.unchanged = 0
+
+    def save(self, key: str, value: PageState) -> None:
+        with self.lock:
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO page_states (crawl, url, etag, last_modified, content_hash, links, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                        (self.crawl, key, value.etag, value.last_modified, value.content_hash, json.dumps(value.links), time.time()))
+
+    def get(self, key: str) -> Optional[PageState]:
+        with self.lock:
+            row = self.connection.execute("SELECT etag, last_modified, content_hash, links FROM page_states WHERE crawl = ? AND url = ?", (self.crawl, key)).fetchone()
+        if row is None:
+            return None
+        return PageState(row[0], row[1], row[2], json.loads(row[3]))
+
+    def delete(self, key: str) -> None:
+        with self.lock:
+            with self.connection:
+                self.connection.execute("DELETE FROM page_states WHERE crawl = ? AND url = ?", (self.crawl, key))
+
+    def exists(self, key: str) -> bool:
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM page_states WHERE crawl = ? AND url = ?", (self.crawl, key)).fetchone() is not None
+
+    def record_skip(self, not_modified: bool) -> None:
+        with self.lock:
+            if not_modified:
+                self.not_modified += 1
+            else:
+                self.unchanged += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"not_modified": self.not_modified, "unchanged": self.unchanged}
+
+def test_embedding_cache():
+    import tempfile
+    cache = EmbeddingCache(os.path.join(tempfile.mkdtemp(), "embeddings.sqlite3"))
+    keys = [cache.make_key("model", text) for text in ["a", "b", "a"]]
+    assert keys[0] == keys[2] and keys[0] != cache.make_key("other-model", "a")
+
+    assert cache.get_many(keys) == [None, None, None]
+    cache.put_many(keys[:2], [[0.5, 1.0], [0.25, -2.0]])
+    assert [vector.tolist() for vector in cache.get_many(keys)] == [[0.5, 1.0], [0.25, -2.0], [0.5, 1.0]]
+    assert cache.stats()["hits"] == 3 and cache.stats()["misses"] == 3
+    assert cache.get(keys[0]).dtype == np.float32
+
+    cache.delete(keys[1])
+    assert not cache.exists(keys[1]) and cache.exists(keys[0])
+
+def test_llm_cache():
+    import tempfile
+    cache = LLMCache(os.path.join(tempfile.mkdtemp(), "llm.sqlite3"), max_entries=10)
+    key = cache.make_key(model="gpt", prompt="hi", temperature=0)
+    assert key == cache.make_key(temperature=0, prompt="hi", model="gpt")
+    assert cache.get(key) is None
+    cache.save(key, '{"is_relevant": true}')
+    assert cache.get(key) == '{"is_relevant": true}'
+
+    for i in range(20):
+        cache.save(cache.make_key(prompt=str(i)), str(i))
+    assert cache.size <= 10, f"Expected at most 10 entries, got {cache.size}"
+    assert cache.exists(cache.make_key(prompt="19")) and not cache.exists(cache.make_key(prompt="0"))
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+def test_page_state_cache():
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "pages.sqlite3")
+    cache = PageStateCache(path)
+    assert cache.get("https://vote.gov") is None
+    cache.save("https://vote.gov", PageState('"abc"', None, get_chunk_id("text"), ["https://vote.gov/register"]))
+    state = PageStateCache(path).get("https://vote.gov")
+    assert state.links == ["https://vote.gov/register"] and state.content_hash == get_chunk_id("text")
+    assert state.request_headers() == {"If-None-Match": '"abc"'}
+    assert PageStateCache(path, crawl="other").get("https://vote.gov") is None, "Expected another crawl not to see the page as saved"
+    cache.delete("https://vote.gov")
+    assert not cache.exists("https://vote.gov")
+
+if __name__ == "__main__":
+    test_embedding_cache()
+    test_llm_cache()
+    test_page_state_cache()
+    print("cache.py: All tests passed!")
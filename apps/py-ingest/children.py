@@ -1,11 +1,15 @@
 from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
+from parse import ParsedPage, normalize_links
+from typing import Union
 
-def extract_links(current_url: str, soup: BeautifulSoup):
-    links = [link.get('href') for link in soup.find_all('a')]
+def extract_links(current_url: str, soup: Union[ParsedPage, BeautifulSoup]):
+    if isinstance(soup, ParsedPage):
+        # already resolved when the page was parsed with parse_page
+        if soup.links is not None:
+            return soup.links
+        links = soup.hrefs
+    else:
+        links = [link.get('href') for link in soup.find_all('a')]
 
-    # Normalize links by ignoring fragments
-    links = [urljoin(current_url, link) for link in links if link]
-    links = [urlparse(link)._replace(fragment='').geturl() for link in links if not link.endswith('#')]
-
-    return list(set(links))  # Remove duplicates
+    # Normalize links by ignoring fragments, and remove duplicates
+    return normalize_links(current_url, links)
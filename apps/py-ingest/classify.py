@@ -0,0 +1,222 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from pydantic import BaseModel
+
+from llm import AbstractLLM
+from utils import count_tokens
+
+class ChunkTypeResponse(BaseModel):
+    type: str
+    subtopics: Optional[List[str]] = []
+
+class NumberedChunkType(ChunkTypeResponse):
+    index: int
+
+class ChunkTypesResponse(BaseModel):
+    chunks: List[NumberedChunkType]
+
+BATCH_INSTRUCTIONS = "Below are {count} numbered pieces of information, each starting with its number in square brackets. Classify each one on its own, exactly as if it were the only piece you were given, and return one entry for EVERY number from 1 to {count}, with that number as its `index`."
+
+class BatchChunkClassifier:
+    """
+    Gets the `type` and `subtopics` of many chunks per LLM call, instead of one call per chunk that
+    each resends the classifier's long system prompt.
+
+    Chunks are sent as a numbered list and the model answers with one numbered entry per chunk.
+    Entries with an unknown or repeated number are ignored, and chunks that didn't come back are
+    asked for again in a new batch, up to `retries` times. A batch that fails outright (usually an
+    answer cut off at `max_tokens`) also halves the batch size for the retries.
+
+    The batch size adapts to the chunks: a batch grows until its prompt would go over
+    `max_prompt_tokens`, its answer (about `completion_tokens_per_chunk` per chunk) over
+    `max_completion_tokens`, or it holds `max_batch_size` chunks.
+    """
+    def __init__(self, model: AbstractLLM, max_prompt_tokens: int = 6000, max_completion_tokens: int = 4096, completion_tokens_per_chunk: int = 48, max_batch_size: int = 40, retries: int = 2, max_workers: int = 8, count: Callable[[str], int] = count_tokens):
+        self.model = model
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_completion_tokens = max_completion_tokens
+        self.completion_tokens_per_chunk = completion_tokens_per_chunk
+        self.max_batch_size = max_batch_size
+        self.retries = retries
+        self.max_workers = max_workers
+        self.count = count
+
+    def batches(self, chunks: Sequence[str], indexes: Sequence[int], max_batch_size: int) -> List[List[int]]:
+        """Groups `indexes` (into `chunks`, in order) greedily into batches that fit the budgets."""
+        max_batch_size = min(max_batch_size, self.max_completion_tokens // self.completion_tokens_per_chunk)
+        batches = []
+        batch: List[int] = []
+        batch_tokens = self.count(BATCH_INSTRUCTIONS)
+        for index in indexes:
+            # + a few tokens for the number and the blank line around each chunk
+            tokens = self.count(chunks[index]) + 6
+            if batch and (len(batch) >= max_batch_size or batch_tokens + tokens > self.max_prompt_tokens):
+                batches.append(batch)
+                batch, batch_tokens = [], self.count(BATCH_INSTRUCTIONS)
+            batch.append(index)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def prompt(self, chunks: Sequence[str], batch: Sequence[int]) -> str:
+        numbered = "\n\n".join(f"[{number}] {chunks[index]}" for number, index in enumerate(batch, start=1))
+        return BATCH_INSTRUCTIONS.format(count=len(batch)) + "\n\n" + numbered
+
+    def classify_batch(self, chunks: Sequence[str], batch: Sequence[int]) -> Dict[int, Tuple[str, List[str]]]:
+        """The (type, subtopics) of each chunk in `batch` that the model answered for, by index into `chunks`."""
+        if len(batch) == 1:
+            # a batch of one is just the per-chunk request, which is also what's cached for it
+            response = self.model.generate(chunks[batch[0]], response_model=ChunkTypeResponse, max_tokens=256)
+            return {batch[0]: (response.type, response.subtopics)}
+        max_tokens = min(self.max_completion_tokens, len(batch) * self.completion_tokens_per_chunk + 64)
+        response = self.model.generate(self.prompt(chunks, batch), response_model=ChunkTypesResponse, max_tokens=max_tokens)
+        results = {}
+        for entry in response.chunks:
+            if not 1 <= entry.index <= len(batch):
+                continue
+            results.setdefault(batch[entry.index - 1], (entry.type, entry.subtopics))
+        return results
+
+    def classify(self, chunks: Sequence[str]) -> List[Tuple[str, List[str]]]:
+        """The (type, subtopics) of every chunk, with ("other", []) for any the model never answered for."""
+        results: Dict[int, Tuple[str, List[str]]] = {}
+        pending = list(range(len(chunks)))
+        max_batch_size = self.max_batch_size
+        for attempt in range(self.retries + 1):
+            if not pending:
+                break
+            batches = self.batches(chunks, pending, max_batch_size)
+            failed = False
+            with ThreadPoolExecutor(max_workers=min(len(batches), self.max_workers)) as executor:
+                futures = [executor.submit(self.classify_batch, chunks, batch) for batch in batches]
+                for batch, future in zip(batches, futures):
+                    try:
+                        results.update(future.result())
+                    except Exception as e:
+                        failed = True
+                        logging.info(f"Failed to classify a batch of {len(batch)} chunks due to {e}")
+            pending = [index for index in pending if index not in results]
+            if pending:
+                logging.debug(f"Asking again for {len(pending)}/{len(chunks)} chunks the model didn't classify")
+            if failed:
+                max_batch_size = max(1, max_batch_size // 2)
+        if pending:
+            logging.info(f"Could not classify {len(pending)}/{len(chunks)} chunks, typing them as other")
+        return [results.get(index, ("other", [])) for index in range(len(chunks))]
+
+# a fixture set of chunks like the ones cleaned from election pages, with the type each should get
+FIXTURE_CHUNKS = [
+    ("Polls in Ohio are open from 6:30 a.m. to 7:30 p.m. on Election Day. Any voter in line at 7:30 p.m. will be allowed to vote.", "useful_information"),
+    ("To register to vote in Virginia you must be a resident of Virginia, a U.S. citizen, and 18 years old by the next general election.", "useful_information"),
+    ("Absentee ballots must be postmarked on or before Election Day and received by the county board of elections no later than four days after it.", "useful_information"),
+    ("\"We are going to make sure every eligible voter in this state can cast a ballot without waiting in line for hours,\" the Secretary of State said at a press conference.", "third_party_quote"),
+    ("The governor said that the new voter ID requirements would be enforced starting with the March primary, and that free IDs would be available at any DMV office.", "paraphrase"),
+    ("Critics argue that shortening the early voting period is a thinly veiled attempt to suppress turnout among working voters who cannot get to the polls on a Tuesday.", "commentary"),
+    ("Voters who have moved within the same county since the last election can update their address at their polling place on Election Day and cast a regular ballot.", "useful_information"),
+    ("\"I will fight every day to protect the right to vote,\" I told the crowd in Des Moines, \"because democracy only works when everyone can take part.\"", "direct_quote"),
+    ("In my view, the state's decision to close a third of its polling places was a mistake that will be felt most in rural counties.", "commentary"),
+    ("A provisional ballot is cast when a voter's eligibility cannot be confirmed at the polls. It is counted once the county verifies the voter's registration, usually within ten days.", "useful_information"),
+    ("Election officials said that turnout in the primary was about 30 percent, roughly in line with the last midterm primary four years ago.", "paraphrase"),
+    ("Follow us on social media for the latest news and updates from the campaign trail.", "other"),
+]
+
+def test_batch_chunk_classifier():
+    class ScriptedLLM(AbstractLLM):
+        """Answers batches from a lookup by chunk text, dropping the chunks listed in `skip` the first time."""
+        def __init__(self, skip=()):
+            self.skip = set(skip)
+            self.calls = []
+
+        def generate(self, prompt, response_model=None, max_tokens=64):
+            self.calls.append(prompt)
+            if response_model is ChunkTypeResponse:
+                return ChunkTypeResponse(type=labels[prompt], subtopics=["voting"])
+            pieces = [piece.split("] ", 1)[1] for piece in prompt.split("\n\n")[1:]]
+            entries = []
+            for number, piece in enumerate(pieces, start=1):
+                if piece in self.skip:
+                    self.skip.discard(piece)
+                    continue
+                entries.append(NumberedChunkType(index=number, type=labels[piece], subtopics=["voting"]))
+            # an index out of range and a repeat are ignored
+            entries.append(NumberedChunkType(index=len(pieces) + 1, type="other"))
+            entries.append(NumberedChunkType(index=1, type="other"))
+            return ChunkTypesResponse(chunks=entries)
+
+    chunks = [text for text, _ in FIXTURE_CHUNKS]
+    labels = dict(FIXTURE_CHUNKS)
+    words = lambda text: len(text.split())
+
+    model = ScriptedLLM()
+    classifier = BatchChunkClassifier(model, max_batch_size=5, count=words)
+    assert [type for type, _ in classifier.classify(chunks)] == [label for _, label in FIXTURE_CHUNKS]
+    assert len(model.calls) == 3, f"Expected 12 chunks in batches of 5 to take 3 calls, got {len(model.calls)}"
+
+    model = ScriptedLLM(skip=[chunks[2], chunks[7]])
+    classifier = BatchChunkClassifier(model, count=words)
+    assert [type for type, _ in classifier.classify(chunks)] == [label for _, label in FIXTURE_CHUNKS]
+    assert len(model.calls) == 2 and "[1] " + chunks[2] in model.calls[1] and chunks[0] not in model.calls[1], "Expected only the missing chunks to be asked for again"
+
+    # the prompt budget caps the batch size
+    assert all(sum(words(chunks[index]) + 6 for index in batch) <= 120 for batch in BatchChunkClassifier(model, max_prompt_tokens=120 + words(BATCH_INSTRUCTIONS), count=words).batches(chunks, range(len(chunks)), 40))
+
+    class FailingLLM(ScriptedLLM):
+        def generate(self, prompt, response_model=None, max_tokens=64):
+            if response_model is ChunkTypesResponse and prompt.count("\n\n[") >= 4:
+                raise ValueError("answer cut off at max_tokens")
+            return super().generate(prompt, response_model, max_tokens)
+
+    classifier = BatchChunkClassifier(FailingLLM(), max_batch_size=8, retries=3, count=words)
+    assert [type for type, _ in classifier.classify(chunks)] == [label for _, label in FIXTURE_CHUNKS], "Expected failed batches to be retried smaller"
+    assert BatchChunkClassifier(FailingLLM(), max_batch_size=8, retries=0, count=words).classify(chunks[:5]) == [("other", [])] * 5
+    print("classify.py: All tests passed!")
+
+def benchmark_batch_chunk_classifier(model: Optional[AbstractLLM] = None, topics: Sequence[str] = ("voting in the United States",), repeat: int = 4):
+    """
+    LLM calls, prompt tokens, wall time and accuracy on FIXTURE_CHUNKS of per-chunk typing, as
+    `LLMDataCleaner.get_chunks` does by default, against BatchChunkClassifier. Pass `model` to run it
+    against something other than the cleaner's own GPT-4 topic model.
+    """
+    if model is None:
+        from clean import LLMDataCleaner
+        model = LLMDataCleaner(topics=list(topics), dedup=False).topic_model
+    system_prompt_tokens = count_tokens(getattr(model, "system_prompt", None) or "")
+    chunks = [text for text, _ in FIXTURE_CHUNKS] * repeat
+    # the same chunk repeated would be answered from the LLM cache, so each copy gets its own number
+    chunks = [f"{text} ({copy})" for copy, text in enumerate(chunks)]
+    labels = [label for _, label in FIXTURE_CHUNKS] * repeat
+
+    class Counting(AbstractLLM):
+        def __init__(self):
+            self.calls = 0
+            self.tokens = 0
+
+        def generate(self, prompt, response_model=None, max_tokens=64):
+            self.calls += 1
+            self.tokens += system_prompt_tokens + count_tokens(prompt)
+            return model.generate(prompt, response_model=response_model, max_tokens=max_tokens)
+
+    per_chunk = Counting()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        single = [response.type for response in executor.map(lambda chunk: per_chunk.generate(chunk, response_model=ChunkTypeResponse, max_tokens=256), chunks)]
+    single_seconds = time.perf_counter() - start
+
+    batched = Counting()
+    start = time.perf_counter()
+    batch = [type for type, _ in BatchChunkClassifier(batched).classify(chunks)]
+    batch_seconds = time.perf_counter() - start
+
+    accuracy = lambda types: sum(type == label for type, label in zip(types, labels)) / len(labels)
+    agreement = sum(a == b for a, b in zip(single, batch)) / len(chunks)
+    print(f"{len(chunks)} chunks")
+    print(f"per chunk: {per_chunk.calls:4d} calls, {per_chunk.tokens:7d} prompt tokens, {single_seconds:6.2f} s, {accuracy(single):.0%} accurate")
+    print(f"batched:   {batched.calls:4d} calls, {batched.tokens:7d} prompt tokens, {batch_seconds:6.2f} s, {accuracy(batch):.0%} accurate, {agreement:.0%} agree with per chunk")
+
+if __name__ == "__main__":
+    test_batch_chunk_classifier()
+    benchmark_batch_chunk_classifier()
@@ -1,11 +1,15 @@
 from abc import ABC, abstractmethod
 from datetime import datetime
 import logging
-from typing import List, Optional
+from typing import List, Optional, Sequence, Union
 from bs4 import BeautifulSoup
+from classify import BatchChunkClassifier, ChunkTypeResponse
+from dedup import NearDuplicateIndex, get_near_duplicate_index
 from llm import AbstractLLM, GPT
+from parse import ParsedPage, clean_lines
 from pydantic import BaseModel
-from schema import Chunk, Document 
+from schema import ChunkBatch, Document 
+from split import TextAligner, TokenSplitter
 from utils import get_document_id, get_chunk_id
 from embed import embed 
 
@@ -13,37 +17,48 @@ from embed import embed
 # For example, we could have "parent text", "html node", etc. as fields on the chunk. 
 # We definitely do not want to lose the context. Nikki Haley's website makes brazen claims that are not substantiated by the text.
 
+class EmbedError(Exception):
+    """Raised when none of a document's chunks could be embedded, so the page has to be processed again."""
+    pass
+
 class AbstractDataCleaner(ABC):
     @abstractmethod
-    def get_chunks(self, raw_data: BeautifulSoup):
+    def get_chunks(self, raw_data: Union[ParsedPage, BeautifulSoup], document_id: Optional[str] = None):
+        pass
+
+    def register_saved_chunks(self, chunks: ChunkBatch):
+        """Called once `chunks` are written to the database."""
         pass
 
-    def get_clean_text(self, raw_data: BeautifulSoup):
+    def get_clean_text(self, raw_data: Union[ParsedPage, BeautifulSoup]):
+        # a ParsedPage already collected its clean text while it was parsed
+        if isinstance(raw_data, ParsedPage):
+            return raw_data.clean_text
+
         for script in raw_data(["script", "style"]):
             script.decompose()  # rip it out
 
         # get text
         text = raw_data.get_text(separator=' ', strip=True)
-        # break into lines and remove leading and trailing space on each
-        lines = (line.strip() for line in text.splitlines())
-        # break multi-headlines into a line each
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        # drop blank lines
-        text = '\n'.join(chunk for chunk in chunks if chunk)
-        return text 
+        return clean_lines(text)
     
-    def get_document(self, url: str, raw_data: BeautifulSoup) -> Document:
-        # get the title of the page using beautifulsoup 
-        title = raw_data.title.string
-        # get the date of the page using beautifulsoup
-        date_published = raw_data.find("meta",  property="article:published_time")
-
-        if date_published:
-            date_published = date_published['content']
-        
-        author = raw_data.find("meta",  property="article:author")
-        if author:
-            author = author['content']
+    def get_document(self, url: str, raw_data: Union[ParsedPage, BeautifulSoup]) -> Document:
+        if isinstance(raw_data, ParsedPage):
+            title = raw_data.title
+            date_published = raw_data.meta.get("article:published_time")
+            author = raw_data.meta.get("article:author")
+        else:
+            # get the title of the page using beautifulsoup 
+            title = raw_data.title.string
+            # get the date of the page using beautifulsoup
+            date_published = raw_data.find("meta",  property="article:published_time")
+
+            if date_published:
+                date_published = date_published['content']
+            
+            author = raw_data.find("meta",  property="article:author")
+            if author:
+                author = author['content']
 
         date_crawled = datetime.now()
 
@@ -53,40 +68,72 @@ class AbstractDataCleaner(ABC):
         document = Document(id=document_id, url=url, title=title, author=author, date_crawled=date_crawled, date_published=date_published, topics=[])
         return document
     
-    # TODO: maybe link to neighbors in document 
-    def enrich_chunks(self, chunk_contents: List[str], document: Document, chunks_surrounding_contents: List[str] = [], chunk_extra_info: List[dict] = []):
-        chunks = []
-        index = 0
-        # generate a uuid 
-
-        # embed each one with error handled, if it fails delete the chunk and continue
+    def get_chunk_embedding_text(self, document: Document, content: str) -> str:
+        # We embed the title and the content together to get a better embedding
+        return f"{document.title} ({document.url}): {content}"
 
-        for content in chunk_contents:
-            id = get_chunk_id(content)
+    # TODO: maybe link to neighbors in document 
+    def enrich_chunks(self, chunk_contents: List[str], document: Document, chunks_surrounding_contents: List[str] = [], chunk_extra_info: List[dict] = [], embeddings: Optional[Sequence] = None) -> ChunkBatch:
+        """
+        Builds the chunks of a document. All of its chunks are embedded in one batched call, unless
+        `embeddings` (one per content) were already computed, e.g. across several documents at once.
+
+        If the batched call fails the chunks are embedded one at a time and the ones that still fail
+        are dropped. Raises `EmbedError` when not a single chunk could be embedded.
+        """
+        if embeddings is None and chunk_contents:
+            texts = [self.get_chunk_embedding_text(document, content) for content in chunk_contents]
             try: 
-                # We embed the title and the content together to get a better embedding
-                embedding = embed([f"{document.title} ({document.url}): {content}"])[0]
-            except:
-                logging.info(f"Failed to embed chunk with content: {content}")
-                continue
-
-            chunk_surrounding_content = chunks_surrounding_contents[index] if chunks_surrounding_contents else ""
+                embeddings = embed(texts)
+            except Exception as e:
+                logging.info(f"Failed to embed {len(chunk_contents)} chunks for {document.url} due to {e}, embedding them one at a time")
+                kept, embeddings = [], []
+                for index, text in enumerate(texts):
+                    try:
+                        embeddings.append(embed([text])[0])
+                        kept.append(index)
+                    except Exception as chunk_error:
+                        logging.info(f"Failed to embed chunk with content: {chunk_contents[index]} due to {chunk_error}")
+                if not kept:
+                    raise EmbedError(f"Could not embed any of the {len(chunk_contents)} chunks of {document.url}") from e
+                chunk_contents = [chunk_contents[index] for index in kept]
+                chunks_surrounding_contents = [chunks_surrounding_contents[index] for index in kept] if chunks_surrounding_contents else []
+                chunk_extra_info = [chunk_extra_info[index] for index in kept] if chunk_extra_info else []
+        embeddings = embeddings if embeddings is not None else []
+
+        count = min(len(chunk_contents), len(embeddings))
+        types = []
+        topics = []
+        index_in_doc = []
+        for index in range(count):
             this_chunk_extra_info  = chunk_extra_info[index] if (chunk_extra_info and  chunk_extra_info[index]) else {"type": "other", "subtopics": []}
-            if (not this_chunk_extra_info['subtopics'] or len(this_chunk_extra_info['subtopics']) == 0):
-                this_chunk_extra_info['subtopics'] = []
-            chunks.append(Chunk(id=id, document_id=document.id, content=content, index_in_doc=index, embedding=embedding, surrounding_content=chunk_surrounding_content, type=this_chunk_extra_info['type'], topics=this_chunk_extra_info['subtopics']+document.topics))
-            index += 1
-        return chunks
+            types.append(this_chunk_extra_info['type'])
+            topics.append((this_chunk_extra_info['subtopics'] or []) + document.topics)
+            # cleaners return chunks in document order, so a chunk's index is its position among the
+            # chunks that are kept, without gaps for dropped ones
+            index_in_doc.append(index)
+        return ChunkBatch(
+            ids=[get_chunk_id(content) for content in chunk_contents[:count]],
+            document_ids=[document.id] * count,
+            index_in_doc=index_in_doc,
+            contents=list(chunk_contents[:count]),
+            surrounding_contents=list(chunks_surrounding_contents[:count]) if chunks_surrounding_contents else None,
+            types=types,
+            topics=topics,
+            embeddings=embeddings[:count],
+        )
             
 
 class SimpleDataCleaner(AbstractDataCleaner):
-    def get_chunks(self, raw_data: BeautifulSoup):
+    def get_chunks(self, raw_data: Union[ParsedPage, BeautifulSoup], document_id: Optional[str] = None):
         # Strip out all scripts, styles, and unnecessary tags to return clean html nodes
+        if isinstance(raw_data, ParsedPage):
+            return [raw_data.clean_text]
         return [raw_data.get_text()]
 
 class LLMDataCleaner(AbstractDataCleaner):
     # initialize with a GPT("3.5") client
-    def __init__(self, topics=[]):
+    def __init__(self, topics=[], dedup: bool = True, near_duplicates: Optional[NearDuplicateIndex] = None, dedup_scope: str = "default", part_tokens: int = 3000, part_overlap_tokens: int = 0, batch_typing: bool = False):
         system_prompt = "Here is some raw data that we extracted from a webpage. We want to break it up into specific chunks that are logically coherent, preserving the initial text exactly. Please provide a list of these chunks, and be precise. We do not care about headers or short strings or links to other pages, we only want actual substantive information. If it is not a FACT that will be a useful reference text, do not include it. Don't just include stuff that points to other facts without adding substantive information. Skip over short pieces of text, such as anything less than a few sentences long. We do NOT want meaningless things like `Learn about this` or `Find more here` if the actual info is not shared. DO NOT INCLUDE ANYTHING THAT DOES NOT HAVE A CONCRETE, USEFUL FACT."
         if (topics):
             system_prompt += " We ONLY care about text related to these topics, and it MUST add real information to a user's search query. You must ignore the rest so we don't look at any irrelevant information: " + ",".join(topics)
@@ -100,30 +147,47 @@ class LLMDataCleaner(AbstractDataCleaner):
                                
                                For `subtopics`, we want to classify at most 1-2 and optionally zero "subtopics" that the piece of information is about. For example, a piece of text may be about "abortion", "climate", "democracy", "lgbt", "foreign policy", "economy", "war", etc. Make your topic names short and succinct.""")
         self.max_workers = 8
+        # the model has to write the chunks of a part back out verbatim, so parts stay well under its
+        # 4096 token completion limit
+        self.splitter = TokenSplitter(part_tokens, part_overlap_tokens)
+        # chunks that nearly repeat one already saved by the crawl (footers, "check your registration"
+        # blurbs) are dropped before they're typed and embedded. Each crawl passes its own scope
+        self.near_duplicates = (near_duplicates if near_duplicates is not None else get_near_duplicate_index(dedup_scope)) if dedup else None
+        # types many chunks per call instead of one call per chunk, see classify.BatchChunkClassifier
+        self.classifier = BatchChunkClassifier(self.topic_model, max_workers=self.max_workers) if batch_typing else None
         super().__init__()
 
-    def get_chunks(self, raw_data: BeautifulSoup):
+    def drop_near_duplicates(self, chunks: List[str], document_id: Optional[str] = None) -> List[str]:
+        if self.near_duplicates is None:
+            return chunks
+        kept = []
+        for content in chunks:
+            canonical = self.near_duplicates.find(content, document_id)
+            if canonical is None:
+                kept.append(content)
+            else:
+                logging.debug(f"Dropping chunk {get_chunk_id(content)}, a near duplicate of {canonical}")
+                self.near_duplicates.link(get_chunk_id(content), document_id, canonical)
+        if len(kept) < len(chunks):
+            logging.info(f"Dropped {len(chunks) - len(kept)}/{len(chunks)} near-duplicate chunks, stats {self.near_duplicates.stats()}")
+        return kept
+
+    def register_saved_chunks(self, chunks: ChunkBatch):
+        # only saved chunks can stand in for the near duplicates dropped later
+        if self.near_duplicates is not None:
+            for id, document_id, content in zip(chunks.ids, chunks.document_ids, chunks.contents):
+                self.near_duplicates.add(id, content, document_id)
+
+    def get_chunks(self, raw_data: Union[ParsedPage, BeautifulSoup], document_id: Optional[str] = None):
         class CleanResponse(BaseModel):
             chunks: list[str]
 
-        max_tokens=3000
-
-        def split_text(text, limit=max_tokens):
-            """
-            Recursively splits the text into halves until each part is under the limit.
-            """
-            if len(text) <= limit:
-                return [text]
-            else:
-                midpoint = len(text) // 2
-                return split_text(text[:midpoint], limit) + split_text(text[midpoint:], limit)
-
         clean_text = self.get_clean_text(raw_data)
 
-        chunks = []
-        # Split the clean text into parts that are under the max_tokens limit
-
-        parts = split_text(clean_text, max_tokens)
+        # Split the clean text into parts of at most part_tokens, between paragraphs and sentences
+        parts = list(self.splitter.split(clean_text))
+        if not parts:
+            return [], [], []
 
         from concurrent.futures import ThreadPoolExecutor
 
@@ -131,25 +195,36 @@ class LLMDataCleaner(AbstractDataCleaner):
             model_response = self.model.generate(part, response_model=CleanResponse, max_tokens=4096)
             return model_response.chunks
 
+        # each chunk's (start, end) in the clean text, found in the part it came from
+        aligner = TextAligner(clean_text)
+        spans = {}
+
         # We can run many parallel because we are I/O bound 
         with ThreadPoolExecutor(max_workers=min(len(parts), self.max_workers)) as executor:
-            future_chunks = [executor.submit(generate_chunks, part) for part in parts]
-            for future in future_chunks:
-                chunks.extend(future.result())
-        
-        chunks =  [chunk for chunk in chunks if len(chunk) > 30]
+            future_chunks = [(part, executor.submit(generate_chunks, part.text)) for part in parts]
+            for part, future in future_chunks:
+                part_chunks = [chunk for chunk in future.result() if len(chunk) > 30]
+                for chunk, span in zip(part_chunks, aligner.align(part_chunks, within=part)):
+                    # overlapping parts can give back the same chunk twice, the first one wins
+                    if chunk not in spans:
+                        # a chunk the model reworded can't be found, so it's placed at the start of its part
+                        spans[chunk] = span or (part.start, None)
+
+        # chunks in document order, which `enrich_chunks` numbers them by
+        chunks = sorted(spans, key=lambda chunk: spans[chunk][0])
+        chunks = self.drop_near_duplicates(chunks, document_id)
+        if not chunks:
+            return [], [], []
         # for each chunk, get surrounding_content which is the ~200 characters before and after the chunk
         chunks_surrounding_contents = []
         for content in chunks:
-            start_index = clean_text.find(content)
-            end_index = start_index + len(content)
+            start_index, end_index = spans[content]
+            if end_index is None:
+                chunks_surrounding_contents.append(content)
+                continue
             surrounding_content = clean_text[max(0, start_index-200):min(len(clean_text), end_index+200)]
             chunks_surrounding_contents.append(surrounding_content)
 
-        class ChunkTypeResponse(BaseModel):
-            type: str
-            subtopics: Optional[List[str]] = []
-        
         # type can be direct_quote, paraphrase, commentary, useful_information, or other
         # direct_quote: a direct quote from the source or person in question
         # paraphrase: a paraphrase of the source or person in question
@@ -158,13 +233,15 @@ class LLMDataCleaner(AbstractDataCleaner):
             model_response = self.topic_model.generate(chunk, response_model=ChunkTypeResponse, max_tokens=256)
             return model_response.type, model_response.subtopics
 
-        chunk_extra_info = []
+        if self.classifier:
+            chunk_types = self.classifier.classify(chunks)
+        else:
+            with ThreadPoolExecutor(max_workers=min(len(chunks), self.max_workers)) as executor:
+                chunk_types = list(executor.map(generate_chunk_type, chunks))
 
-        with ThreadPoolExecutor(max_workers=min(len(chunks), self.max_workers)) as executor:
-            future_chunk_types = [executor.submit(generate_chunk_type, chunk) for chunk in chunks]
-            for index, future in enumerate(future_chunk_types):
-                chunk_type, chunk_subtopics = future.result()
-                chunk_extra_info.append({"type": chunk_type, "subtopics": chunk_subtopics})
+        chunk_extra_info = []
+        for chunk, (chunk_type, chunk_subtopics) in zip(chunks, chunk_types):
+            chunk_extra_info.append({"type": chunk_type, "subtopics": chunk_subtopics})
 
 
         return chunks, chunks_surrounding_contents, chunk_extra_info
@@ -198,7 +275,29 @@ def test_llm_data_cleaner_chunking_and_levenshtein_distance():
 
     print("LLMDataCleaner chunking tests and Levenshtein distance checks passed.")
 
+def test_llm_data_cleaner_index_in_doc():
+    import os
+    import tempfile
+    from types import SimpleNamespace
+    near_duplicates = NearDuplicateIndex(os.path.join(tempfile.mkdtemp(), "near_duplicates.sqlite3"))
+    cleaner = LLMDataCleaner(near_duplicates=near_duplicates)
+    footer = "This is an official website of the State of Ohio, check your voter registration status online."
+    text = f"Early voting starts on October 8 at every county board of elections.\n{footer}\nPolls are open from 6:30am to 7:30pm on Election Day."
+    chunks = [line for line in text.splitlines()]
+    # the model hands the chunks back out of order
+    cleaner.model = SimpleNamespace(generate=lambda part, **kwargs: SimpleNamespace(chunks=chunks[::-1]))
+    cleaner.topic_model = SimpleNamespace(generate=lambda chunk, **kwargs: SimpleNamespace(type="useful_information", subtopics=[]))
+    near_duplicates.add("footer", footer, "other-page")
+
+    contents, surrounding_contents, extra_info = cleaner.get_chunks(ParsedPage(clean_text=text), "page")
+    assert contents == [chunks[0], chunks[2]], f"Expected the footer to be dropped and the rest kept in document order, got {contents}"
+    document = Document(id="page", url="https://vote.example.gov", title="Voting", topics=[])
+    batch = cleaner.enrich_chunks(contents, document, surrounding_contents, extra_info, embeddings=[[0.0], [1.0]])
+    assert batch.index_in_doc == [0, 1], f"Expected indexes without a gap for the dropped chunk, got {batch.index_in_doc}"
+    print("LLMDataCleaner index_in_doc tests passed.")
+
 if __name__ == "__main__":
     test_llm_data_cleaner_chunking_and_levenshtein_distance()
+    test_llm_data_cleaner_index_in_doc()
     print("All tests passed")
 
@@ -2,20 +2,44 @@ from abc import ABC, abstractmethod
 # import psycopg2
 # from psycopg2.extras import RealDictCursor
 import os
-from typing import List
+from datetime import datetime, timedelta
+import time
+from threading import Condition, Thread
+from typing import Callable, List, Optional, Union
 from embed import embed 
 from prisma import Prisma
 from utils import get_uuid, get_document_id, get_chunk_id
-from schema import Document, Chunk
+from schema import Document, Chunk, ChunkBatch, as_chunk_batch
+from vectors import to_pgvector
+from vector_index import VectorIndex
+from lexical import LexicalIndex
 import logging
 
+# called with the ids of the rows that failed once a save is written, see `AbstractDatabase.save`
+OnSaved = Callable[[List[str]], None]
+
 class AbstractDatabase(ABC):
     @abstractmethod
     def save_documents(self, documents: List[Document]):
         pass
 
     @abstractmethod
-    def save_chunks(self, chunks: List[Chunk]):
+    def save_chunks(self, chunks: Union[List[Chunk], ChunkBatch]):
+        pass
+
+    def save(self, documents: List[Document], chunks: Union[List[Chunk], ChunkBatch], on_saved: Optional[OnSaved] = None):
+        """
+        Saves the rows. `on_saved` is called with the ids of any rows that failed once the rows are
+        actually written, which for a buffering database is some time after `save` returns, and not
+        at all if the write fails outright.
+        """
+        self.save_documents(documents)
+        self.save_chunks(chunks)
+        if on_saved:
+            on_saved([])
+
+    def flush(self):
+        # for databases that buffer writes; called when a crawl finishes
         pass
 
 class SimpleDatabase(AbstractDatabase):
@@ -31,9 +55,11 @@ class SimpleDatabase(AbstractDatabase):
                 file.write(f"URL: {document.url}\nTitle: {document.title}\nAuthor: {document.author}\nDate Crawled: {document.date_crawled}\nDate Published: {document.date_published}")
             logging.debug(f"Saved document with ID {document.id} to SimpleDatabase")
 
-    def save_chunks(self, chunks: List[Chunk]):
+    def save_chunks(self, chunks: Union[List[Chunk], ChunkBatch]):
         logging.debug("Creating directory for chunks if it doesn't exist.")
         os.makedirs("./simple_db/chunks", exist_ok=True)
+        if isinstance(chunks, ChunkBatch):
+            chunks = chunks.to_chunks()
         for chunk in chunks:
             logging.debug(f"Processing chunk for document ID {chunk.document_id}")
             # get a safe key name from the chunk document_id and index_in_doc
@@ -43,9 +69,35 @@ class SimpleDatabase(AbstractDatabase):
                 file.write(chunk.content)
             logging.debug(f"Saved chunk for document ID {chunk.document_id} to SimpleDatabase")
 
+DOCUMENT_COLUMNS = ['id', 'title', 'url', 'author', 'date_crawled', 'date_published', 'topics']
+CHUNK_COLUMNS = ['id', 'content', 'document_id', 'index_in_doc', 'embedding', 'surrounding_content', 'type', 'topics']
+# how each column's text parameter is cast in SQL; everything else is sent as text
+COLUMN_CASTS = {'date_crawled': 'timestamp', 'date_published': 'timestamp', 'topics': 'text[]', 'embedding': 'vector', 'index_in_doc': 'integer'}
+
+def to_pg_array(values) -> str:
+    escaped = (str(item).replace('\\', '\\\\').replace('"', '\\"') for item in values)
+    return "{" + ",".join(f'"{item}"' for item in escaped) + "}"
+
+def to_sql_param(column: str, value):
+    if value is None:
+        return None
+    if column == 'embedding':
+        return to_pgvector(value)
+    if column == 'topics':
+        return to_pg_array(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
 class PrismaDatabase(AbstractDatabase):
-    def __init__(self):
+    """
+    Writes rows with multi-row, parameterized `INSERT ... ON CONFLICT` statements of up to
+    `batch_size` rows each. When a batch fails it is retried row by row, so the rows that are
+    actually bad get logged and returned by id instead of taking the whole batch down silently.
+    """
+    def __init__(self, batch_size: int = 100):
         logging.debug("Initializing PrismaDatabase connection.")
+        self.batch_size = batch_size
         self.prisma = Prisma()
         self.prisma.connect()
 
@@ -60,71 +112,291 @@ class PrismaDatabase(AbstractDatabase):
         except Exception as e:
             logging.error(f"Failed to execute query: {e}")
 
-    def save_documents(self, documents: List[Document], upsert: bool = True):
-        for document in documents:
-            logging.debug(f"Preparing to save document with ID {document.id}")
-            columns = ['id']
-            values = [f"'{document.id}'"]
-            possible_columns = ['title', 'url', 'author', 'date_crawled', 'date_published', 'topics']
-            upsert_columns = []
-
-            for column in possible_columns:
-                value = getattr(document, column, None)
-                if value is not None:
-                    columns.append(f'"{column}"')
-                    upsert_columns.append(f'"{column}" = EXCLUDED."{column}"')
-                    if isinstance(value, list):  # Assuming topics is a list
-                        formatted_list = "{" + ",".join([f'"{item}"' for item in value]) + "}"
-                        values.append(f"'{formatted_list}'")
-                    else:
-                        values.append(f"'{value}'")
-            
-            columns_str = ", ".join(columns)
-            values_str = ", ".join(values)
-            upsert_str = ", ".join(upsert_columns)
-            query = f'INSERT INTO "Document" ({columns_str}) VALUES ({values_str})'
-            if upsert:
-                query += f' ON CONFLICT (id) DO UPDATE SET {upsert_str}'
-            self.execute_raw_query(query)
-            logging.debug(f"Saved document with ID {document.id} to PrismaDatabase")
-
-    def save_chunks(self, chunks: List[Chunk], upsert: bool = True):
-        for chunk in chunks:
-            logging.debug(f"Preparing to save chunk for document ID {chunk.document_id}")
-            columns = ['id']
-            values = [f"'{chunk.id}'"]
-            possible_columns = ['content', 'document_id', 'index_in_doc', 'embedding', 'surrounding_content', 'type', 'topics']
-            upsert_columns = []
-
-            for column in possible_columns:
-                value = getattr(chunk, column, None)
-                if value is not None:
-                    columns.append(f'"{column}"')
-                    upsert_columns.append(f'"{column}" = EXCLUDED."{column}"')
-                    try:
-                        if (column == 'index_in_doc'):
-                            values.append(str(value))
-                        elif (column == 'embedding'):
-                            # Escaping single quotes in strings to prevent syntax errors
-                            values.append(f"'{value}'")
-                        elif (column == 'topics'):
-                            formatted_list = "{" + ",".join([f'"{item}"' for item in value]) + "}"
-                            values.append(f"'{formatted_list}'")
+    def build_upsert(self, table: str, columns: List[str], rows: List[list], upsert: bool = True):
+        args = []
+        values = []
+        for row in rows:
+            placeholders = []
+            for column, value in zip(columns, row):
+                args.append(to_sql_param(column, value))
+                cast = COLUMN_CASTS.get(column)
+                placeholders.append(f"${len(args)}::{cast}" if cast else f"${len(args)}")
+            values.append("(" + ", ".join(placeholders) + ")")
+        columns_str = ", ".join(f'"{column}"' for column in columns)
+        query = f'INSERT INTO "{table}" ({columns_str}) VALUES {", ".join(values)}'
+        if upsert:
+            # like the old per-row statements, a missing value never overwrites a stored one
+            upsert_str = ", ".join(f'"{column}" = COALESCE(EXCLUDED."{column}", "{table}"."{column}")' for column in columns if column != 'id')
+            query += f' ON CONFLICT (id) DO UPDATE SET {upsert_str}'
+        return query, args
+
+    def build_statements(self, table: str, columns: List[str], items: Union[list, ChunkBatch], upsert: bool = True):
+        if isinstance(items, ChunkBatch):
+            # straight from the columns, without building a `Chunk` per row
+            rows = [list(row) for row in zip(*(items.column(column) for column in columns))]
+        else:
+            rows = [[getattr(item, column, None) for column in columns] for item in items]
+        # Postgres rejects an upsert that touches the same row twice, and chunk ids are content
+        # hashes, so repeats are normal: the last copy of each id wins, as it would row by row
+        rows = list({row[0]: row for row in rows}.values())
+        return [(table, columns, rows[start:start + self.batch_size], upsert) for start in range(0, len(rows), self.batch_size)]
+
+    def write(self, statements: list) -> List[str]:
+        """
+        Runs the batched statements in one transaction, returning the ids of rows that could not be
+        saved. If that fails, every row is written again in one transaction with a savepoint per row,
+        so only the rows that fail are left out.
+        """
+        if not statements:
+            return []
+        try:
+            with self.prisma.tx(timeout=timedelta(seconds=60)) as transaction:
+                for table, columns, rows, upsert in statements:
+                    transaction.execute_raw(*self.build_upsert(table, columns, rows, upsert))
+            return []
+        except Exception as e:
+            logging.warning(f"PrismaDatabase: Batched write failed due to {e}, retrying row by row")
+
+        failed = []
+        try:
+            with self.prisma.tx(timeout=timedelta(seconds=60)) as transaction:
+                for table, columns, rows, upsert in statements:
+                    for row in rows:
+                        transaction.execute_raw("SAVEPOINT row_write")
+                        try:
+                            transaction.execute_raw(*self.build_upsert(table, columns, [row], upsert))
+                        except Exception as e:
+                            transaction.execute_raw("ROLLBACK TO SAVEPOINT row_write")
+                            logging.error(f"PrismaDatabase: Failed to save {table} {row[0]} due to {e}")
+                            failed.append(row[0])
                         else:
-                            escaped_value = str(value).replace("'", "''")
-                            values.append(f"'{escaped_value}'")
+                            transaction.execute_raw("RELEASE SAVEPOINT row_write")
+        except Exception as e:
+            logging.error(f"PrismaDatabase: Row by row write failed due to {e}")
+            return [row[0] for _, _, rows, _ in statements for row in rows]
+        return failed
+
+    def save_documents(self, documents: List[Document], upsert: bool = True) -> List[str]:
+        failed = self.write(self.build_statements("Document", DOCUMENT_COLUMNS, documents, upsert))
+        logging.debug(f"Saved {len(documents) - len(failed)} documents to PrismaDatabase")
+        return failed
+
+    def save_chunks(self, chunks: Union[List[Chunk], ChunkBatch], upsert: bool = True) -> List[str]:
+        failed = self.write(self.build_statements("Chunk", CHUNK_COLUMNS, chunks, upsert))
+        logging.debug(f"Saved {len(chunks) - len(failed)} chunks to PrismaDatabase")
+        return failed
+
+    def save(self, documents: List[Document], chunks: Union[List[Chunk], ChunkBatch], on_saved: Optional[OnSaved] = None, upsert: bool = True) -> List[str]:
+        # documents go first so the chunks' foreign keys resolve within the same transaction
+        statements = self.build_statements("Document", DOCUMENT_COLUMNS, documents, upsert) + self.build_statements("Chunk", CHUNK_COLUMNS, chunks, upsert)
+        failed = self.write(statements)
+        if on_saved:
+            on_saved(failed)
+        return failed
+
+class WriteBehindDatabase(AbstractDatabase):
+    """
+    Wraps another database so saves return as soon as the rows are buffered.
+
+    A dedicated writer thread flushes the buffer, across however many pages filled it, once it holds
+    `flush_rows` rows or its oldest row is `flush_interval` seconds old. When `max_rows` rows are
+    waiting, savers block until the writer catches up. `flush` waits until everything buffered so
+    far has been written.
+
+    Each save's `on_saved` runs on the writer thread once the flush holding its rows is written, so
+    callers can record what's durable (visited urls, page states) only then. A flush that fails
+    drops its callbacks along with its rows.
+    """
+    def __init__(self, db: AbstractDatabase, flush_rows: int = 500, max_rows: int = 5000, flush_interval: float = 2.0):
+        self.db = db
+        self.flush_rows = flush_rows
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.documents = []
+        # `ChunkBatch`es, merged into one when written
+        self.chunks = []
+        self.chunk_rows = 0
+        self.callbacks = []
+        self.oldest = None
+        self.writing = False
+        self.flush_requested = False
+        self.closed = False
+        self.condition = Condition()
+        self.thread = Thread(target=self._write_loop, name="WriteBehindDatabase", daemon=True)
+        self.thread.start()
+
+    def buffered(self) -> int:
+        return len(self.documents) + self.chunk_rows
+
+    def save(self, documents: List[Document], chunks: Union[List[Chunk], ChunkBatch], on_saved: Optional[OnSaved] = None):
+        chunks = as_chunk_batch(chunks)
+        with self.condition:
+            while self.buffered() >= self.max_rows and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                raise RuntimeError("WriteBehindDatabase is closed")
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            self.documents.extend(documents)
+            if len(chunks):
+                self.chunks.append(chunks)
+                self.chunk_rows += len(chunks)
+            if on_saved:
+                self.callbacks.append(on_saved)
+            self.condition.notify_all()
+
+    def save_documents(self, documents: List[Document]):
+        self.save(documents, [])
+
+    def save_chunks(self, chunks: Union[List[Chunk], ChunkBatch]):
+        self.save([], chunks)
+
+    def _write_loop(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.buffered() and (self.flush_requested or self.closed or self.buffered() >= self.flush_rows):
+                        break
+                    if self.buffered() and time.monotonic() - self.oldest >= self.flush_interval:
+                        break
+                    if self.closed:
+                        return
+                    timeout = None if not self.buffered() else self.flush_interval - (time.monotonic() - self.oldest)
+                    self.condition.wait(timeout)
+                documents, chunks, callbacks = self.documents, self.chunks, self.callbacks
+                self.documents, self.chunks, self.chunk_rows, self.callbacks, self.oldest = [], [], 0, [], None
+                self.writing = True
+                self.condition.notify_all()
+
+            try:
+                chunks = ChunkBatch.concat(chunks)
+                failed = self.db.save(documents, chunks) or []
+                if failed:
+                    logging.error(f"WriteBehindDatabase: {len(failed)} of {len(documents) + len(chunks)} rows failed to save")
+            except Exception as e:
+                logging.error(f"WriteBehindDatabase: Failed to write {len(documents)} documents and {len(chunks)} chunks due to {e}", exc_info=True)
+            else:
+                for on_saved in callbacks:
+                    try:
+                        on_saved(failed)
                     except Exception as e:
-                        logging.error(f"Error processing value for column '{column}' with content: '{value}'. Error: {e}")
-                        continue
-            
-            columns_str = ", ".join(columns)
-            values_str = ", ".join(values)
-            upsert_str = ", ".join(upsert_columns)
-            query = f'INSERT INTO "Chunk" ({columns_str}) VALUES ({values_str})'
-            if upsert:
-                query += f' ON CONFLICT (id) DO UPDATE SET {upsert_str}'
-            self.execute_raw_query(query)
-            logging.debug(f"Saved chunk for document ID {chunk.document_id} to PrismaDatabase")
+                        logging.error(f"WriteBehindDatabase: on_saved callback failed due to {e}", exc_info=True)
+
+            with self.condition:
+                self.writing = False
+                if not self.buffered():
+                    self.flush_requested = False
+                self.condition.notify_all()
+
+    def flush(self):
+        with self.condition:
+            self.flush_requested = True
+            self.condition.notify_all()
+            while self.buffered() or self.writing:
+                self.condition.wait()
+
+    def close(self):
+        self.flush()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.db.flush()
+
+class IndexedDatabase(AbstractDatabase):
+    """
+    Wraps another database and adds every saved chunk to the local indexes that
+    `retrieve.LocalRetriever` and `retrieve.HybridRetriever` search, so they keep up with the crawl:
+    its embedding to `index` and its content to `lexical`, if given. Chunks the wrapped database
+    reports as failed are left out. Wrap this in `WriteBehindDatabase`, not the other way around,
+    so the indexes only see rows once they are written.
+    """
+    def __init__(self, db: AbstractDatabase, index: VectorIndex, lexical: Optional[LexicalIndex] = None):
+        self.db = db
+        self.index = index
+        self.lexical = lexical
+
+    def save(self, documents: List[Document], chunks: Union[List[Chunk], ChunkBatch], on_saved: Optional[OnSaved] = None):
+        chunks = as_chunk_batch(chunks)
+        failed = self.db.save(documents, chunks) or []
+        failed_ids = set(failed)
+        rows = [row for row, id in enumerate(chunks.ids) if id not in failed_ids]
+        if chunks.embeddings is not None:
+            self.index.add([chunks.ids[row] for row in rows], chunks.embeddings[rows])
+        if self.lexical is not None:
+            self.lexical.add([chunks.ids[row] for row in rows], [chunks.contents[row] for row in rows])
+        if on_saved:
+            on_saved(failed)
+        return failed
+
+    def save_documents(self, documents: List[Document]):
+        return self.save(documents, [])
+
+    def save_chunks(self, chunks: Union[List[Chunk], ChunkBatch]):
+        return self.save([], chunks)
+
+    def flush(self):
+        if self.lexical is not None:
+            self.lexical.flush()
+        self.db.flush()
+
+def test_write_behind_database():
+    class RecordingDatabase(AbstractDatabase):
+        def __init__(self):
+            self.writes = []
+
+        def save_documents(self, documents):
+            self.writes.append(("documents", len(documents)))
+
+        def save_chunks(self, chunks):
+            time.sleep(0.05)
+            self.writes.append(("chunks", len(chunks)))
+
+    inner = RecordingDatabase()
+    db = WriteBehindDatabase(inner, flush_rows=10, max_rows=20, flush_interval=60)
+    document = Document(id="doc", url="https://example.com", title="Test Document")
+    written = []
+    for i in range(30):
+        db.save([document], [Chunk(id=str(i), document_id="doc", index_in_doc=i, content="Test Chunk")], on_saved=lambda failed, i=i: written.append(i))
+    db.flush()
+    assert sum(count for kind, count in inner.writes if kind == "chunks") == 30
+    assert sorted(written) == list(range(30)), "Expected every save's callback once its rows were written"
+    assert len(inner.writes) < 60, "Expected rows from several saves to be written together"
+    assert inner.writes[0][0] == "documents", "Expected documents to be written before their chunks"
+    db.close()
+
+    class BrokenDatabase(RecordingDatabase):
+        def save_chunks(self, chunks):
+            raise ConnectionError("database is down")
+
+    db = WriteBehindDatabase(BrokenDatabase(), flush_interval=60)
+    written = []
+    db.save([document], [Chunk(id="0", document_id="doc", index_in_doc=0, content="Test Chunk")], on_saved=written.append)
+    db.close()
+    assert not written, "Expected no callback for rows that were never written"
+    print("db.py: WriteBehindDatabase tests passed!")
+
+def test_indexed_database():
+    import tempfile
+    import numpy as np
+
+    class FailingDatabase(AbstractDatabase):
+        def save_documents(self, documents):
+            pass
+
+        def save_chunks(self, chunks):
+            pass
+
+        def save(self, documents, chunks):
+            return ["b"]
+
+    index = VectorIndex(tempfile.mkdtemp(), dimensions=2)
+    lexical = LexicalIndex(tempfile.mkdtemp())
+    db = IndexedDatabase(FailingDatabase(), index, lexical)
+    db.save([], ChunkBatch(ids=["a", "b"], contents=["early voting", "polling places"], embeddings=np.eye(2)))
+    assert index.ids == ["a"], f"Expected only the saved chunk to be indexed, got {index.ids}"
+    assert [id for id, _ in lexical.search("voting")] == ["a"] and not lexical.search("polling")
+    print("db.py: IndexedDatabase tests passed!")
 
 def test_prisma_database():
     logging.debug("Testing PrismaDatabase functionality.")
@@ -143,5 +415,7 @@ def test_prisma_database():
     del prisma_db
 
 if __name__ == "__main__":
+    test_write_behind_database()
+    test_indexed_database()
     test_prisma_database()
     print("db.py: All tests passed!")    
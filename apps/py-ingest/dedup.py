@@ -0,0 +1,202 @@
+import hashlib
+import os
+import re
+import sqlite3
+import time
+import zlib
+from threading import Lock
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+_indexes = {}
+_index_lock = Lock()
+
+def get_near_duplicate_index(scope: str = "default") -> 'NearDuplicateIndex':
+    """
+    One index per scope (a crawl, or a site), shared by every cleaner working on it. Crawls get their
+    own scopes so one state's chunks are never dropped as copies of another state's.
+    """
+    with _index_lock:
+        if scope not in _indexes:
+            _indexes[scope] = NearDuplicateIndex(os.path.join("local_cache", "near_duplicates", re.sub(r"[^A-Za-z0-9_.-]", "_", scope) + ".sqlite3"))
+        return _indexes[scope]
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    # splitmix64's finalizer; multiplications wrap around, which is what we want
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xbf58476d1ce4e5b9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
+
+def numbers(text: str) -> str:
+    """The text's number tokens (dates, years, phone numbers, ...), in order."""
+    return " ".join(word for word in _WORD.findall(text.lower()) if word.isdigit())
+
+def shingles(text: str, size: int = 3) -> np.ndarray:
+    """Hashes of the text's word `size`-grams, after lowercasing and dropping punctuation."""
+    words = _WORD.findall(text.lower())
+    if len(words) <= size:
+        return np.array([zlib.crc32(" ".join(words).encode("utf-8"))], dtype=np.uint64)
+    return np.unique(np.fromiter((zlib.crc32(" ".join(words[i:i + size]).encode("utf-8")) for i in range(len(words) - size + 1)), dtype=np.uint64))
+
+class NearDuplicateIndex:
+    """
+    Persistent MinHash/LSH index of chunk texts, used to catch chunks that are near but not exact
+    copies of one already seen, like the same disclaimer with a different state name or date.
+
+    Each text gets a `num_perm` MinHash signature over its word shingles, split into `bands`. Texts
+    sharing any band are candidates, and a candidate is a duplicate when the signatures agree on at
+    least `threshold` of their values, which estimates the Jaccard similarity of the shingle sets.
+    Texts whose numbers differ are never duplicates, since a changed date or deadline is the fact.
+    Signatures and band buckets are kept in SQLite so the index lasts across runs of a crawl.
+
+    Only chunks that were saved should be added, see `add`, and a chunk is never a duplicate of one
+    from its own document. Dropped chunks are linked to their canonical chunk, see `link`.
+    """
+    def __init__(self, path: str = "local_cache/near_duplicates.sqlite3", num_perm: int = 128, bands: int = 32, threshold: float = 0.7, shingle_size: int = 3, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        # the seed fixes the permutations, so signatures stay comparable across runs
+        self.seeds = np.random.default_rng(seed).integers(0, 1 << 63, num_perm, dtype=np.uint64)
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS signatures (id TEXT PRIMARY KEY, document_id TEXT, numbers TEXT NOT NULL, signature BLOB NOT NULL) WITHOUT ROWID")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS buckets (band INTEGER NOT NULL, bucket INTEGER NOT NULL, id TEXT NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS buckets_lookup ON buckets (band, bucket)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS duplicates (id TEXT NOT NULL, document_id TEXT, canonical_id TEXT NOT NULL, PRIMARY KEY (id, document_id))")
+        self.checked = 0
+        self.duplicates = 0
+
+    def signature(self, text: str) -> np.ndarray:
+        # each seed picks a different hash of the shingles, and the signature keeps the minimum of each.
+        # A (a * x + b) mod p family was measurably biased low on short chunks, a full mixer isn't
+        hashes = shingles(text, self.shingle_size)
+        return _mix(hashes[:, None] ^ self.seeds[None, :]).min(axis=0).astype(np.uint32)
+
+    def _buckets(self, signature: np.ndarray) -> List[Tuple[int, int]]:
+        return [(band, int.from_bytes(hashlib.blake2b(signature[band * self.rows:(band + 1) * self.rows].tobytes(), digest_size=8).digest(), "little", signed=True)) for band in range(self.bands)]
+
+    def _find(self, signature: np.ndarray, buckets: List[Tuple[int, int]], numbers: str, document_id: Optional[str]) -> Optional[str]:
+        candidates = set()
+        for band, bucket in buckets:
+            candidates.update(id for id, in self.connection.execute("SELECT id FROM buckets WHERE band = ? AND bucket = ?", (band, bucket)))
+        best, best_similarity = None, self.threshold
+        for id in candidates:
+            stored_document_id, stored_numbers, stored = self.connection.execute("SELECT document_id, numbers, signature FROM signatures WHERE id = ?", (id,)).fetchone()
+            if stored_numbers != numbers or (document_id is not None and stored_document_id == document_id):
+                continue
+            similarity = float(np.mean(np.frombuffer(stored, dtype=np.uint32) == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = id, similarity
+        return best
+
+    def find(self, text: str, document_id: Optional[str] = None) -> Optional[str]:
+        """
+        The id of an indexed text that `text`, a chunk of `document_id`, is a near duplicate of, if
+        there is one. Only looks; `text` is added once it's saved.
+        """
+        signature = self.signature(text)
+        buckets = self._buckets(signature)
+        with self.lock:
+            self.checked += 1
+            canonical = self._find(signature, buckets, numbers(text), document_id)
+            if canonical is not None:
+                self.duplicates += 1
+            return canonical
+
+    def add(self, id: str, text: str, document_id: Optional[str] = None) -> None:
+        """Indexes a chunk. Call it once the chunk is saved, so a chunk is never dropped in favour of one that isn't."""
+        signature = self.signature(text)
+        buckets = self._buckets(signature)
+        with self.lock, self.connection:
+            if self.connection.execute("INSERT OR IGNORE INTO signatures (id, document_id, numbers, signature) VALUES (?, ?, ?, ?)", (id, document_id, numbers(text), signature.tobytes())).rowcount:
+                self.connection.executemany("INSERT INTO buckets (band, bucket, id) VALUES (?, ?, ?)", [(band, bucket, id) for band, bucket in buckets])
+
+    def link(self, id: str, document_id: Optional[str], canonical_id: str) -> None:
+        """Records that chunk `id` of `document_id` was dropped as a near duplicate of `canonical_id`."""
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO duplicates (id, document_id, canonical_id) VALUES (?, ?, ?)", (id, document_id, canonical_id))
+
+    def duplicates_of(self, canonical_id: str) -> List[Tuple[str, Optional[str]]]:
+        """The (id, document_id) of the chunks dropped as near duplicates of `canonical_id`."""
+        with self.lock:
+            return self.connection.execute("SELECT id, document_id FROM duplicates WHERE canonical_id = ?", (canonical_id,)).fetchall()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM signatures").fetchone()[0]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"checked": self.checked, "duplicates": self.duplicates, "duplicate_rate": self.duplicates / self.checked if self.checked else 0.0}
+
+def test_near_duplicate_index():
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "near_duplicates.sqlite3")
+    index = NearDuplicateIndex(path)
+    footer = "This is an official website of the State of Ohio. Check your voter registration status online before the registration deadline, and contact your county board of elections with any questions about polling locations or absentee ballots."
+    assert index.find(footer, "home") is None
+    assert index.find(footer, "home") is None, "Expected a text not to be a duplicate until it's added"
+    index.add("ohio", footer, "home")
+    assert index.find(footer.replace("website", "web site"), "home") is None, "Expected a chunk not to duplicate one of its own document"
+    assert index.find(footer.replace("website", "web site") + " Updated weekly.", "faq") == "ohio", "Expected a lightly edited copy to be caught"
+    early_voting = "Early voting in Ohio runs from October 8 to November 3, and voters may cast a ballot at the board of elections office in the county where they are registered during that period."
+    index.add("early-voting", early_voting, "home")
+    assert index.find(early_voting.replace("October 8", "October 25"), "faq") is None, "Expected a changed date not to be a duplicate"
+    assert index.find("Short text") is None
+    assert index.stats()["duplicates"] == 1 and len(index) == 2
+    index.link("ohio-2", "faq", "ohio")
+    assert index.duplicates_of("ohio") == [("ohio-2", "faq")]
+
+    reopened = NearDuplicateIndex(path)
+    assert reopened.find(footer + " Updated weekly.", "faq") == "ohio", "Expected the index to persist across runs"
+    assert reopened.duplicates_of("ohio") == [("ohio-2", "faq")]
+    print("dedup.py: All tests passed!")
+
+def benchmark_near_duplicate_index(pages: int = 300, paragraphs_per_page: int = 12, boilerplate_rate: float = 0.4):
+    """
+    A synthetic crawl where a share of each page's paragraphs is boilerplate repeated across pages
+    with small edits, counting how many chunks would still be typed and embedded.
+    """
+    import tempfile
+    rng = np.random.default_rng(0)
+    vocabulary = [f"word{i}" for i in range(5000)]
+    boilerplate = [" ".join(rng.choice(vocabulary, 60)) for _ in range(20)]
+    chunks = []
+    for page in range(pages):
+        for _ in range(paragraphs_per_page):
+            if rng.random() < boilerplate_rate:
+                words = boilerplate[rng.integers(len(boilerplate))].split()
+                words[rng.integers(len(words))] = f"page{page}"
+                chunks.append(" ".join(words))
+            else:
+                chunks.append(" ".join(rng.choice(vocabulary, 60)))
+
+    index = NearDuplicateIndex(os.path.join(tempfile.mkdtemp(), "near_duplicates.sqlite3"))
+    start = time.perf_counter()
+    kept = 0
+    for i, chunk in enumerate(chunks):
+        if index.find(chunk, document_id=str(i // paragraphs_per_page)) is None:
+            # every kept chunk is saved, and so added
+            index.add(str(i), chunk, document_id=str(i // paragraphs_per_page))
+            kept += 1
+    elapsed = time.perf_counter() - start
+    exact = len(set(chunks))
+    print(f"{len(chunks)} chunks: {exact} left after exact dedup, {kept} after near-duplicate dedup, {1000 * elapsed / len(chunks):.2f} ms/chunk")
+
+if __name__ == "__main__":
+    test_near_duplicate_index()
+    benchmark_near_duplicate_index()
@@ -2,45 +2,117 @@
 # embed a list of things
 # get cosine similarity between two things
 
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from typing import List, Tuple
+import numpy as np
 from openai import OpenAI
-from cache import LocalCache 
+import logging
+from cache import LocalCache, EmbeddingCache
 from dotenv import load_dotenv
+from ratelimit import get_rate_limiter, make_openai_client
+from utils import estimate_tokens
+import similarity
+from vectors import as_matrix, as_vector, from_base64
 
 load_dotenv()
 
-def embed(texts: List[str], model: str = "text-embedding-3-small") -> List[List[float]]:
+# The endpoint accepts up to 2048 inputs per request. We keep each request well under its token
+# limit so that a large embed() is split into several requests that can run side by side.
+MAX_BATCH_INPUTS = 2048
+MAX_BATCH_TOKENS = 64000
+
+_client = None
+_client_lock = Lock()
+_cache = None
+
+def get_client() -> OpenAI:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = make_openai_client()
+        return _client
+
+def get_embedding_cache() -> EmbeddingCache:
+    global _cache
+    with _client_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+        return _cache
+
+def batch_texts(texts: List[str], max_tokens: int = MAX_BATCH_TOKENS, max_inputs: int = MAX_BATCH_INPUTS) -> List[List[str]]:
+    """
+    Greedily packs texts, in order, into batches bounded by input count and estimated tokens.
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if batch and (len(batch) >= max_inputs or batch_tokens + tokens > max_tokens):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def embed_batch(texts: List[str], model: str) -> List[np.ndarray]:
+    tokens = sum(estimate_tokens(text) for text in texts)
+    # base64 is the raw float32 bytes: a third of the JSON payload and no float parsing
+    response = get_rate_limiter().call(model, tokens, lambda: get_client().embeddings.create(input=texts, model=model, encoding_format="base64"))
+    return [from_base64(item.embedding) if isinstance(item.embedding, str) else as_vector(item.embedding) for item in sorted(response.data, key=lambda item: item.index)]
+
+def embed(texts: List[str], model: str = "text-embedding-3-small", max_concurrency: int = 4, use_cache: bool = True) -> np.ndarray:
     """
     Get embeddings for a list of texts.
 
+    Texts already in the embedding cache are not sent again. The rest are deduplicated, packed
+    into as few requests as the endpoint allows and sent concurrently through the shared rate limiter.
+    Embeddings come back in the order of `texts`.
+
     :param texts: A list of strings for which to get embeddings.
     :param model: The model to use for generating embeddings.
-    :return: A list of embeddings, each embedding is a list of floats.
+    :param max_concurrency: The maximum number of requests in flight at once.
+    :param use_cache: Whether to read from and write to the persistent embedding cache.
+    :return: A float32 matrix with one embedding per row.
     """
-    client = OpenAI()
+    texts = [text.replace("\n", " ") for text in texts]
+    embeddings = [None] * len(texts)
+    if use_cache:
+        cache = get_embedding_cache()
+        keys = [cache.make_key(model, text) for text in texts]
+        embeddings = cache.get_many(keys)
 
-    embeddings = []
-    for text in texts:
-        text = text.replace("\n", " ")
-        response = client.embeddings.create(input=[text], model=model)
-        embeddings.append(response.data[0].embedding)
-    return embeddings
+    missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+    if missing:
+        batches = batch_texts(missing)
+        if len(batches) == 1:
+            results = [embed_batch(batches[0], model)]
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_concurrency, len(batches))) as executor:
+                results = list(executor.map(lambda batch: embed_batch(batch, model), batches))
+        fetched = dict(zip(missing, (embedding for batch_embeddings in results for embedding in batch_embeddings)))
+        embeddings = [embedding if embedding is not None else fetched[text] for text, embedding in zip(texts, embeddings)]
+        if use_cache:
+            cache.put_many([cache.make_key(model, text) for text in missing], [fetched[text] for text in missing])
+
+    if use_cache:
+        logging.debug(f"embed: {len(texts) - len(missing)}/{len(texts)} texts served from cache, cache stats {cache.stats()}")
+    return as_matrix(embeddings)
 
 def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
     """
     Calculate the cosine similarity between two vectors.
+    To compare one vector with many, see `similarity.cosine_one_vs_many` and `similarity.top_k_many`.
 
     :param vec1: The first vector.
     :param vec2: The second vector.
     :return: The cosine similarity between vec1 and vec2.
     """
-    dot_product = sum(p*q for p, q in zip(vec1, vec2))
-    magnitude_vec1 = sum(p**2 for p in vec1) ** 0.5
-    magnitude_vec2 = sum(q**2 for q in vec2) ** 0.5
-    if magnitude_vec1 == 0 or magnitude_vec2 == 0:
-        # Avoid division by zero
-        return 0.0
-    return dot_product / (magnitude_vec1 * magnitude_vec2)
+    return similarity.cosine_similarity(vec1, vec2)
 
 def test_embed():
     texts = [
@@ -49,7 +121,10 @@ def test_embed():
     ]
     embeddings = embed(texts)
     assert len(embeddings) == 2, f"Expected 2 embeddings, got {len(embeddings)}"
-    assert len(embeddings[0]) == 1536, f"Expected 1536 dimensions, got {len(embeddings[0])}"
+    assert embeddings.shape == (2, 1536) and embeddings.dtype == np.float32, f"Expected a 2x1536 float32 matrix, got {embeddings.shape} {embeddings.dtype}"
+
+    batches = batch_texts(["a" * 400] * 5, max_tokens=250)
+    assert [len(batch) for batch in batches] == [2, 2, 1], f"Expected token-bounded batches, got {[len(batch) for batch in batches]}"
 
 if __name__ == "__main__":
     test_embed()
@@ -0,0 +1,108 @@
+import heapq
+import itertools
+import time
+from collections import deque
+from typing import Any, Callable, Hashable, Optional
+
+def url_key(item) -> Hashable:
+    # queue items are (url, depth) tuples, but callers check membership with the bare url
+    return item[0] if isinstance(item, tuple) else item
+
+class Frontier:
+    """
+    Crawl frontier with O(1) membership checks and O(1)/O(log n) add and pop.
+
+    Ready items sit in a FIFO, items added with a delay sit in a heap keyed on their time to visit
+    and are moved to the FIFO once they are due. A set of keys mirrors both so `exists` never scans.
+    """
+    def __init__(self, key: Callable[[Any], Hashable] = url_key):
+        self.key = key
+        self.members = set()
+        self.ready = deque()
+        self.delayed = []
+        self.counter = itertools.count()
+
+    def add(self, item, delay: float = 0) -> bool:
+        key = self.key(item)
+        if key in self.members:
+            return False
+        self.members.add(key)
+        if delay > 0:
+            heapq.heappush(self.delayed, (time.time() + delay, next(self.counter), item))
+        else:
+            self.ready.append(item)
+        return True
+
+    def _promote(self, now: float):
+        while self.delayed and self.delayed[0][0] <= now:
+            self.ready.append(heapq.heappop(self.delayed)[2])
+
+    def pop(self):
+        if self.delayed:
+            self._promote(time.time())
+        if not self.ready:
+            return None
+        item = self.ready.popleft()
+        self.members.discard(self.key(item))
+        return item
+
+    def exists(self, item) -> bool:
+        return self.key(item) in self.members
+
+    def next_ready_in(self) -> Optional[float]:
+        """Seconds until an item can be popped, 0 if one is ready now and None if the frontier is empty."""
+        if self.ready:
+            return 0
+        if self.delayed:
+            return max(0, self.delayed[0][0] - time.time())
+        return None
+
+    def __len__(self):
+        return len(self.ready) + len(self.delayed)
+
+def test_frontier():
+    frontier = Frontier()
+    assert frontier.add(("https://a.gov", 0))
+    assert not frontier.add(("https://a.gov", 1)), "Expected duplicate url to be ignored"
+    assert frontier.add(("https://b.gov", 0), delay=60)
+    assert frontier.add(("https://c.gov", 0))
+    assert frontier.exists("https://b.gov") and frontier.exists(("https://c.gov", 3))
+    assert len(frontier) == 3, f"Expected 3 items, got {len(frontier)}"
+
+    assert frontier.pop() == ("https://a.gov", 0)
+    assert frontier.pop() == ("https://c.gov", 0)
+    assert frontier.pop() is None, "Expected delayed item to be held back"
+    assert 0 < frontier.next_ready_in() <= 60
+
+    frontier.delayed[0] = (time.time() - 1,) + frontier.delayed[0][1:]
+    assert frontier.pop() == ("https://b.gov", 0)
+    assert not frontier.exists("https://b.gov")
+    assert frontier.next_ready_in() is None and len(frontier) == 0
+    print("frontier.py: All tests passed!")
+
+def benchmark_frontier(sizes=(10**5, 10**6)):
+    for size in sizes:
+        frontier = Frontier()
+        items = [(f"https://example.gov/page/{i}", i % 4) for i in range(size)]
+
+        start = time.perf_counter()
+        for i, item in enumerate(items):
+            frontier.add(item, delay=60 if i % 10 == 0 else 0)
+        add_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for item in items:
+            frontier.exists(item[0])
+        exists_time = time.perf_counter() - start
+
+        popped = 0
+        start = time.perf_counter()
+        while frontier.pop() is not None:
+            popped += 1
+        pop_time = time.perf_counter() - start
+
+        print(f"n={size:>8}: add {add_time / size * 1e6:.2f}us, exists {exists_time / size * 1e6:.2f}us, pop {pop_time / popped * 1e6:.2f}us per item")
+
+if __name__ == "__main__":
+    test_frontier()
+    benchmark_frontier()
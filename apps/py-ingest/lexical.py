@@ -0,0 +1,336 @@
+import json
+import logging
+import os
+import re
+import time
+from array import array
+from collections import Counter
+from threading import RLock
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from similarity import top_k
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-./][a-z0-9]+)*")
+SEPARATOR_PATTERN = re.compile(r"[-./]")
+MAX_TERM_LENGTH = 32
+STOPWORDS = frozenset("a an and are as at be by can do for from has have how i if in is it my of on or that the their this to was what when where which who will with you your".split())
+
+def stem(term: str) -> str:
+    # plurals only: enough for "ballots" to match "ballot" without mangling names and numbers
+    if len(term) > 4 and term.isalpha():
+        if term.endswith("ies"):
+            return term[:-3] + "y"
+        if term.endswith("s") and not term.endswith(("ss", "us", "is")):
+            return term[:-1]
+    return term
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercased, plural-stemmed alphanumeric terms without stopwords. Compound terms like `ds-11`,
+    `16-1-102` or `u.s` are kept whole, so exact form and statute numbers match, and also split
+    into their parts.
+    """
+    tokens = []
+    for term in TOKEN_PATTERN.findall(text.lower()):
+        term = term[:MAX_TERM_LENGTH]
+        if term not in STOPWORDS:
+            tokens.append(stem(term))
+        if SEPARATOR_PATTERN.search(term):
+            tokens.extend(stem(part) for part in SEPARATOR_PATTERN.split(term) if part and part not in STOPWORDS)
+    return tokens
+
+class Segment:
+    """One immutable, memory-mapped slice of the inverted index: sorted terms and their postings."""
+    def __init__(self, path: str):
+        self.path = path
+        self.terms = np.load(f"{path}.terms.npy", mmap_mode="r")
+        self.offsets = np.load(f"{path}.offsets.npy", mmap_mode="r")
+        self.rows = np.load(f"{path}.rows.npy", mmap_mode="r")
+        self.tfs = np.load(f"{path}.tfs.npy", mmap_mode="r")
+
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        position = int(np.searchsorted(self.terms, term))
+        if position == len(self.terms) or self.terms[position] != term:
+            return None, None
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return self.rows[start:end], self.tfs[start:end]
+
+    @staticmethod
+    def write(path: str, terms: np.ndarray, offsets: np.ndarray, rows: np.ndarray, tfs: np.ndarray) -> 'Segment':
+        np.save(f"{path}.terms.npy", terms)
+        np.save(f"{path}.offsets.npy", offsets.astype(np.int64))
+        np.save(f"{path}.rows.npy", rows.astype(np.int32))
+        np.save(f"{path}.tfs.npy", tfs.astype(np.uint16))
+        return Segment(path)
+
+    def delete(self):
+        for suffix in ("terms", "offsets", "rows", "tfs"):
+            os.remove(f"{self.path}.{suffix}.npy")
+
+class LexicalIndex:
+    """
+    An incremental, on-disk BM25 index over chunk contents.
+
+    Added chunks are buffered in memory and written out as an immutable segment of sorted terms
+    and postings (int32 rows, uint16 term frequencies) every `flush_docs` chunks or on `flush`.
+    Segments are memory-mapped and merged into one once there are more than `max_segments`.
+    Adding an id again replaces its text. A search scores only the postings of the query's terms,
+    skipping terms found in more than `max_df` of the chunks (they barely move BM25 scores but cost
+    the most to score) unless the query has nothing else.
+    """
+    def __init__(self, path: str, flush_docs: int = 50000, max_segments: int = 8, k1: float = 1.2, b: float = 0.75, max_df: float = 0.5):
+        self.path = path
+        self.max_df = max_df
+        self.flush_docs = flush_docs
+        self.max_segments = max_segments
+        self.k1 = k1
+        self.b = b
+        self.lock = RLock()
+        os.makedirs(path, exist_ok=True)
+
+        meta = {"count": 0, "segments": [], "next_segment": 0}
+        if os.path.exists(self._file("meta.json")):
+            with open(self._file("meta.json")) as file:
+                meta = json.load(file)
+        self.next_segment = meta["next_segment"]
+        self.segments = [Segment(self._file(name)) for name in meta["segments"]]
+
+        # rows past the last completed flush belong to a flush that never finished
+        count = meta["count"]
+        self.ids: List[str] = []
+        if os.path.exists(self._file("ids.txt")):
+            with open(self._file("ids.txt")) as file:
+                self.ids = file.read().splitlines()[:count]
+        self.lengths = np.fromfile(self._file("lengths.bin"), dtype=np.uint32, count=count) if count else np.empty(0, dtype=np.uint32)
+        self._truncate(count)
+
+        self.rows: Dict[str, int] = {}
+        self.live = np.ones(count, dtype=bool)
+        for row, id in enumerate(self.ids):
+            if not id:
+                # written in place of a row that was replaced while still buffered
+                self.live[row] = False
+                continue
+            replaced = self.rows.get(id)
+            if replaced is not None:
+                self.live[replaced] = False
+            self.rows[id] = row
+
+        self.buffer_ids: List[str] = []
+        self.buffer_lengths = array("I")
+        self.buffer: Dict[str, Tuple[array, array]] = {}
+        self._stats = None
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _truncate(self, count: int):
+        with open(self._file("ids.txt"), "a") as file:
+            file.truncate(sum(len(id) + 1 for id in self.ids))
+        with open(self._file("lengths.bin"), "ab") as file:
+            file.truncate(count * 4)
+
+    def _write_meta(self):
+        meta = {"count": len(self.ids), "segments": [os.path.basename(segment.path) for segment in self.segments], "next_segment": self.next_segment}
+        with open(self._file("meta.json.tmp"), "w") as file:
+            json.dump(meta, file)
+        os.replace(self._file("meta.json.tmp"), self._file("meta.json"))
+
+    def __len__(self):
+        return int(self.live.sum()) + len(self.buffer_ids)
+
+    def add(self, ids: Sequence[str], texts: Sequence[str]) -> None:
+        tokenized = [Counter(tokenize(text)) for text in texts]
+        with self.lock:
+            self._stats = None
+            for id, counts in zip(ids, tokenized):
+                row = len(self.ids) + len(self.buffer_ids)
+                replaced = self.rows.get(id)
+                if replaced is not None and replaced < len(self.live):
+                    self.live[replaced] = False
+                elif replaced is not None:
+                    self.buffer_ids[replaced - len(self.ids)] = None
+                self.rows[id] = row
+                self.buffer_ids.append(id)
+                self.buffer_lengths.append(sum(counts.values()))
+                for term, tf in counts.items():
+                    postings = self.buffer.get(term)
+                    if postings is None:
+                        postings = self.buffer[term] = (array("i"), array("H"))
+                    postings[0].append(row)
+                    postings[1].append(min(tf, 65535))
+            if len(self.buffer_ids) >= self.flush_docs:
+                self.flush()
+
+    def flush(self) -> None:
+        """Writes the buffered chunks out as a new segment."""
+        with self.lock:
+            if not self.buffer_ids:
+                return
+            terms = sorted(self.buffer)
+            counts = np.array([len(self.buffer[term][0]) for term in terms], dtype=np.int64)
+            offsets = np.concatenate([[0], np.cumsum(counts)])
+            rows = np.frombuffer(b"".join(self.buffer[term][0].tobytes() for term in terms), dtype=np.int32)
+            tfs = np.frombuffer(b"".join(self.buffer[term][1].tobytes() for term in terms), dtype=np.uint16)
+            name = f"segment-{self.next_segment:05d}"
+            self.next_segment += 1
+            segment = Segment.write(self._file(name), np.array(terms, dtype=f"<U{MAX_TERM_LENGTH}"), offsets, rows, tfs)
+
+            # a replaced row keeps its postings until the next merge, it's just never returned
+            buffer_live = np.array([id is not None for id in self.buffer_ids], dtype=bool)
+            buffer_ids = [id if id is not None else "" for id in self.buffer_ids]
+            with open(self._file("ids.txt"), "a") as file:
+                file.write("".join(f"{id}\n" for id in buffer_ids))
+            with open(self._file("lengths.bin"), "ab") as file:
+                file.write(self.buffer_lengths.tobytes())
+            self.ids.extend(buffer_ids)
+            self.lengths = np.concatenate([self.lengths, np.frombuffer(self.buffer_lengths.tobytes(), dtype=np.uint32)])
+            self.live = np.concatenate([self.live, buffer_live])
+            self.segments.append(segment)
+            self.buffer_ids, self.buffer_lengths, self.buffer = [], array("I"), {}
+            self._stats = None
+            self._write_meta()
+            if len(self.segments) > self.max_segments:
+                self.merge()
+
+    def merge(self) -> None:
+        """Merges every segment into one."""
+        with self.lock:
+            if len(self.segments) < 2:
+                return
+            start = time.perf_counter()
+            terms = np.unique(np.concatenate([np.asarray(segment.terms) for segment in self.segments]))
+            term_ids, rows, tfs = [], [], []
+            for segment in self.segments:
+                mapped = np.searchsorted(terms, segment.terms)
+                term_ids.append(np.repeat(mapped, np.diff(segment.offsets)))
+                rows.append(np.asarray(segment.rows))
+                tfs.append(np.asarray(segment.tfs))
+            term_ids, rows, tfs = np.concatenate(term_ids), np.concatenate(rows), np.concatenate(tfs)
+            # segments cover increasing rows, so a stable sort by term keeps each posting list in row order
+            order = np.argsort(term_ids, kind="stable")
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(term_ids, minlength=len(terms)))])
+            name = f"segment-{self.next_segment:05d}"
+            self.next_segment += 1
+            merged = Segment.write(self._file(name), terms, offsets, rows[order], tfs[order])
+            old_segments, self.segments = self.segments, [merged]
+            self._write_meta()
+            for segment in old_segments:
+                segment.delete()
+            logging.info(f"LexicalIndex: Merged {len(old_segments)} segments ({len(rows)} postings) in {time.perf_counter() - start:.1f}s")
+
+    def _postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        rows, tfs = [], []
+        for segment in self.segments:
+            segment_rows, segment_tfs = segment.postings(term)
+            if segment_rows is not None:
+                rows.append(segment_rows)
+                tfs.append(segment_tfs)
+        if term in self.buffer:
+            rows.append(np.frombuffer(self.buffer[term][0], dtype=np.int32))
+            tfs.append(np.frombuffer(self.buffer[term][1], dtype=np.uint16))
+        if not rows:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.uint16)
+        return np.concatenate(rows), np.concatenate(tfs)
+
+    def _id(self, row: int) -> str:
+        return self.ids[row] if row < len(self.ids) else self.buffer_ids[row - len(self.ids)]
+
+    def stats(self) -> Tuple[np.ndarray, np.ndarray, float]:
+        """Every row's length and liveness, and the average live length, cached between writes."""
+        if self._stats is None:
+            lengths = np.concatenate([self.lengths, np.frombuffer(self.buffer_lengths, dtype=np.uint32)]).astype(np.float32)
+            live = np.concatenate([self.live, np.array([id is not None for id in self.buffer_ids], dtype=bool)])
+            average_length = max(1.0, float(lengths[live].mean())) if live.any() else 1.0
+            self._stats = (lengths, live, average_length)
+        return self._stats
+
+    def search(self, query: str, k: int = 20, ids: Optional[Sequence[str]] = None) -> List[Tuple[str, float]]:
+        """The `k` best BM25 matches for `query`, best first. `ids` restricts the candidates."""
+        terms = list(dict.fromkeys(tokenize(query)))
+        with self.lock:
+            if not terms or not len(self):
+                return []
+            lengths, live, average_length = self.stats()
+            count = len(self)
+
+            postings = [self._postings(term) for term in terms]
+            postings = [(rows, tfs) for rows, tfs in postings if len(rows)]
+            selective = [(rows, tfs) for rows, tfs in postings if len(rows) <= self.max_df * count]
+            matched_rows, matched_scores = [], []
+            for rows, tfs in selective or postings:
+                idf = np.log(1 + (count - len(rows) + 0.5) / (len(rows) + 0.5))
+                tfs = tfs.astype(np.float32)
+                norms = self.k1 * (1 - self.b + self.b * lengths[rows] / average_length)
+                matched_rows.append(rows)
+                matched_scores.append(idf * tfs * (self.k1 + 1) / (tfs + norms))
+            if not matched_rows:
+                return []
+            if len(matched_rows) == 1:
+                # a row appears at most once per posting list
+                candidates, scores = matched_rows[0], matched_scores[0]
+            elif sum(len(rows) for rows in matched_rows) > len(lengths) // 16:
+                # long posting lists: summing into one dense array beats sorting them
+                scores = np.zeros(len(lengths), dtype=np.float32)
+                for rows, row_scores in zip(matched_rows, matched_scores):
+                    scores[rows] += row_scores
+                candidates = np.flatnonzero(scores)
+                scores = scores[candidates]
+            else:
+                candidates, inverse = np.unique(np.concatenate(matched_rows), return_inverse=True)
+                scores = np.bincount(inverse, weights=np.concatenate(matched_scores)).astype(np.float32)
+
+            allowed = live[candidates]
+            if ids is not None:
+                wanted = np.array(sorted(self.rows[id] for id in set(ids) if id in self.rows), dtype=np.int64)
+                allowed &= np.isin(candidates, wanted)
+            candidates, scores = candidates[allowed], scores[allowed]
+            return [(self._id(candidates[i]), float(scores[i])) for i in top_k(scores, k)]
+
+def test_lexical_index():
+    import tempfile
+    path = tempfile.mkdtemp()
+    assert tokenize("Bring form DS-11 by Oct. 5") == ["bring", "form", "ds-11", "ds", "11", "oct", "5"]
+    assert tokenize("Ballots, counties and status") == ["ballot", "county", "status"]
+
+    index = LexicalIndex(path, flush_docs=2, max_segments=2)
+    index.add(["a", "b", "c"], ["Register to vote by mail", "Polling places open at 7am", "Mail ballots must arrive by election day"])
+    index.add(["d", "e"], ["Form DS-11 deadline", "Early voting by mail"])
+    assert [id for id, _ in index.search("mail ballot")][:1] == ["c"]
+    assert [id for id, _ in index.search("ds-11")] == ["d"], "Expected compound terms to match exactly"
+
+    # replacing a chunk's text, and everything, buffered or not, surviving a reload
+    index.add(["a"], ["Polling places close at 8pm"])
+    index.flush()
+    reloaded = LexicalIndex(path)
+    assert len(reloaded) == 5 and len(reloaded.segments) <= 2
+    assert "a" not in [id for id, _ in reloaded.search("register")]
+    assert [id for id, _ in reloaded.search("polling places", ids=["a", "d"])] == ["a"]
+    print("lexical.py: All tests passed!")
+
+def benchmark_lexical_index(count: int = 1000000, vocabulary: int = 50000, words_per_chunk: int = 60, queries: int = 200):
+    """Build time and query latency at `count` chunks of Zipf-distributed terms."""
+    import tempfile
+    rng = np.random.default_rng(0)
+    words = np.array([f"w{i}" for i in range(vocabulary)])
+    index = LexicalIndex(tempfile.mkdtemp(), flush_docs=100000)
+    start = time.perf_counter()
+    for block in range(0, count, 10000):
+        draws = np.minimum(rng.zipf(1.2, (10000, words_per_chunk)), vocabulary) - 1
+        index.add([str(i) for i in range(block, block + 10000)], [" ".join(words[row]) for row in draws])
+    index.flush()
+    build = time.perf_counter() - start
+
+    for query_words in (1, 3, 8):
+        texts = [" ".join(words[np.minimum(rng.zipf(1.2, query_words), 2000) - 1]) for _ in range(queries)]
+        start = time.perf_counter()
+        for text in texts:
+            index.search(text, k=20)
+        latency = (time.perf_counter() - start) / queries * 1000
+        print(f"{count} chunks, {query_words} term queries: {latency:6.2f}ms/query (built in {build:.0f}s, {len(index.segments)} segments)")
+
+if __name__ == "__main__":
+    test_lexical_index()
+    benchmark_lexical_index()
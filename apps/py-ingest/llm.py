@@ -1,18 +1,37 @@
 # GPT completion, can use 3.5 or 4
 
 from abc import ABC, abstractmethod
+import json
+import logging
 import os
+from concurrent.futures import Future
+from threading import Lock
 import openai
 import instructor
 from openai import OpenAI
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from cache import LocalCache
+from cache import LocalCache, LLMCache
+from ratelimit import get_rate_limiter, make_openai_client
+from utils import estimate_tokens
 
 load_dotenv()
 
 # Enables `response_model`
 
+_cache = None
+_cache_lock = Lock()
+# requests currently being answered, so identical concurrent prompts share one API call
+_in_flight = {}
+_in_flight_lock = Lock()
+
+def get_llm_cache() -> LLMCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMCache()
+        return _cache
+
 class AbstractLLM(ABC):
     @abstractmethod
     def generate(self, prompt: str):
@@ -20,20 +39,79 @@ class AbstractLLM(ABC):
 
 
 class GPT(AbstractLLM):
-    def __init__(self, version: str, system_prompt: str = None):
+    def __init__(self, version: str, system_prompt: str = None, use_cache: bool = True):
         openai = OpenAI()
-        client = instructor.patch(OpenAI())
+        client = instructor.patch(make_openai_client())
         self.client = client
 
         self.model_version = "gpt-3.5-turbo" if version == "3.5" else "gpt-4-0125-preview"
         self.system_prompt = system_prompt
+        self.use_cache = use_cache
 
     def generate(self, prompt: str, response_model: BaseModel = None, functions: list = [], temperature: float = 0, max_tokens: int = 64, top_p: float = 1):
+        """
+        Deterministic requests (temperature 0, no functions) are answered from the LLM cache when the
+        same request was seen before, and concurrent identical requests wait on a single API call.
+        """
+        if not self.use_cache or temperature != 0 or functions:
+            return self.complete(prompt, response_model, functions, temperature, max_tokens, top_p)
+
+        cache = get_llm_cache()
+        key = cache.make_key(
+            model=self.model_version,
+            system_prompt=self.system_prompt,
+            prompt=prompt,
+            response_model=response_model.model_json_schema() if response_model else None,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p,
+        )
+        cached = cache.get(key)
+        if cached is not None:
+            return self.load_response(cached, response_model)
+
+        with _in_flight_lock:
+            future = _in_flight.get(key)
+            if future is None:
+                # the owner of an earlier call may have saved its response and left between our
+                # cache lookup and taking the lock
+                cached = cache.get(key, recheck=True)
+                if cached is not None:
+                    return self.load_response(cached, response_model)
+            is_owner = future is None
+            if is_owner:
+                future = _in_flight[key] = Future()
+        if not is_owner:
+            cache.record_coalesced()
+            return self.load_response(future.result(), response_model)
+
+        try:
+            response = self.complete(prompt, response_model, functions, temperature, max_tokens, top_p)
+            dumped = response.model_dump_json() if response_model else json.dumps(response)
+            cache.save(key, dumped)
+            future.set_result(dumped)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with _in_flight_lock:
+                _in_flight.pop(key, None)
+        logging.debug(f"GPT: LLM cache stats {cache.stats()}")
+        return response
+
+    def load_response(self, dumped: str, response_model: BaseModel = None):
+        if response_model:
+            return response_model.model_validate_json(dumped)
+        return json.loads(dumped)
+
+    def complete(self, prompt: str, response_model: BaseModel = None, functions: list = [], temperature: float = 0, max_tokens: int = 64, top_p: float = 1):
         messages = [{"role": "user", "content": prompt}]
         if self.system_prompt:
             messages.insert(0, {"role": "system", "content": self.system_prompt})
-        
-        response = self.client.chat.completions.create(
+
+        # completions count against the token budget by their max_tokens, not what they end up using
+        tokens = sum(estimate_tokens(message["content"]) for message in messages) + max_tokens
+        response = get_rate_limiter().call(self.model_version, tokens, lambda: self.client.chat.completions.create(
             model=self.model_version,
             messages=messages,
             functions=functions,
@@ -41,8 +119,8 @@ class GPT(AbstractLLM):
             temperature=temperature,
             max_tokens=max_tokens,
             top_p=top_p
-        )
+        ))
 
         if (response_model):
             return response
-        return response.choices[0].message['content']
+        return response.choices[0].message.content
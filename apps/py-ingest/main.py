@@ -4,6 +4,11 @@ import argparse
 # Setting up CLI argument parsing for logging level
 parser = argparse.ArgumentParser(description='Ingestion Engine Logging Level')
 parser.add_argument('--log', dest='log_level', default='INFO', help='Set the logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)')
+parser.add_argument('--state-dir', dest='state_dir', default=None, help='Persist each crawl\'s frontier and visited set under this directory so an interrupted run resumes where it stopped. Delete the directory to start over.')
+parser.add_argument('--full-refresh', dest='full_refresh', action='store_true', help='Process every page again, even ones that are unchanged since they were last saved.')
+parser.add_argument('--parse-processes', dest='parse_processes', type=int, default=0, help='Parse pages in this many worker processes instead of on the crawler\'s threads, so parsing isn\'t held to one core by the GIL.')
+parser.add_argument('--batch-typing', dest='batch_typing', action='store_true', help='Classify many chunks per LLM call instead of one call per chunk, see classify.BatchChunkClassifier.')
+parser.add_argument('--index-dir', dest='index_dir', default=None, help='Add every saved chunk to the local vector and keyword indexes in this directory, see retrieve.HybridRetriever.')
 args = parser.parse_args()
 
 # Configuring logging based on the CLI argument
@@ -13,39 +18,153 @@ if not isinstance(numeric_level, int):
 logging.basicConfig(level=numeric_level, handlers=[logging.StreamHandler()], format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
 from abc import ABC, abstractmethod
+from cache import PageState, PageStateCache
 from children import extract_links
-from db import AbstractDatabase, PrismaDatabase
+from db import AbstractDatabase, IndexedDatabase, PrismaDatabase, WriteBehindDatabase
 import requests
-from bs4 import BeautifulSoup
+import asyncio
+import aiohttp
 import time
+import os
+import multiprocessing
+import sqlite3
 from datetime import datetime, timedelta
 import re
 from relevance import AbstractRelevanceChecker, SimpleRelevanceChecker, LLMRelevanceChecker
-from clean import AbstractDataCleaner, LLMDataCleaner
-from schema import Chunk 
-from typing import List 
+from clean import AbstractDataCleaner, EmbedError, LLMDataCleaner
+from frontier import Frontier, url_key
+from parse import ParsedPage, parse_html, parse_page
+from pipeline import Stage
+from vector_index import VectorIndex
+from lexical import LexicalIndex
+from embed import embed
+from politeness import HostScheduler, fetch_crawl_delay, get_host, get_scheme, parse_retry_after
+from schema import Chunk, ChunkBatch
+from typing import Dict, List, Optional, Tuple
+from utils import get_chunk_id
+from threading import Condition, Lock, Thread, current_thread
+
+class FetchError(Exception):
+    """Raised by extractors when a page can't be fetched. `status` is None for network errors."""
+    def __init__(self, url: str, status: int = None, retry_after: float = None):
+        self.url = url
+        self.status = status
+        self.retry_after = retry_after
+        super().__init__(f"{url} returned status {status}" if status else f"{url} could not be reached")
+
+class NotModified(FetchError):
+    """Raised on a 304 to a conditional request: the page hasn't changed since `state` was saved."""
+    def __init__(self, url: str, state: PageState):
+        self.state = state
+        super().__init__(url, 304)
+
+def get_validators(headers) -> Dict[str, Optional[str]]:
+    return {"etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")}
 
 class AbstractDataExtractor(ABC):
     @abstractmethod
-    def extract(self, url: str) -> BeautifulSoup:
+    def extract(self, url: str) -> ParsedPage:
         pass
 
     def get_html(self, url: str) -> bytes:
-        response = requests.get(url)
+        return self.get_html_if_modified(url)[0]
+
+    def get_html_if_modified(self, url: str, state: Optional[PageState] = None) -> Tuple[bytes, Dict[str, Optional[str]], Optional[str]]:
+        """
+        Fetches a page along with its ETag and Last-Modified validators and its Content-Type. With the
+        `state` saved the last time the page was processed the request is conditional, and
+        `NotModified` is raised if the server says the page hasn't changed.
+        """
+        try:
+            response = requests.get(url, timeout=30, headers=state.request_headers() if state else None)
+        except requests.RequestException as e:
+            raise FetchError(url) from e
         if response.status_code == 200:
-            return response.content
-        else:
-            return None
+            return response.content, get_validators(response.headers), response.headers.get("Content-Type")
+        if response.status_code == 304 and state:
+            raise NotModified(url, state)
+        raise FetchError(url, response.status_code, parse_retry_after(response.headers.get("Retry-After")))
     
-    def parse_html(self, html: bytes) -> BeautifulSoup:
-        return BeautifulSoup(html, 'html.parser')
+    def parse_html(self, html: bytes, content_type: Optional[str] = None) -> ParsedPage:
+        # one lxml pass for text, title, meta and links, see parse.ParsedPage
+        return parse_html(html, content_type=content_type)
 
 class SimpleDataExtractor(AbstractDataExtractor):
-    def extract(self, url: str) -> BeautifulSoup:
-        html = self.get_html(url)
+    def extract(self, url: str) -> ParsedPage:
+        html, _, content_type = self.get_html_if_modified(url)
+        if not html:
+            logging.error(f"IngestionEngine: Failed to get html from {url}")
+        return self.parse_html(html, content_type)
+
+class AsyncDataExtractor(AbstractDataExtractor):
+    """
+    Fetches pages through one shared aiohttp session running on a background event loop.
+
+    Connections are pooled and kept alive across the whole crawl, with a cap on total and per-host
+    connections and on the number of fetches in flight. `get_html` stays blocking so the extractor
+    can be dropped into `IngestionEngine`'s worker threads unchanged.
+    """
+    def __init__(self, max_in_flight: int = 32, limit_per_host: int = 4, timeout: float = 30, connect_timeout: float = 10, headers: dict = None):
+        self.max_in_flight = max_in_flight
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.headers = headers or {"User-Agent": "letsvote-ingest/1.0"}
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, name="AsyncDataExtractor", daemon=True)
+        self.thread.start()
+        self.session = self._run(self._create_session())
+
+    async def _create_session(self) -> aiohttp.ClientSession:
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight, limit_per_host=self.limit_per_host, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=self.timeout, connect=self.connect_timeout)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.headers)
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def fetch(self, url: str) -> bytes:
+        return (await self.fetch_if_modified(url))[0]
+
+    async def fetch_if_modified(self, url: str, state: Optional[PageState] = None) -> Tuple[bytes, Dict[str, Optional[str]], Optional[str]]:
+        async with self.semaphore:
+            try:
+                async with self.session.get(url, headers=state.request_headers() if state else None) as response:
+                    if response.status == 200:
+                        return await response.read(), get_validators(response.headers), response.headers.get("Content-Type")
+                    if response.status == 304 and state:
+                        raise NotModified(url, state)
+                    raise FetchError(url, response.status, parse_retry_after(response.headers.get("Retry-After")))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise FetchError(url) from e
+
+    async def fetch_many(self, urls: List[str]) -> list:
+        # failed fetches come back as their FetchError instead of failing the whole batch
+        return await asyncio.gather(*(self.fetch(url) for url in urls), return_exceptions=True)
+
+    def get_html(self, url: str) -> bytes:
+        return self._run(self.fetch(url))
+
+    def get_html_if_modified(self, url: str, state: Optional[PageState] = None) -> Tuple[bytes, Dict[str, Optional[str]], Optional[str]]:
+        return self._run(self.fetch_if_modified(url, state))
+
+    def get_many_html(self, urls: List[str]) -> list:
+        return self._run(self.fetch_many(urls))
+
+    def extract(self, url: str) -> ParsedPage:
+        html, _, content_type = self.get_html_if_modified(url)
         if not html:
             logging.error(f"IngestionEngine: Failed to get html from {url}")
-        return self.parse_html(html)
+        return self.parse_html(html, content_type)
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        self._run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
 
 class AbstractQueueManager(ABC):
     @abstractmethod
@@ -60,82 +179,372 @@ class AbstractQueueManager(ABC):
     def exists(self, item):
         pass
 
+    def mark_visited(self, url: str):
+        pass
+
+    def get_visited(self) -> List[str]:
+        return []
+
+    def release(self, item, status: int = None, retry_after: float = None, failed: bool = False) -> bool:
+        # called once a popped item is finished; returns True if the queue took it back for a retry
+        return False
+
+    def next_ready_in(self) -> Optional[float]:
+        # seconds until pop can return something, None if nothing is queued
+        return None
+
 class SimpleQueueManager(AbstractQueueManager):
     def __init__(self):
-        self.queue = []
-        self.time_to_visit = {}
+        self.queue = Frontier()
 
     def add(self, items: list, delay=0):
         for item in items:
-            if delay > 0:
-                self.time_to_visit[item] = datetime.now() + timedelta(seconds=delay)
-            if item not in self.queue:
-                self.queue.append(item)
+            self.queue.add(item, delay)
 
     def pop(self):
-        if not self.queue:
-            return None
-        current_time = datetime.now()
-        for i, url in enumerate(self.queue):
-            if url in self.time_to_visit and self.time_to_visit[url] > current_time:
-                continue
-            return self.queue.pop(i)
-        return None
+        return self.queue.pop()
 
     def exists(self, item):
-        return item in self.queue
+        return self.queue.exists(item)
+
+    def next_ready_in(self):
+        return self.queue.next_ready_in()
     
     def __len__(self):
         return len(self.queue)
 
-from threading import Lock, current_thread
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 class ThreadedQueueManager(AbstractQueueManager):
     def __init__(self):
-        self.queue = []
-        self.time_to_visit = {}
+        self.queue = Frontier()
         self.lock = Lock()
 
     def add(self, items: list, delay=0):
         with self.lock:
             for item in items:
-                if delay > 0:
-                    self.time_to_visit[item] = datetime.now() + timedelta(seconds=delay)
-                if item not in self.queue:
-                    self.queue.append(item)
+                self.queue.add(item, delay)
 
     def pop(self):
         with self.lock:
-            if not self.queue:
-                return None
-            current_time = datetime.now()
-            for i, url in enumerate(self.queue):
-                if url in self.time_to_visit and self.time_to_visit[url] > current_time:
-                    continue
-                return self.queue.pop(i)
-            return None
+            return self.queue.pop()
+
+    def exists(self, item):
+        with self.lock:
+            return self.queue.exists(item)
+
+    def next_ready_in(self):
+        with self.lock:
+            return self.queue.next_ready_in()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.queue)
+
+class PoliteQueueManager(AbstractQueueManager):
+    """
+    Thread-safe queue manager that schedules urls per host with `HostScheduler`, so no single host
+    gets hammered by every worker while other hosts sit idle. Each host's robots.txt crawl-delay is
+    looked up the first time the host is seen.
+
+    With a `store`, the frontier and visited set are also persisted there so the crawl can be
+    resumed: whatever the store still has queued is scheduled on start, and every add, pop, retry
+    and visit is written through to it. The scheduler still decides what is popped when.
+    """
+    def __init__(self, min_delay: float = 0.25, max_concurrency_per_host: int = 4, max_backoff: float = 300, max_retries: int = 3, respect_robots: bool = True, store: Optional['SqliteQueueManager'] = None):
+        self.scheduler = HostScheduler(min_delay=min_delay, max_concurrency=max_concurrency_per_host, max_backoff=max_backoff, max_retries=max_retries)
+        self.respect_robots = respect_robots
+        self.lock = Lock()
+        self.store = store
+        if store is not None:
+            for url, depth, delay in store.pending():
+                self.schedule([(url, depth)], delay)
+
+    def add(self, items: list, delay=0):
+        if self.store is not None:
+            # only what the store didn't already have queued or visited
+            items = self.store.add(items, delay)
+        self.schedule(items, delay)
+
+    def schedule(self, items: list, delay=0):
+        if self.respect_robots:
+            with self.lock:
+                # robots.txt is fetched with the scheme of the host's first url
+                new_hosts = {}
+                for item in items:
+                    if not self.scheduler.knows_host(get_host(item)):
+                        new_hosts.setdefault(get_host(item), get_scheme(item))
+            # robots.txt is fetched outside the lock so other workers aren't blocked on it
+            crawl_delays = {host: fetch_crawl_delay(host, scheme) for host, scheme in new_hosts.items()}
+        else:
+            crawl_delays = {}
+        with self.lock:
+            for host, crawl_delay in crawl_delays.items():
+                if crawl_delay:
+                    logging.info(f"PoliteQueueManager: Using crawl-delay of {crawl_delay}s for {host}")
+                self.scheduler.set_crawl_delay(host, crawl_delay)
+            for item in items:
+                self.scheduler.add(item, delay)
+
+    def pop(self):
+        with self.lock:
+            item = self.scheduler.pop()
+        if item is not None and self.store is not None:
+            self.store.start(item)
+        return item
 
     def exists(self, item):
         with self.lock:
-            return item in self.queue
+            return self.scheduler.exists(item)
+
+    def release(self, item, status: int = None, retry_after: float = None, failed: bool = False) -> bool:
+        with self.lock:
+            requeued = self.scheduler.release(item, status, retry_after, failed)
+        if requeued and self.store is not None:
+            self.store.requeue(item)
+        return requeued
+
+    def mark_visited(self, url: str):
+        if self.store is not None:
+            self.store.mark_visited(url)
+
+    def get_visited(self) -> List[str]:
+        return self.store.get_visited() if self.store is not None else []
+
+    def next_ready_in(self):
+        with self.lock:
+            return self.scheduler.next_ready_in()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.scheduler)
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+class SqliteQueueManager(AbstractQueueManager):
+    """
+    Frontier and visited set persisted to a SQLite database in WAL mode, so a crawl can be resumed.
+
+    Popped items stay in the frontier marked as in progress until `mark_visited` is called for them;
+    anything still in progress when the process died is put back in the frontier on the next start.
+    """
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS frontier (url TEXT PRIMARY KEY, depth INTEGER NOT NULL, time_to_visit REAL NOT NULL, in_progress INTEGER NOT NULL DEFAULT 0)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS frontier_ready ON frontier (in_progress, time_to_visit)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS visited (url TEXT PRIMARY KEY)")
+        resumed = self.connection.execute("UPDATE frontier SET in_progress = 0 WHERE in_progress = 1").rowcount
+        if resumed:
+            logging.info(f"SqliteQueueManager: Re-queued {resumed} urls that were in progress when {path} was last used")
+
+    def add(self, items: list, delay=0) -> list:
+        """Queues the items that aren't queued or visited yet, returning those."""
+        time_to_visit = time.time() + delay
+        rows = [(item, 0) if isinstance(item, str) else item for item in items]
+        added = []
+        with self.lock:
+            with self.connection:
+                self.connection.execute("BEGIN")
+                for url, depth in rows:
+                    if self.connection.execute(
+                        "INSERT OR IGNORE INTO frontier (url, depth, time_to_visit) SELECT ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM visited WHERE url = ?)",
+                        (url, depth, time_to_visit, url)).rowcount:
+                        added.append((url, depth))
+        return added
+
+    def pop(self):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("BEGIN")
+                row = self.connection.execute("SELECT url, depth FROM frontier WHERE in_progress = 0 AND time_to_visit <= ? ORDER BY time_to_visit LIMIT 1", (time.time(),)).fetchone()
+                if row is None:
+                    return None
+                self.connection.execute("UPDATE frontier SET in_progress = 1 WHERE url = ?", (row[0],))
+                return (row[0], row[1])
+
+    def pending(self) -> List[Tuple[str, int, float]]:
+        """(url, depth, seconds until it is due) of everything queued and not in progress."""
+        now = time.time()
+        with self.lock:
+            return [(url, depth, max(0, time_to_visit - now)) for url, depth, time_to_visit in self.connection.execute("SELECT url, depth, time_to_visit FROM frontier WHERE in_progress = 0 ORDER BY time_to_visit")]
+
+    def start(self, item):
+        # for a scheduler popping from its own copy of the frontier, see `PoliteQueueManager`
+        with self.lock:
+            self.connection.execute("UPDATE frontier SET in_progress = 1 WHERE url = ?", (url_key(item),))
+
+    def requeue(self, item):
+        with self.lock:
+            self.connection.execute("UPDATE frontier SET in_progress = 0 WHERE url = ?", (url_key(item),))
+
+    def exists(self, item):
+        url = item[0] if isinstance(item, tuple) else item
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM frontier WHERE url = ? AND in_progress = 0", (url,)).fetchone() is not None
+
+    def mark_visited(self, url: str):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.execute("INSERT OR IGNORE INTO visited (url) VALUES (?)", (url,))
+                self.connection.execute("DELETE FROM frontier WHERE url = ?", (url,))
+
+    def get_visited(self) -> List[str]:
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT url FROM visited")]
+
+    def next_ready_in(self):
+        with self.lock:
+            time_to_visit = self.connection.execute("SELECT MIN(time_to_visit) FROM frontier WHERE in_progress = 0").fetchone()[0]
+        return None if time_to_visit is None else max(0, time_to_visit - time.time())
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM frontier WHERE in_progress = 0").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class PageWork:
+    """A page moving through an engine, carrying whatever the earlier steps (or pipeline stages) produced."""
+    __slots__ = ("url", "depth", "released", "page_state", "validators", "content_type", "html", "raw_data", "clean_text", "content_hash", "links", "document", "chunk_contents", "chunk_surrounding_contents", "chunk_extra_info", "chunks")
+
+    def __init__(self, url: str, depth: int):
+        self.url = url
+        self.depth = depth
+        self.released = False
+        self.page_state = None
+        self.validators = {}
+        self.content_type = None
+        self.html = None
+        self.raw_data = None
+        self.clean_text = None
+        self.content_hash = None
+        self.links = []
+        self.document = None
+        self.chunk_contents = []
+        self.chunk_surrounding_contents = []
+        self.chunk_extra_info = []
+        self.chunks = ChunkBatch()
 
 class IngestionEngine:
-    def __init__(self, meta_topics: List[str], extractor: AbstractDataExtractor, cleaner: AbstractDataCleaner, relevance_checker: AbstractRelevanceChecker, db: AbstractDatabase, queue: AbstractQueueManager, num_threads: int = 1):
+    def __init__(self, meta_topics: List[str], extractor: AbstractDataExtractor, cleaner: AbstractDataCleaner, relevance_checker: AbstractRelevanceChecker, db: AbstractDatabase, queue: AbstractQueueManager, num_threads: int = 1, max_in_flight: int = None, page_states: Optional[PageStateCache] = None, parse_processes: int = 0):
         self.meta_topics = meta_topics
         self.extractor = extractor
         self.cleaner = cleaner
         self.relevance_checker = relevance_checker
         self.db = db
         self.queue = queue
-        self.visited_urls = {}
+        # when set, pages unchanged since they were last saved only have their links followed
+        self.page_states = page_states
+        # when set, pages are parsed in a pool of this many processes, see `parse`
+        self.parse_processes = parse_processes
+        self.parse_pool = None
+        self.visited_urls = {url: True for url in queue.get_visited()}
         self.num_threads = num_threads
+        # a few more tasks than threads so a worker never idles waiting for the run loop
+        self.max_in_flight = max_in_flight or num_threads * 2
+        self.in_flight = set()
         self.lock = Lock()
+        # signalled whenever a task finishes or urls are enqueued, so the run loop never polls
+        self.work_available = Condition()
 
     def normalize_url(self, url: str) -> str:
         return url.strip("/").strip()
 
+    def start_parse_pool(self):
+        if self.parse_processes:
+            # spawn rather than fork, since the crawl already has an event loop and worker threads running
+            self.parse_pool = ProcessPoolExecutor(self.parse_processes, mp_context=multiprocessing.get_context("spawn"))
+
+    def stop_parse_pool(self):
+        if self.parse_pool:
+            self.parse_pool.shutdown()
+            self.parse_pool = None
+
+    def parse(self, current_url: str, html: bytes, content_type: Optional[str] = None) -> ParsedPage:
+        """
+        Parses a fetched page. With `parse_processes` the raw bytes go to a worker process, which
+        sends back the `ParsedPage` with its links already resolved, so the CPU work of many pages
+        runs in parallel instead of sharing this process's GIL. Without it the extractor parses the
+        page on the calling thread.
+        """
+        if self.parse_pool:
+            return self.parse_pool.submit(parse_page, current_url, html, content_type=content_type).result()
+        return self.extractor.parse_html(html, content_type)
+
     def process_url(self, current_url: str, depth: int = 0, start_at_depth: int = 0, max_depth=10000):
+        try:
+            saved = self._process_url(current_url, depth, start_at_depth, max_depth)
+            # a saved page is marked visited once its rows are written, see `pages_saved`
+            self.finish_url(current_url, depth, visited=not saved)
+        except FetchError as e:
+            logging.warning(f"IngestionEngine: Could not fetch {current_url}: {e}")
+            self.finish_url(current_url, depth, e.status, e.retry_after, failed=True)
+        except EmbedError as e:
+            # nothing was saved: the page stays unvisited, so a resumed crawl processes it again
+            logging.error(f"IngestionEngine: Failed to embed {current_url} due to {e}.")
+            self.finish_url(current_url, depth, failed=True, visited=False)
+
+    def finish_url(self, current_url: str, depth: int, status: int = None, retry_after: float = None, failed: bool = False, released: bool = False, visited: bool = True):
+        """
+        Releases a popped url back to the queue. Unless it's requeued for a retry it is marked visited,
+        except with `visited=False`, which leaves it for the next run of a persisted queue to retry.
+        """
+        requeued = False if released else self.queue.release((current_url, depth), status, retry_after, failed)
+        if requeued:
+            with self.lock:
+                self.visited_urls.pop(current_url, None)
+        elif visited:
+            self.queue.mark_visited(current_url)
+
+    def pages_saved(self, works: List[PageWork], failed: List[str]):
+        """
+        Called by the database once the pages' rows are written. Only then are they marked visited,
+        so a page whose rows were still buffered when the crawl died, or failed to write, is processed
+        again by a resumed crawl instead of being skipped as done. Their page states are recorded,
+        and their chunks become canonical for the cleaner's near-duplicate check, only now too.
+        """
+        failed = set(failed)
+        for work in works:
+            if work.document.id in failed or any(id in failed for id in work.chunks.ids):
+                logging.error(f"IngestionEngine: Rows of {work.url} failed to save, leaving it unvisited")
+                continue
+            self.queue.mark_visited(work.url)
+            self.save_page_state(work)
+            self.cleaner.register_saved_chunks(work.chunks)
+
+    def enqueue_children(self, current_url: str, depth: int, children_urls: List[str], pre_cleaned_data: str):
+        children_urls = [url for url in children_urls if url not in self.visited_urls and not self.queue.exists(url) and self.relevance_checker.is_maybe_relevant(url, pre_cleaned_data)]
+        logging.debug(f"IngestionEngine: Putting children: {children_urls}")
+
+        self.queue.add([(self.normalize_url(url), depth + 1) for url in children_urls])
+        self.notify_work_available()
+
+    def skip_unchanged(self, current_url: str, depth: int, state: PageState, not_modified: bool, pre_cleaned_data: str = ""):
+        """Follows the links of a page that hasn't changed since it was saved, skipping everything else."""
+        reason = "not modified" if not_modified else "unchanged"
+        logging.info(f"IngestionEngine: {current_url} is {reason} since it was last saved, only following its links")
+        self.page_states.record_skip(not_modified)
+        if not not_modified:
+            # keep the fresh validators, so next time the server can answer with a 304
+            self.page_states.save(current_url, state)
+        self.enqueue_children(current_url, depth, state.links, pre_cleaned_data)
+
+    def save_page_state(self, work: PageWork):
+        # a page without a content hash has to be processed again next time
+        if self.page_states and work.content_hash is not None:
+            self.page_states.save(work.url, PageState(content_hash=work.content_hash, links=work.links, **work.validators))
+
+    def _process_url(self, current_url: str, depth: int = 0, start_at_depth: int = 0, max_depth=10000):
         with self.lock:
             if current_url in self.visited_urls:
                 logging.info(f"IngestionEngine: {current_url} has already been visited, skipping")
@@ -150,12 +559,24 @@ class IngestionEngine:
             return
 
         try:
-            raw_data = self.extractor.extract(current_url)
+            state = self.page_states.get(current_url) if self.page_states else None
+            try:
+                html, validators, content_type = self.extractor.get_html_if_modified(current_url, state)
+            except NotModified:
+                self.skip_unchanged(current_url, depth, state, not_modified=True)
+                return
+            raw_data = self.parse(current_url, html, content_type)
             logging.debug(f"IngestionEngine: Extracted data from {current_url}")
             pre_cleaned_data = self.cleaner.get_clean_text(raw_data)
+            links = extract_links(current_url, raw_data)
+            saved = False
 
             if depth >= start_at_depth:
                 logging.debug(f"IngestionEngine: Pre-cleaned data from {current_url}")
+                content_hash = get_chunk_id(pre_cleaned_data)
+                if state and state.content_hash == content_hash:
+                    self.skip_unchanged(current_url, depth, state._replace(links=links, **validators), not_modified=False, pre_cleaned_data=pre_cleaned_data)
+                    return
 
                 if not self.relevance_checker.is_relevant(current_url, pre_cleaned_data):
                     logging.info(f"IngestionEngine: {current_url} is not relevant, skipping")
@@ -166,62 +587,299 @@ class IngestionEngine:
                 print("Document topics: ", document)
                 logging.debug(f"IngestionEngine: Extracted document from {current_url}")
 
-                chunk_contents, chunk_surrounding_contents, chunk_extra_info = self.cleaner.get_chunks(raw_data)
+                chunk_contents, chunk_surrounding_contents, chunk_extra_info = self.cleaner.get_chunks(raw_data, document.id)
                 chunks = self.cleaner.enrich_chunks(chunk_contents, document, chunk_surrounding_contents, chunk_extra_info)
                 logging.debug(f"IngestionEngine: Extracted {len(chunks)} chunks from {current_url}")
 
-                self.db.save_documents([document])
-                self.db.save_chunks(chunks)
+                work = PageWork(current_url, depth)
+                work.document, work.chunks = document, chunks
+                # a page that lost chunks to failed embeds has to be processed again on the next re-crawl
+                if len(chunks) == len(chunk_contents):
+                    work.validators, work.content_hash, work.links = validators, content_hash, links
+                self.db.save([document], chunks, on_saved=lambda failed: self.pages_saved([work], failed))
                 logging.info(f"IngestionEngine: Saved {len(chunks)} chunks for document {document.id}")
+                saved = True
             else:
                 logging.info(f"IngestionEngine: Skipping processing for {current_url} at depth {depth}")
 
-            children_urls = extract_links(current_url, raw_data)
-            children_urls = [url for url in children_urls if url not in self.visited_urls and not self.queue.exists(url) and self.relevance_checker.is_maybe_relevant(url, pre_cleaned_data)]
-            logging.debug(f"IngestionEngine: Putting children: {children_urls}")
-
-            for url in children_urls:
-                normalized_url = self.normalize_url(url)
-                self.queue.add([(normalized_url, depth + 1)])
+            self.enqueue_children(current_url, depth, links, pre_cleaned_data)
+            return saved
 
+        except (FetchError, EmbedError):
+            raise
         except Exception as e:
             logging.error(f"IngestionEngine: Encountered an error while processing {current_url} due to {e}.", exc_info=True)
             # Optionally, re-queue the URL with a delay for retrying failed operations
             # self.queue.add([(current_url, depth)], delay=60)
-    def run(self, seed_urls: List[str], start_at_depth: int = 0, max_depth: int = 10000000):
+
+    def notify_work_available(self):
+        with self.work_available:
+            self.work_available.notify()
+
+    def task_done(self, future):
+        if future.exception():
+            logging.error(f"IngestionEngine: Task failed with {future.exception()!r}")
+        with self.work_available:
+            self.in_flight.discard(future)
+            self.work_available.notify()
+
+    def run(self, seed_urls: List[str], start_at_depth: int = 0, max_depth: int = 10000000, max_wait: float = 5):
         normalized_seed_urls = [(self.normalize_url(url), 0) for url in seed_urls]
         self.queue.add(normalized_seed_urls)
-        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
-            futures = []
-            while not all(future.done() for future in futures) or not len(self.queue) == 0:
-                queue_item = self.queue.pop()
-                if queue_item:
-                    current_url, depth = queue_item
-                    future = executor.submit(self.process_url, current_url, depth, start_at_depth, max_depth)
-                    futures.append(future)
+        self.start_parse_pool()
+        try:
+            with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+                with self.work_available:
+                    while True:
+                        if len(self.in_flight) < self.max_in_flight:
+                            queue_item = self.queue.pop()
+                            if queue_item:
+                                current_url, depth = queue_item
+                                future = executor.submit(self.process_url, current_url, depth, start_at_depth, max_depth)
+                                self.in_flight.add(future)
+                                future.add_done_callback(self.task_done)
+                                continue
+                            if not self.in_flight and len(self.queue) == 0:
+                                break
+                            # nothing poppable yet: sleep until a delayed url is due, or a task finishes or enqueues urls
+                            ready_in = self.queue.next_ready_in()
+                            timeout = max_wait if ready_in is None else min(ready_in, max_wait)
+                        else:
+                            timeout = max_wait
+                        self.work_available.wait(timeout)
+        finally:
+            self.stop_parse_pool()
+            self.db.flush()
+        print("Exiting...")
+
+class PipelinedIngestionEngine(IngestionEngine):
+    """
+    Runs pages through fetch → parse → relevance → chunk → embed → store stages connected by bounded
+    queues, so a slow stage (usually the LLM) no longer holds up fetching and parsing of other pages.
+
+    Each stage has its own concurrency: many fetchers, a few parser threads, a capped number of LLM
+    workers, and embed/store stages that batch several pages into one embedding call and one set of
+    DB writes. At most `max_in_flight` pages are anywhere in the pipeline at once, which together
+    with the bounded stage queues keeps memory flat however large the frontier grows.
+    """
+    def __init__(self, meta_topics: List[str], extractor: AbstractDataExtractor, cleaner: AbstractDataCleaner, relevance_checker: AbstractRelevanceChecker, db: AbstractDatabase, queue: AbstractQueueManager, fetch_workers: int = 16, parse_workers: int = 2, llm_workers: int = 4, embed_batch_size: int = 8, embed_retries: int = 1, db_batch_size: int = 16, stage_queue_size: int = 32, max_in_flight: int = None, page_states: Optional[PageStateCache] = None, parse_processes: int = 0):
+        super().__init__(meta_topics, extractor, cleaner, relevance_checker, db, queue, num_threads=fetch_workers, max_in_flight=max_in_flight or fetch_workers * 4, page_states=page_states, parse_processes=parse_processes)
+        self.parse_workers = parse_workers
+        self.llm_workers = llm_workers
+        self.embed_batch_size = embed_batch_size
+        self.embed_retries = embed_retries
+        self.db_batch_size = db_batch_size
+        self.stage_queue_size = stage_queue_size
+
+    def build_stages(self) -> List[Stage]:
+        size = self.stage_queue_size
+        self.store_stage = Stage("store", self.store_pages, workers=1, maxsize=size, batch_size=self.db_batch_size, on_error=self.fail_pages)
+        self.embed_stage = Stage("embed", self.embed_pages, workers=2, maxsize=size, batch_size=self.embed_batch_size, on_error=self.fail_pages)
+        self.chunk_stage = Stage("chunk", self.chunk_page, workers=self.llm_workers, maxsize=size, on_error=self.drop_page)
+        self.relevance_stage = Stage("relevance", self.check_page_relevance, workers=self.llm_workers, maxsize=size, on_error=self.drop_page)
+        # with a process pool, one thread per process keeps every process busy
+        self.parse_stage = Stage("parse", self.parse_page, workers=max(self.parse_workers, self.parse_processes), maxsize=size, on_error=self.drop_page)
+        self.fetch_stage = Stage("fetch", self.fetch_page, workers=self.num_threads, maxsize=size, on_error=self.drop_page)
+        # upstream first, so closing them in order drains the pipeline front to back
+        return [self.fetch_stage, self.parse_stage, self.relevance_stage, self.chunk_stage, self.embed_stage, self.store_stage]
+
+    def admit(self, current_url: str, depth: int) -> Optional[PageWork]:
+        with self.lock:
+            already_visited = current_url in self.visited_urls
+            self.visited_urls[current_url] = True
+        if already_visited:
+            logging.info(f"IngestionEngine: {current_url} has already been visited, skipping")
+            self.queue.release((current_url, depth))
+            return None
+        if depth >= self.max_depth:
+            logging.info(f"IngestionEngine: Reached max depth for {current_url}, skipping further processing")
+            self.finish_url(current_url, depth)
+            return None
+        logging.info(f"IngestionEngine: Processing {current_url} at depth {depth}")
+        return PageWork(current_url, depth)
+
+    def finish(self, work: PageWork, status: int = None, retry_after: float = None, failed: bool = False, visited: bool = True):
+        try:
+            self.finish_url(work.url, work.depth, status, retry_after, failed, released=work.released, visited=visited)
+        finally:
+            # even if the queue couldn't take the url back, the run loop mustn't wait on it forever
+            with self.work_available:
+                self.in_flight.discard(work)
+                self.work_available.notify()
+
+    def drop_page(self, work: PageWork, e: Exception):
+        logging.error(f"IngestionEngine: Encountered an error while processing {work.url} due to {e}.", exc_info=e)
+        self.finish(work)
+
+    def fail_pages(self, works: List[PageWork], e: Exception):
+        # these pages were chunked but never saved: they stay unvisited, so a resumed crawl processes them again
+        for work in works:
+            logging.error(f"IngestionEngine: Failed to embed or save {work.url} due to {e}.", exc_info=e)
+            self.finish(work, failed=True, visited=False)
+
+    def fetch_page(self, work: PageWork):
+        work.page_state = self.page_states.get(work.url) if self.page_states else None
+        try:
+            work.html, work.validators, work.content_type = self.extractor.get_html_if_modified(work.url, work.page_state)
+        except NotModified:
+            self.queue.release((work.url, work.depth))
+            work.released = True
+            self.skip_unchanged(work.url, work.depth, work.page_state, not_modified=True)
+            self.finish(work)
+            return
+        except FetchError as e:
+            logging.warning(f"IngestionEngine: Could not fetch {work.url}: {e}")
+            self.finish(work, e.status, e.retry_after, failed=True)
+            return
+        # the host is done with this page, so free its politeness slot before the slow stages run
+        self.queue.release((work.url, work.depth))
+        work.released = True
+        self.parse_stage.put(work)
+
+    def parse_page(self, work: PageWork):
+        work.raw_data = self.parse(work.url, work.html, work.content_type)
+        work.html = None
+        work.clean_text = self.cleaner.get_clean_text(work.raw_data)
+        work.links = extract_links(work.url, work.raw_data)
+        if work.depth >= self.start_at_depth:
+            work.content_hash = get_chunk_id(work.clean_text)
+            if work.page_state and work.page_state.content_hash == work.content_hash:
+                self.skip_unchanged(work.url, work.depth, work.page_state._replace(links=work.links, **work.validators), not_modified=False, pre_cleaned_data=work.clean_text)
+                self.finish(work)
+                return
+            self.relevance_stage.put(work)
+        else:
+            logging.info(f"IngestionEngine: Skipping processing for {work.url} at depth {work.depth}")
+            self.enqueue_children(work.url, work.depth, work.links, work.clean_text)
+            self.finish(work)
+
+    def check_page_relevance(self, work: PageWork):
+        if not self.relevance_checker.is_relevant(work.url, work.clean_text):
+            logging.info(f"IngestionEngine: {work.url} is not relevant, skipping")
+            self.finish(work)
+            return
+        self.enqueue_children(work.url, work.depth, work.links, work.clean_text)
+        work.document = self.cleaner.get_document(work.url, work.raw_data)
+        work.document.topics = self.meta_topics
+        self.chunk_stage.put(work)
+
+    def chunk_page(self, work: PageWork):
+        work.chunk_contents, work.chunk_surrounding_contents, work.chunk_extra_info = self.cleaner.get_chunks(work.raw_data, work.document.id)
+        work.raw_data = None
+        work.clean_text = None
+        self.embed_stage.put(work)
+
+    def embed_pages(self, works: List[PageWork]):
+        # one embedding request for every chunk of every page in the batch
+        texts = [self.cleaner.get_chunk_embedding_text(work.document, content) for work in works for content in work.chunk_contents]
+        embeddings = None
+        for attempt in range(self.embed_retries + 1):
+            try:
+                embeddings = embed(texts) if texts else []
+                break
+            except Exception as e:
+                error = e
+                logging.warning(f"IngestionEngine: Embedding {len(texts)} chunks of {len(works)} pages failed (attempt {attempt + 1}) due to {e!r}")
+        if embeddings is None:
+            if len(works) == 1:
+                raise error
+            # one page at a time, so a page the API keeps rejecting only fails itself
+            for work in works:
+                try:
+                    self.embed_pages([work])
+                except Exception as e:
+                    self.fail_pages([work], e)
+            return
+        offset = 0
+        for work in works:
+            count = len(work.chunk_contents)
+            work.chunks = self.cleaner.enrich_chunks(work.chunk_contents, work.document, work.chunk_surrounding_contents, work.chunk_extra_info, embeddings=embeddings[offset:offset + count])
+            offset += count
+        for work in works:
+            self.store_stage.put(work)
+
+    def store_pages(self, works: List[PageWork]):
+        self.db.save([work.document for work in works], ChunkBatch.concat([work.chunks for work in works]), on_saved=lambda failed: self.pages_saved(works, failed))
+        for work in works:
+            logging.info(f"IngestionEngine: Saved {len(work.chunks)} chunks for document {work.document.id}")
+            self.finish(work, visited=False)
+
+    def next_work(self, max_wait: float) -> Optional[PageWork]:
+        """Blocks until a page may enter the pipeline, returning None once the crawl is finished."""
+        with self.work_available:
+            while True:
+                if len(self.in_flight) < self.max_in_flight:
+                    queue_item = self.queue.pop()
+                    if queue_item:
+                        work = self.admit(*queue_item)
+                        if work:
+                            self.in_flight.add(work)
+                            return work
+                        continue
+                    if not self.in_flight and len(self.queue) == 0:
+                        return None
+                    ready_in = self.queue.next_ready_in()
+                    timeout = max_wait if ready_in is None else min(ready_in, max_wait)
                 else:
-                    logging.info("IngestionEngine: Queue is empty, waiting for new URLs")
-                    time.sleep(10)
-                    continue
-            print("Exiting...")
+                    timeout = max_wait
+                self.work_available.wait(timeout)
+
+    def run(self, seed_urls: List[str], start_at_depth: int = 0, max_depth: int = 10000000, max_wait: float = 5):
+        self.start_at_depth = start_at_depth
+        self.max_depth = max_depth
+        self.queue.add([(self.normalize_url(url), 0) for url in seed_urls])
+        self.start_parse_pool()
+        stages = [stage.start() for stage in self.build_stages()]
+        try:
+            while True:
+                work = self.next_work(max_wait)
+                if work is None:
+                    break
+                # outside the condition: this blocks while the fetchers are saturated
+                self.fetch_stage.put(work)
+        finally:
+            for stage in stages:
+                stage.close()
+            self.stop_parse_pool()
+            self.db.flush()
+        print("Exiting...")
 
 
 num_threads = 8
 
+def make_queue(name: str) -> AbstractQueueManager:
+    if args.state_dir:
+        safe_name = re.sub(r"[^A-Za-z0-9_-]+", "_", name)
+        return PoliteQueueManager(store=SqliteQueueManager(os.path.join(args.state_dir, f"{safe_name}.sqlite3")))
+    return PoliteQueueManager()
+
+_page_states = {}
+
+def get_page_states(crawl: str) -> Optional[PageStateCache]:
+    """
+    The page states of a crawl, or None with --full-refresh. Crawls keep separate states, since the
+    same page saved by one crawl (with its topics) still has to be saved by another.
+    """
+    if args.full_refresh:
+        return None
+    if crawl not in _page_states:
+        _page_states[crawl] = PageStateCache(crawl=crawl)
+    return _page_states[crawl]
+
 def run_for_elections():
     topics = ["Instructions for voters on how to vote in the United States election in 2024", "general educational information they should know about how the electoral process works"]
     relevance_checker = LLMRelevanceChecker([".*\.gov"], topics=topics)
-    cleaner = LLMDataCleaner(topics=topics)
+    cleaner = LLMDataCleaner(topics=topics, batch_typing=args.batch_typing, dedup_scope="elections")
 
-    engine = IngestionEngine(["2024 United States Election", "Voting"], SimpleDataExtractor(), cleaner=cleaner, relevance_checker=relevance_checker, db=PrismaDatabase(), queue=SimpleQueueManager(), num_threads=num_threads)
+    engine = IngestionEngine(["2024 United States Election", "Voting"], SimpleDataExtractor(), cleaner=cleaner, relevance_checker=relevance_checker, db=PrismaDatabase(), queue=make_queue("elections"), num_threads=num_threads, page_states=get_page_states("elections"), parse_processes=args.parse_processes)
     engine.run(["https://www.usa.gov/midterm-elections"])
 
 def run_for_nikki_haley():
     topics = ["Nikki Haley 2024 Presidential campaign and her political views", "Nikki Haley's tenure and track record as a politicial and concrete actions she has taken"]
     relevance_checker = LLMRelevanceChecker(["https://nikkihaley\.com/.*"], topics=topics)
-    cleaner = LLMDataCleaner(topics=topics)
+    cleaner = LLMDataCleaner(topics=topics, batch_typing=args.batch_typing, dedup_scope="nikki_haley")
 
-    engine = IngestionEngine(["Nikki Haley 2024 Presidential Campaign", "Candidates"], SimpleDataExtractor(), cleaner=cleaner, relevance_checker=relevance_checker, db=PrismaDatabase(), queue=SimpleQueueManager(), num_threads=num_threads)
+    engine = IngestionEngine(["Nikki Haley 2024 Presidential Campaign", "Candidates"], SimpleDataExtractor(), cleaner=cleaner, relevance_checker=relevance_checker, db=PrismaDatabase(), queue=make_queue("nikki_haley"), num_threads=num_threads, page_states=get_page_states("nikki_haley"), parse_processes=args.parse_processes)
     engine.run(["https://nikkihaley.com/about/"])
 
 def run_for_candidate_wikipedia(candidate_name, wikipedia_url):
@@ -229,12 +887,18 @@ def run_for_candidate_wikipedia(candidate_name, wikipedia_url):
     relevance_checker = LLMRelevanceChecker([
     ".*"
     ], topics=topics)
-    cleaner = LLMDataCleaner(topics=topics)
+    cleaner = LLMDataCleaner(topics=topics, batch_typing=args.batch_typing, dedup_scope=f"wikipedia_{candidate_name}")
 
-    engine = IngestionEngine([f"{candidate_name} 2024 Presidential Campaign", "Candidates", "Wikipedia"], SimpleDataExtractor(), cleaner=cleaner, relevance_checker=relevance_checker, db=PrismaDatabase(), queue=SimpleQueueManager(), num_threads=num_threads)
+    engine = IngestionEngine([f"{candidate_name} 2024 Presidential Campaign", "Candidates", "Wikipedia"], SimpleDataExtractor(), cleaner=cleaner, relevance_checker=relevance_checker, db=PrismaDatabase(), queue=make_queue(f"wikipedia_{candidate_name}"), num_threads=num_threads, page_states=get_page_states(f"wikipedia_{candidate_name}"), parse_processes=args.parse_processes)
     engine.run([wikipedia_url], start_at_depth=0, max_depth=2)
 
 def run_for_state_elections():
+    # one pooled extractor and one buffered DB writer for the whole crawl, shared across states
+    extractor = AsyncDataExtractor(max_in_flight=num_threads * 4)
+    db = PrismaDatabase()
+    if args.index_dir:
+        db = IndexedDatabase(db, VectorIndex(args.index_dir), LexicalIndex(os.path.join(args.index_dir, "lexical")))
+    db = WriteBehindDatabase(db)
     # all 50 states
     for state, state_seed_urls in [
         ("Alabama", ["https://www.sos.alabama.gov/alabama-votes"]),
@@ -291,11 +955,73 @@ def run_for_state_elections():
         topics = [f"Instructions for voters on how to vote in local, state, primary, or general elections in {state} in 2024", "general educational information that voters should know about how the electoral process works", f"voting in {state}"]
         gov_regex = r".*\.gov.*"
         relevance_checker = LLMRelevanceChecker([gov_regex], topics=topics)
-        cleaner = LLMDataCleaner(topics=topics)
+        cleaner = LLMDataCleaner(topics=topics, batch_typing=args.batch_typing, dedup_scope=f"state_{state}")
 
-        engine = IngestionEngine([state, "State Elections", "2024 United States Election", "Voting"], SimpleDataExtractor(), cleaner=cleaner, relevance_checker=relevance_checker, db=PrismaDatabase(), queue=SimpleQueueManager(), num_threads=num_threads)
+        engine = PipelinedIngestionEngine([state, "State Elections", "2024 United States Election", "Voting"], extractor, cleaner=cleaner, relevance_checker=relevance_checker, db=db, queue=make_queue(f"state_{state}"), fetch_workers=num_threads * 2, page_states=get_page_states(f"state_{state}"), parse_processes=args.parse_processes)
         engine.run(state_seed_urls, max_depth=3)
-        
+    db.close()
+    extractor.close()
+
+
+def test_embed_failure_leaves_page_unvisited():
+    import clean
+
+    class PageExtractor(AbstractDataExtractor):
+        def extract(self, url: str) -> ParsedPage:
+            return self.parse_html(self.get_html(url))
+
+        def get_html_if_modified(self, url: str, state: Optional[PageState] = None):
+            return b"<title>Voting</title><p>Polls are open from 7am to 7pm.</p>", {"etag": None, "last_modified": None}, "text/html"
+
+    class TwoChunkCleaner(AbstractDataCleaner):
+        def get_chunks(self, raw_data, document_id=None):
+            return ["Polls are open from 7am.", "Polls close at 7pm."], [], []
+
+    class Relevant(AbstractRelevanceChecker):
+        def is_relevant(self, url: str, data: str):
+            return True
+
+    class MemoryDatabase(AbstractDatabase):
+        def __init__(self):
+            self.chunks = []
+
+        def save_documents(self, documents):
+            pass
+
+        def save_chunks(self, chunks):
+            self.chunks.extend(chunks.contents)
+
+    class VisitedQueue(ThreadedQueueManager):
+        def __init__(self):
+            super().__init__()
+            self.visited = []
+
+        def mark_visited(self, url: str):
+            self.visited.append(url)
+
+    def crawl(embed):
+        clean.embed, original = embed, clean.embed
+        try:
+            queue, db = VisitedQueue(), MemoryDatabase()
+            IngestionEngine(["Voting"], PageExtractor(), TwoChunkCleaner(), Relevant([".*"], []), db, queue).run(["https://vote.example.gov"])
+            return queue.visited, db.chunks
+        finally:
+            clean.embed = original
+
+    def failing(texts):
+        raise ConnectionError("embeddings are down")
+
+    visited, chunks = crawl(failing)
+    assert visited == [] and chunks == [], "Expected a page none of whose chunks embedded to stay unvisited"
+
+    def failing_on_close(texts):
+        if len(texts) > 1 or "close" in texts[0]:
+            raise ConnectionError("embeddings are down")
+        return [[0.0, 1.0]]
+
+    visited, chunks = crawl(failing_on_close)
+    assert visited == ["https://vote.example.gov"] and chunks == ["Polls are open from 7am."], "Expected only the chunk that failed to embed to be dropped"
+    print("main.py: embed failure tests passed!")
 
 if __name__ == "__main__":
     # we should run for every candidate, on their website+Twitter+Wikipedia+news articles
@@ -0,0 +1,345 @@
+import codecs
+import glob
+import logging
+import os
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urljoin, urlparse
+
+from lxml import etree
+
+# pages past these limits are cut short, and whatever was read before the limit is kept
+MAX_PAGE_BYTES = 5 * 1024 * 1024
+MAX_PARSE_SECONDS = 2.0
+# how often (in tags) the parser checks the clock
+CHECK_EVERY = 256
+FEED_SIZE = 64 * 1024
+
+SKIPPED_TAGS = {"script", "style"}
+_CHARSET = re.compile(rb"<meta[^>]+charset=[\"']?([A-Za-z0-9_-]+)", re.IGNORECASE)
+_HEADER_CHARSET = re.compile(r"charset=[\"']?([A-Za-z0-9_.:-]+)", re.IGNORECASE)
+_BOMS = ((codecs.BOM_UTF8, "utf-8"), (codecs.BOM_UTF16_LE, "utf-16le"), (codecs.BOM_UTF16_BE, "utf-16be"))
+# browsers decode pages labelled latin-1 or ascii as windows-1252, a superset of both
+_WINDOWS_1252 = {"iso8859-1", "ascii", "cp1252"}
+
+def split_bom(html: bytes) -> Tuple[Optional[str], bytes]:
+    """The encoding a byte order mark at the start of the page gives, and the page without it."""
+    for bom, encoding in _BOMS:
+        if html.startswith(bom):
+            return encoding, html[len(bom):]
+    return None, html
+
+def known_encoding(label: str) -> Optional[str]:
+    """The charset label if Python knows it, since pages declare all sorts of typos and made-up names."""
+    try:
+        name = codecs.lookup(label).name
+    except LookupError:
+        return None
+    return "windows-1252" if name in _WINDOWS_1252 else label.lower()
+
+def fallback_encoding(html: bytes) -> str:
+    """utf-8 if the page decodes as such, else windows-1252 like browsers."""
+    try:
+        html.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "windows-1252"
+
+def sniff_encoding(html: bytes, content_type: Optional[str] = None) -> str:
+    """
+    The page's encoding the way browsers pick it: a byte order mark, else the charset of the
+    Content-Type header, else the one the page declares in a meta tag, else `fallback_encoding`.
+    Charsets Python doesn't know are skipped.
+    """
+    encoding, html = split_bom(html)
+    if encoding:
+        return encoding
+    header = _HEADER_CHARSET.search(content_type) if content_type else None
+    declared = _CHARSET.search(html[:4096])
+    for label in (header.group(1) if header else None, declared.group(1).decode("ascii") if declared else None):
+        encoding = known_encoding(label) if label else None
+        if encoding:
+            return encoding
+    return fallback_encoding(html)
+
+def clean_lines(text: str) -> str:
+    """Strips each line, breaks multi-headlines (runs of two spaces) into a line each and drops blank lines."""
+    lines = (line.strip() for line in text.splitlines())
+    phrases = (phrase.strip() for line in lines for phrase in line.split("  "))
+    return '\n'.join(phrase for phrase in phrases if phrase)
+
+def normalize_links(current_url: str, hrefs: List[str]) -> List[str]:
+    """Absolute, de-duplicated link targets with their fragments removed."""
+    links = [urljoin(current_url, href) for href in hrefs if href]
+    links = [urlparse(link)._replace(fragment='').geturl() for link in links if not link.endswith('#')]
+    return list(set(links))
+
+class ParsedPage:
+    """
+    What the engine needs from a page's HTML, collected in one pass: its clean text, title, meta
+    tags and link targets. `truncated` is set when the page hit the size or time limit. `links`
+    holds the normalized links once `parse_page` resolved them against the page's url.
+    """
+    __slots__ = ("title", "clean_text", "hrefs", "meta", "truncated", "links")
+
+    def __init__(self, title: Optional[str] = None, clean_text: str = "", hrefs: List[str] = None, meta: Dict[str, str] = None, truncated: bool = False, links: Optional[List[str]] = None):
+        self.title = title
+        self.clean_text = clean_text
+        self.hrefs = hrefs or []
+        self.meta = meta or {}
+        self.truncated = truncated
+        self.links = links
+
+class _ParseLimit(Exception):
+    pass
+
+class _PageCollector:
+    """lxml parser target: gets start/end/data events as the HTML is tokenized, no tree is built."""
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        self.strings = []
+        self.pending = []
+        self.skip_depth = 0
+        # <title> inside inline svg is the svg's tooltip, not the page's
+        self.svg_depth = 0
+        self.in_title = False
+        self.title_done = False
+        self.title = []
+        self.hrefs = []
+        self.meta = {}
+        self.tags = 0
+
+    def flush(self):
+        if self.pending:
+            text = "".join(self.pending).strip()
+            self.pending = []
+            if text:
+                self.strings.append(text)
+
+    def start(self, tag, attrib):
+        self.flush()
+        self.tags += 1
+        if self.tags % CHECK_EVERY == 0 and time.perf_counter() > self.deadline:
+            raise _ParseLimit()
+        if tag in SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag == "a":
+            href = attrib.get("href")
+            if href:
+                self.hrefs.append(href)
+        elif tag == "meta":
+            key = attrib.get("property") or attrib.get("name")
+            if key and "content" in attrib:
+                self.meta.setdefault(key, attrib["content"])
+        elif tag == "svg":
+            self.svg_depth += 1
+        elif tag == "title" and not self.svg_depth and not self.title_done:
+            self.in_title = True
+
+    def end(self, tag):
+        self.flush()
+        if tag in SKIPPED_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag == "svg":
+            self.svg_depth = max(0, self.svg_depth - 1)
+        elif tag == "title" and self.in_title:
+            # only the page's first title counts
+            self.in_title = False
+            self.title_done = True
+
+    def data(self, data):
+        if self.skip_depth:
+            return
+        self.pending.append(data)
+        if self.in_title:
+            self.title.append(data)
+
+    def comment(self, text):
+        # comments aren't page text, but they do end the current string
+        self.flush()
+
+    def close(self) -> ParsedPage:
+        self.flush()
+        title = "".join(self.title).strip() or None
+        return ParsedPage(title=title, clean_text=clean_lines(" ".join(self.strings)), hrefs=self.hrefs, meta=self.meta)
+
+def parse_html(html: bytes, max_bytes: int = MAX_PAGE_BYTES, max_seconds: float = MAX_PARSE_SECONDS, content_type: Optional[str] = None) -> ParsedPage:
+    """
+    Tokenizes the page once with lxml's HTML parser, collecting text, title, meta tags and links on
+    the way. Only the first `max_bytes` are read, and parsing stops after `max_seconds`.
+    `content_type` is the response's Content-Type header, which may name the page's charset.
+    """
+    if isinstance(html, str):
+        html = html.encode("utf-8")
+    truncated = len(html) > max_bytes
+    html = html[:max_bytes]
+    collector = _PageCollector(time.perf_counter() + max_seconds)
+    # lxml would otherwise assume latin-1 for pages without a meta charset
+    encoding = sniff_encoding(html, content_type)
+    html = split_bom(html)[1]
+    try:
+        parser = etree.HTMLParser(target=collector, recover=True, encoding=encoding)
+    except LookupError:
+        # a charset Python knows but libxml2 doesn't
+        parser = etree.HTMLParser(target=collector, recover=True, encoding=fallback_encoding(html))
+    try:
+        for start in range(0, len(html), FEED_SIZE):
+            parser.feed(html[start:start + FEED_SIZE])
+            if time.perf_counter() > collector.deadline:
+                raise _ParseLimit()
+        page = parser.close() if html else collector.close()
+    except _ParseLimit:
+        truncated = True
+        page = collector.close()
+    except etree.LxmlError as e:
+        logging.warning(f"parse_html: Could not parse page, keeping what was read: {e}")
+        page = collector.close()
+    page.truncated = truncated
+    if truncated:
+        logging.info(f"parse_html: Page cut short at {len(html)} bytes or {max_seconds}s")
+    return page
+
+def parse_page(url: str, html: bytes, max_bytes: int = MAX_PAGE_BYTES, max_seconds: float = MAX_PARSE_SECONDS, content_type: Optional[str] = None) -> ParsedPage:
+    """
+    All of a page's CPU work up to the LLM: `parse_html` plus link normalization. Safe to run in a
+    worker process, the raw bytes go in and only the compact `ParsedPage` comes back.
+    """
+    page = parse_html(html, max_bytes, max_seconds, content_type)
+    page.links = normalize_links(url, page.hrefs)
+    # the links replace the raw hrefs, so they aren't pickled back twice
+    page.hrefs = []
+    return page
+
+def test_parse_html():
+    html = b"""<html><head><title>Register to vote</title>
+    <meta property="article:published_time" content="2024-01-02T00:00:00Z"><meta property="article:author" content="SOS">
+    <style>p { color: red }</style><script>var x = "<a href='/nope'>";</script></head>
+    <body><h1>Voter registration</h1><!-- nav --><p>Register <b>online</b> by October 7.</p>
+    <a href="/register">Register</a><a>no href</a><p>Caf\xc3\xa9 hours  Monday to Friday</p></body></html>"""
+    page = parse_html(html)
+    assert page.title == "Register to vote"
+    assert page.meta["article:published_time"] == "2024-01-02T00:00:00Z" and page.meta["article:author"] == "SOS"
+    assert page.hrefs == ["/register"], f"Expected only real links outside scripts, got {page.hrefs}"
+    assert "color" not in page.clean_text and "var x" not in page.clean_text
+    assert page.clean_text == "Register to vote Voter registration Register online by October 7. Register no href Café hours\nMonday to Friday", page.clean_text
+
+    from bs4 import BeautifulSoup
+    from clean import SimpleDataCleaner
+    assert page.clean_text == SimpleDataCleaner().get_clean_text(BeautifulSoup(html, "html.parser")), "Expected the same clean text as the BeautifulSoup path"
+
+    big = b"<html><body>" + b"<p>filler text</p>" * 100000 + b"</body></html>"
+    limited = parse_html(big, max_bytes=10000)
+    assert limited.truncated and limited.clean_text.startswith("filler text")
+    assert parse_html(big, max_seconds=0).truncated
+    assert not parse_html(b"").truncated and parse_html(b"").clean_text == ""
+    assert parse_html("<meta charset='windows-1252'><p>Caf\xe9</p>".encode("windows-1252")).clean_text == "Café"
+    assert parse_html("<meta charset='utf-9'><p>Caf\xe9</p>".encode("windows-1252")).clean_text == "Café", "Expected an unknown charset to fall back"
+    assert parse_html("<meta charset='iso-8859-1'><p>\u201cCaf\xe9\u201d</p>".encode("windows-1252")).clean_text == "\u201cCafé\u201d", "Expected latin-1 to be read as windows-1252"
+    assert parse_html("<p>Caf\xe9</p>".encode("windows-1252"), content_type="text/html; charset=windows-1252").clean_text == "Café"
+    assert parse_html("<meta charset='utf-8'><p>Caf\xe9</p>".encode("windows-1252"), content_type="text/html; charset=cp1252").clean_text == "Café", "Expected the header to win over the meta tag"
+    assert parse_html(codecs.BOM_UTF16_LE + "<p>Caf\xe9</p>".encode("utf-16-le")).clean_text == "Café"
+    assert parse_html(codecs.BOM_UTF8 + "<p>Caf\xe9</p>".encode("utf-8"), content_type="text/html; charset=windows-1252").clean_text == "Café", "Expected the BOM to win over the header"
+
+    svg = parse_html(b"<html><head><title>Register</title></head><body><title>Stray</title><svg><title>Close</title></svg><p>Text</p></body></html>")
+    assert svg.title == "Register", f"Expected only the page's first title, got {svg.title}"
+    print("parse.py: All tests passed!")
+
+def test_parse_page_in_processes():
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    corpus = _synthetic_corpus(8)
+    url = "https://www.sos.state.example.gov/elections/"
+    with ProcessPoolExecutor(2, mp_context=multiprocessing.get_context("spawn")) as pool:
+        pooled = list(pool.map(parse_page, [url] * len(corpus), corpus))
+    for html, page in zip(corpus, pooled):
+        local = parse_html(html)
+        assert (page.title, page.clean_text, page.meta) == (local.title, local.clean_text, local.meta), "Expected a worker process to parse the page like the calling thread"
+        assert sorted(page.links) == sorted(normalize_links(url, local.hrefs))
+    print("parse.py: parse_page in processes tests passed!")
+
+def _synthetic_corpus(pages: int = 200) -> List[bytes]:
+    import random
+    rng = random.Random(0)
+    words = ["vote", "ballot", "register", "county", "election", "deadline", "absentee", "polling", "official", "state"]
+    corpus = []
+    for page in range(pages):
+        nav = "".join(f"<li><a href='/section/{i}'>Section {i}</a></li>" for i in range(rng.randint(20, 200)))
+        body = "".join(f"<div class='block'><h2>{rng.choice(words)}</h2><p>{' '.join(rng.choices(words, k=rng.randint(20, 120)))}. <a href='/p/{page}/{i}'>more</a></p></div>" for i in range(rng.randint(10, 150)))
+        scripts = "<script>" + "var a = 1;" * rng.randint(100, 3000) + "</script>"
+        corpus.append(f"<html><head><title>Page {page}</title><meta property='article:author' content='SOS'>{scripts}</head><body><nav><ul>{nav}</ul></nav>{body}</body></html>".encode())
+    return corpus
+
+def benchmark_parse(corpus_dir: Optional[str] = None):
+    """
+    CPU time per page of the old BeautifulSoup/html.parser path against one `parse_html` pass, both
+    followed by the same engine calls: clean text twice, the document and its links. Reads every
+    *.html file in `corpus_dir` when given, otherwise generates government-site-like pages.
+    """
+    from bs4 import BeautifulSoup
+    from children import extract_links
+    from clean import SimpleDataCleaner
+    cleaner = SimpleDataCleaner()
+    if corpus_dir:
+        corpus = []
+        for path in sorted(glob.glob(os.path.join(corpus_dir, "*.html"))):
+            with open(path, "rb") as f:
+                corpus.append(f.read())
+    else:
+        corpus = _synthetic_corpus()
+    url = "https://www.sos.state.example.gov/elections/"
+
+    start = time.process_time()
+    for html in corpus:
+        soup = BeautifulSoup(html, "html.parser")
+        cleaner.get_clean_text(soup)
+        # get_chunks cleaned the page a second time
+        cleaner.get_clean_text(soup)
+        cleaner.get_document(url, soup)
+        extract_links(url, soup)
+    old = (time.process_time() - start) / len(corpus)
+
+    start = time.process_time()
+    for html in corpus:
+        page = parse_html(html)
+        cleaner.get_clean_text(page)
+        cleaner.get_clean_text(page)
+        cleaner.get_document(url, page)
+        extract_links(url, page)
+    new = (time.process_time() - start) / len(corpus)
+
+    size = sum(len(html) for html in corpus) / len(corpus)
+    print(f"{len(corpus)} pages, {size / 1024:.0f} KB on average")
+    print(f"BeautifulSoup + html.parser: {1000 * old:7.2f} ms CPU/page")
+    print(f"parse_html (lxml, one pass): {1000 * new:7.2f} ms CPU/page ({old / new:.1f}x)")
+
+def benchmark_parse_processes(corpus_dir: Optional[str] = None, threads: int = 8, processes: List[int] = None):
+    """
+    Pages per second for `parse_page` on `threads` threads (the engine's threaded mode, which the GIL
+    holds to about one core) against process pools of increasing size.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    corpus = [open(path, "rb").read() for path in sorted(glob.glob(os.path.join(corpus_dir, "*.html")))] if corpus_dir else _synthetic_corpus(400)
+    urls = ["https://www.sos.state.example.gov/elections/"] * len(corpus)
+    cores = os.cpu_count() or 1
+    processes = processes or sorted({1, 2, 4, cores})
+
+    with ThreadPoolExecutor(threads) as pool:
+        start = time.perf_counter()
+        list(pool.map(parse_page, urls, corpus))
+        print(f"{threads} threads:     {len(corpus) / (time.perf_counter() - start):7.0f} pages/s")
+    for count in processes:
+        with ProcessPoolExecutor(count, mp_context=multiprocessing.get_context("spawn")) as pool:
+            # start the workers before timing
+            list(pool.map(parse_page, urls[:count], corpus[:count]))
+            start = time.perf_counter()
+            list(pool.map(parse_page, urls, corpus, chunksize=4))
+            print(f"{count:2d} processes:  {len(corpus) / (time.perf_counter() - start):7.0f} pages/s")
+    print(f"({cores} cores available)")
+
+if __name__ == "__main__":
+    test_parse_html()
+    test_parse_page_in_processes()
+    benchmark_parse()
+    benchmark_parse_processes()
@@ -0,0 +1,110 @@
+import logging
+import queue
+import time
+from threading import Thread
+from typing import Callable, Optional
+
+_STOP = object()
+
+class Stage:
+    """
+    A named pool of worker threads fed by a bounded queue.
+
+    `handler` is called with one item, or with a list of up to `batch_size` items when batching, and
+    hands its results to the next stage itself. Because `put` blocks once the input queue is full, a
+    slow stage pushes back on everything upstream of it instead of letting work pile up in memory.
+    When the handler raises, `on_error` is called with the item (or batch) and the exception. Errors
+    are logged when there's no `on_error`, or when `on_error` itself raises, and the worker carries on.
+    """
+    def __init__(self, name: str, handler: Callable, workers: int = 1, maxsize: int = 64, batch_size: int = 1, batch_timeout: float = 0.5, on_error: Optional[Callable] = None):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.on_error = on_error
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = Thread(target=self._work, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def close(self):
+        """Lets the workers drain whatever is queued, then stops them."""
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _next_batch(self):
+        item = self.queue.get()
+        if item is _STOP or self.batch_size == 1:
+            return item, item is _STOP
+        batch = [item]
+        deadline = time.monotonic() + self.batch_timeout
+        while len(batch) < self.batch_size:
+            try:
+                item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _work(self):
+        while True:
+            work, stop = self._next_batch()
+            if work is not _STOP:
+                try:
+                    self.handler(work)
+                except Exception as e:
+                    if self.on_error is None:
+                        logging.error(f"Stage {self.name}: Handler failed due to {e!r}", exc_info=e)
+                    else:
+                        try:
+                            self.on_error(work, e)
+                        except Exception as handler_error:
+                            logging.error(f"Stage {self.name}: Error handler failed due to {handler_error!r} while handling {e!r}", exc_info=handler_error)
+            if stop:
+                return
+
+def test_stage():
+    results = []
+    batches = Stage("batch", lambda batch: results.append(sorted(batch)), batch_size=3, batch_timeout=0.05).start()
+    doubles = Stage("double", lambda item: batches.put(item * 2), workers=2, maxsize=2).start()
+    for i in range(7):
+        doubles.put(i)
+    doubles.close()
+    batches.close()
+    assert sorted(x for batch in results for x in batch) == [0, 2, 4, 6, 8, 10, 12], f"Got {results}"
+    assert all(len(batch) <= 3 for batch in results)
+
+    errors = []
+    failing = Stage("failing", lambda item: 1 / item, on_error=lambda item, e: errors.append(item)).start()
+    for i in range(3):
+        failing.put(i)
+    failing.close()
+    assert errors == [0], f"Expected only the zero to fail, got {errors}"
+
+    def raising_on_error(item, e):
+        errors.append(item)
+        raise RuntimeError("the error handler failed too")
+    handled = []
+    fragile = Stage("fragile", lambda item: handled.append(1 / item), on_error=raising_on_error).start()
+    for i in range(3):
+        fragile.put(i)
+    fragile.close()
+    assert handled == [1.0, 0.5], f"Expected the stage to keep working after its error handler raised, got {handled}"
+    print("pipeline.py: All tests passed!")
+
+if __name__ == "__main__":
+    test_stage()
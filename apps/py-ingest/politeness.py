@@ -0,0 +1,211 @@
+import logging
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+from urllib.parse import urlparse
+from urllib.robotparser import RobotFileParser
+
+import requests
+
+from frontier import Frontier, url_key
+
+# statuses that mean "come back later" rather than "this page is broken"
+RETRY_STATUSES = {None, 429, 500, 502, 503, 504}
+
+def get_host(item) -> str:
+    return urlparse(url_key(item)).netloc.lower()
+
+def get_scheme(item) -> str:
+    return urlparse(url_key(item)).scheme.lower() or "https"
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parses a Retry-After header, which is either a number of seconds or an HTTP date."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def fetch_crawl_delay(host: str, scheme: str = "https", user_agent: str = "letsvote-ingest", timeout: float = 10) -> Optional[float]:
+    """The crawl-delay in the host's robots.txt, fetched with the scheme its urls use."""
+    robots = RobotFileParser()
+    try:
+        response = requests.get(f"{scheme}://{host}/robots.txt", timeout=timeout, headers={"User-Agent": user_agent})
+    except requests.RequestException as e:
+        logging.debug(f"HostScheduler: Could not fetch robots.txt for {host} due to {e!r}")
+        return None
+    if response.status_code != 200:
+        return None
+    robots.parse(response.text.splitlines())
+    crawl_delay = robots.crawl_delay(user_agent)
+    return float(crawl_delay) if crawl_delay is not None else None
+
+class HostState:
+    def __init__(self):
+        self.frontier = Frontier()
+        self.crawl_delay = 0.0
+        self.backoff = 0.0
+        self.next_allowed = 0.0
+        self.active = 0
+
+class HostScheduler:
+    """
+    Hands out urls round-robin across hosts while keeping every host within its politeness budget.
+
+    A host is only eligible when it has fewer than `max_concurrency` urls in flight and its last
+    request was long enough ago. The gap between requests is the larger of `min_delay` and the
+    host's robots.txt crawl-delay, plus an adaptive backoff that doubles on throttling or server
+    errors and halves on every success. Not thread safe; `PoliteQueueManager` wraps it in a lock.
+
+    A host with nothing queued or in flight is dropped from the rotation once its delay has passed,
+    so a long crawl doesn't keep walking hosts it's done with. Its crawl-delay is remembered, but
+    a host that comes back starts without backoff.
+    """
+    def __init__(self, min_delay: float = 0.25, max_concurrency: int = 4, max_backoff: float = 300, max_retries: int = 3):
+        self.min_delay = min_delay
+        self.max_concurrency = max_concurrency
+        self.max_backoff = max_backoff
+        self.max_retries = max_retries
+        self.hosts: Dict[str, HostState] = {}
+        # crawl-delays outlive the hosts' states, so robots.txt is only fetched once per host
+        self.crawl_delays: Dict[str, float] = {}
+        self.rotation = deque()
+        self.retries: Dict[str, int] = {}
+        self.size = 0
+
+    def knows_host(self, host: str) -> bool:
+        return host in self.hosts or host in self.crawl_delays
+
+    def _host(self, host: str) -> HostState:
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState()
+            state.crawl_delay = self.crawl_delays.get(host, 0.0)
+            self.rotation.append(host)
+        return state
+
+    def set_crawl_delay(self, host: str, crawl_delay: Optional[float]):
+        self.crawl_delays[host] = self._host(host).crawl_delay = crawl_delay or 0.0
+
+    def delay_for(self, state: HostState) -> float:
+        return max(self.min_delay, state.crawl_delay) + state.backoff
+
+    def add(self, item, delay: float = 0) -> bool:
+        added = self._host(get_host(item)).frontier.add(item, delay)
+        if added:
+            self.size += 1
+        return added
+
+    def exists(self, item) -> bool:
+        state = self.hosts.get(get_host(item))
+        return state is not None and state.frontier.exists(item)
+
+    def pop(self):
+        now = time.time()
+        for _ in range(len(self.rotation)):
+            host = self.rotation.popleft()
+            state = self.hosts[host]
+            if not state.active and not len(state.frontier) and state.next_allowed <= now:
+                del self.hosts[host]
+                continue
+            self.rotation.append(host)
+            if state.active >= self.max_concurrency or state.next_allowed > now:
+                continue
+            item = state.frontier.pop()
+            if item is None:
+                continue
+            self.size -= 1
+            state.active += 1
+            state.next_allowed = now + self.delay_for(state)
+            return item
+        return None
+
+    def release(self, item, status: Optional[int] = None, retry_after: Optional[float] = None, failed: bool = False) -> bool:
+        """
+        Reports that `item` is finished so its host frees up a slot and adapts its backoff.
+        Returns True when the item was put back in the frontier to be retried later.
+        """
+        state = self._host(get_host(item))
+        state.active = max(0, state.active - 1)
+        now = time.time()
+        url = url_key(item)
+
+        if not failed:
+            state.backoff = state.backoff / 2 if state.backoff > 0.05 else 0.0
+            self.retries.pop(url, None)
+            return False
+        if status not in RETRY_STATUSES:
+            return False
+
+        state.backoff = min(self.max_backoff, max(1.0, state.backoff * 2))
+        wait = max(retry_after or 0, self.delay_for(state))
+        state.next_allowed = max(state.next_allowed, now + wait)
+        logging.info(f"HostScheduler: Backing off {get_host(item)} for {wait:.1f}s after status {status}")
+
+        attempts = self.retries.get(url, 0) + 1
+        if attempts > self.max_retries:
+            self.retries.pop(url, None)
+            return False
+        self.retries[url] = attempts
+        return self.add(item, delay=wait)
+
+    def next_ready_in(self) -> Optional[float]:
+        now = time.time()
+        waits = []
+        for state in self.hosts.values():
+            ready_in = state.frontier.next_ready_in()
+            if ready_in is None or state.active >= self.max_concurrency:
+                continue
+            waits.append(max(ready_in, state.next_allowed - now, 0))
+        return min(waits) if waits else None
+
+    def __len__(self):
+        return self.size
+
+def test_host_scheduler():
+    scheduler = HostScheduler(min_delay=10, max_concurrency=1, max_retries=1)
+    for i in range(3):
+        scheduler.add((f"https://a.gov/{i}", 0))
+    scheduler.add(("https://b.gov/0", 0))
+    assert len(scheduler) == 4
+
+    first, second = scheduler.pop(), scheduler.pop()
+    assert {get_host(first), get_host(second)} == {"a.gov", "b.gov"}, "Expected hosts to be round-robined"
+    assert scheduler.pop() is None, "Expected both hosts to be waiting on their delay"
+
+    # a throttled request backs the host off and is queued again, once
+    assert scheduler.release(first, status=429, retry_after=30, failed=True)
+    assert scheduler.hosts[get_host(first)].next_allowed >= time.time() + 29
+    assert scheduler.exists(first)
+    # a 404 is not the host's fault
+    assert not scheduler.release(second, status=404, failed=True)
+    assert scheduler.hosts["b.gov"].backoff == 0
+
+    # hosts with nothing left are dropped from the rotation once their delay has passed
+    idle = HostScheduler(min_delay=0)
+    idle.set_crawl_delay("c.gov", 5)
+    idle.add(("http://c.gov/0", 0))
+    idle.add(("https://d.gov/0", 0))
+    for _ in range(2):
+        idle.release(idle.pop())
+    assert idle.pop() is None
+    assert "d.gov" not in idle.hosts and list(idle.rotation) == ["c.gov"], "Expected a finished host to be evicted"
+    idle.hosts["c.gov"].next_allowed = 0
+    idle.pop()
+    assert not idle.hosts and not idle.rotation and idle.knows_host("c.gov"), "Expected a host to be evicted only once its delay passed"
+    idle.add(("http://c.gov/1", 0))
+    assert idle.hosts["c.gov"].crawl_delay == 5, "Expected a returning host to keep its crawl-delay"
+    assert get_scheme(("http://c.gov/1", 0)) == "http"
+
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after("soon") is None
+    print("politeness.py: All tests passed!")
+
+if __name__ == "__main__":
+    test_host_scheduler()
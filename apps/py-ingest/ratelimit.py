@@ -0,0 +1,195 @@
+import json
+import logging
+import random
+import re
+import time
+from collections import deque
+from threading import Condition, Lock
+from typing import Callable, Dict, Optional, Tuple
+
+import httpx
+import openai
+from openai import OpenAI
+
+from politeness import parse_retry_after
+
+# (requests per minute, tokens per minute) until the API's rate limit headers tell us otherwise
+DEFAULT_LIMITS: Dict[str, Tuple[int, int]] = {
+    "gpt-4-0125-preview": (500, 300000),
+    "gpt-3.5-turbo": (3500, 160000),
+    "text-embedding-3-small": (3000, 1000000),
+}
+FALLBACK_LIMITS = (500, 100000)
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    """Parses reset durations from the rate limit headers, e.g. `20ms`, `1.5s` or `6m0s`."""
+    if not value:
+        return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_for(self, amount: float) -> float:
+        """Seconds until `amount` (capped at the bucket size) is available."""
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing * 60 / self.capacity)
+
+class ModelLimiter:
+    """
+    Request and token budgets for one model, plus a cap on concurrent calls.
+
+    Callers are admitted strictly in arrival order, so a large prompt waiting for token budget is not
+    starved by a stream of small ones. Budgets are corrected from the API's `x-ratelimit-*` headers,
+    and a 429 pauses every caller of the model until the API says it's fine to continue.
+    """
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, max_concurrency: int = 16):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.paused_until = 0.0
+        self.waiting = deque()
+        self.condition = Condition()
+
+    def acquire(self, tokens: int):
+        ticket = object()
+        with self.condition:
+            self.waiting.append(ticket)
+            while True:
+                now = time.monotonic()
+                self.requests.refill(now)
+                self.tokens.refill(now)
+                wait = None
+                if self.waiting[0] is ticket and self.active < self.max_concurrency:
+                    wait = max(self.paused_until - now, self.requests.wait_for(1), self.tokens.wait_for(tokens))
+                    if wait <= 0:
+                        self.waiting.popleft()
+                        self.active += 1
+                        self.requests.level -= 1
+                        self.tokens.level -= min(tokens, self.tokens.capacity)
+                        self.condition.notify_all()
+                        return
+                self.condition.wait(wait)
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def pause(self, seconds: float):
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers):
+        with self.condition:
+            now = time.monotonic()
+            for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                bucket.refill(now)
+                if limit and limit.isdigit():
+                    bucket.capacity = float(limit)
+                if remaining and remaining.isdigit():
+                    bucket.level = min(bucket.level, float(remaining))
+                    if int(remaining) == 0:
+                        reset = parse_reset(headers.get(f"x-ratelimit-reset-{kind}"))
+                        if reset:
+                            self.paused_until = max(self.paused_until, now + reset)
+            self.condition.notify_all()
+
+class RateLimiter:
+    """
+    Process-wide registry of `ModelLimiter`s that every LLM and embedding request goes through.
+    `call` waits for budget, runs the request and retries retryable errors with jittered backoff.
+    """
+    def __init__(self, limits: Dict[str, Tuple[int, int]] = DEFAULT_LIMITS, max_concurrency: int = 16, max_retries: int = 6):
+        self.limits = limits
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.models: Dict[str, ModelLimiter] = {}
+        self.lock = Lock()
+
+    def for_model(self, model: str) -> ModelLimiter:
+        with self.lock:
+            if model not in self.models:
+                requests_per_minute, tokens_per_minute = self.limits.get(model, FALLBACK_LIMITS)
+                self.models[model] = ModelLimiter(requests_per_minute, tokens_per_minute, self.max_concurrency)
+            return self.models[model]
+
+    def call(self, model: str, tokens: int, request: Callable):
+        limiter = self.for_model(model)
+        for attempt in range(self.max_retries + 1):
+            limiter.acquire(tokens)
+            try:
+                return request()
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                response = getattr(e, "response", None)
+                retry_after = parse_retry_after(response.headers.get("retry-after")) if response is not None else None
+                # full jitter, so callers that failed together don't retry together
+                delay = retry_after if retry_after is not None else random.uniform(0, min(60, 2 ** attempt))
+                logging.warning(f"RateLimiter: {model} request failed with {type(e).__name__}, retrying in {delay:.1f}s")
+                if isinstance(e, openai.RateLimitError):
+                    limiter.pause(delay)
+                else:
+                    time.sleep(delay)
+            finally:
+                limiter.release()
+
+_rate_limiter = RateLimiter()
+
+def get_rate_limiter() -> RateLimiter:
+    return _rate_limiter
+
+def record_rate_limit_headers(response: httpx.Response):
+    try:
+        model = json.loads(response.request.content).get("model")
+    except (ValueError, AttributeError):
+        return
+    if model:
+        get_rate_limiter().for_model(model).update_from_headers(response.headers)
+
+def make_openai_client() -> OpenAI:
+    """An OpenAI client whose responses feed the rate limiter. Retries are left to `RateLimiter.call`."""
+    return OpenAI(max_retries=0, http_client=httpx.Client(event_hooks={"response": [record_rate_limit_headers]}))
+
+def test_rate_limiter():
+    limiter = ModelLimiter(requests_per_minute=600, tokens_per_minute=600, max_concurrency=1)
+    limiter.acquire(100)
+    limiter.release()
+    assert limiter.tokens.level == 500
+
+    # an empty token budget means waiting for ~10 tokens/s to refill
+    limiter.tokens.level = 0
+    start = time.monotonic()
+    limiter.acquire(3)
+    assert 0.2 < time.monotonic() - start < 1, "Expected to wait for the token budget to refill"
+    limiter.release()
+
+    limiter.update_from_headers({"x-ratelimit-limit-requests": "1200", "x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "300ms"})
+    assert limiter.requests.capacity == 1200 and limiter.requests.level == 0
+    start = time.monotonic()
+    limiter.acquire(1)
+    assert time.monotonic() - start >= 0.25, "Expected to wait for the reset from the headers"
+    limiter.release()
+
+    assert parse_reset("6m0s") == 360 and parse_reset("20ms") == 0.02 and parse_reset("") is None
+    print("ratelimit.py: All tests passed!")
+
+if __name__ == "__main__":
+    test_rate_limiter()
@@ -1,24 +1,277 @@
-from prisma import Prisma 
+from datetime import datetime
+import os
+from threading import Lock
+from prisma import Prisma
+from pydantic import BaseModel
+from db import to_pg_array
 from embed import embed
-from typing import List
+from lexical import LexicalIndex
+from vector_index import VectorIndex
+from vectors import from_pgvector, to_pgvector
+from typing import List, Optional, Tuple, Union
+import logging
 
-def knn(search_string: str, k: int = 20):
-    search_embedding = embed([search_string])[0]
-    prisma = Prisma()
-    prisma.connect()
+_prisma = None
+_prisma_lock = Lock()
 
-    formatted_search_embedding = "[" + ",".join([str(x) for x in search_embedding]) + "]"
-    # await prisma.$queryRaw`SELECT url, content FROM "Chunks" ORDER BY embedding <-> ${embedding}::vector LIMIT 5`;
-    return prisma.query_raw(f"SELECT content, embedding <=> '{formatted_search_embedding}'::vector AS distance FROM \"Chunk\" ORDER BY distance LIMIT {k}")
+def get_prisma() -> Prisma:
+    """One connection for the whole process instead of a new one per query."""
+    global _prisma
+    with _prisma_lock:
+        if _prisma is None:
+            _prisma = Prisma()
+            _prisma.connect()
+        return _prisma
+
+class ChunkFilter(BaseModel):
+    """
+    Metadata a chunk has to match to be returned. Every field that is set narrows the search:
+    `topics` matches chunks tagged with any of them, `types` and `document_ids` match any of their
+    values, and the dates bound the document's `date_published`.
+    """
+    topics: List[str] = []
+    types: List[str] = []
+    document_ids: List[str] = []
+    published_after: Optional[datetime] = None
+    published_before: Optional[datetime] = None
+
+    def to_sql(self, args: list) -> str:
+        """WHERE conditions over `c` ("Chunk") and `d` ("Document"), appending their parameters to `args`."""
+        conditions = ['c."embedding" IS NOT NULL']
+        def param(value, cast: str) -> str:
+            args.append(value)
+            return f"${len(args)}::{cast}"
+        if self.topics:
+            conditions.append(f'c."topics" && {param(to_pg_array(self.topics), "text[]")}')
+        if self.types:
+            conditions.append(f'c."type" = ANY({param(to_pg_array(self.types), "text[]")})')
+        if self.document_ids:
+            conditions.append(f'c."document_id" = ANY({param(to_pg_array(self.document_ids), "text[]")})')
+        if self.published_after:
+            conditions.append(f'd."date_published" >= {param(self.published_after.isoformat(), "timestamp")}')
+        if self.published_before:
+            conditions.append(f'd."date_published" < {param(self.published_before.isoformat(), "timestamp")}')
+        return " AND ".join(conditions)
+
+def knn(search_strings: Union[str, List[str]], k: int = 20, where: Optional[ChunkFilter] = None):
+    """
+    The `k` chunks closest to each search string, with their distance and their document's url and
+    title. Several search strings are embedded in one request and answered by one query, in which
+    the `where` filter is part of each search rather than applied to its results. A single string
+    returns one result list, a list of strings returns a result list per string.
+    """
+    single = isinstance(search_strings, str)
+    queries = [search_strings] if single else list(search_strings)
+    if not queries:
+        return []
+    search_embeddings = embed(queries)
+
+    args = [to_pg_array(to_pgvector(embedding) for embedding in search_embeddings), k]
+    conditions = (where or ChunkFilter()).to_sql(args)
+    rows = get_prisma().query_raw(f"""
+        SELECT q.query_index, m.id, m.content, m.type, m.topics, m.document_id, m.url, m.title, m.distance
+        FROM unnest($1::text[]) WITH ORDINALITY AS q(embedding, query_index)
+        CROSS JOIN LATERAL (
+            SELECT c."id" AS id, c."content" AS content, c."type" AS type, c."topics" AS topics, c."document_id" AS document_id,
+                   d."url" AS url, d."title" AS title, c."embedding" <=> q.embedding::vector AS distance
+            FROM "Chunk" c
+            LEFT JOIN "Document" d ON d."id" = c."document_id"
+            WHERE {conditions}
+            ORDER BY distance
+            LIMIT $2
+        ) m
+        ORDER BY q.query_index, m.distance
+    """, *args)
+
+    results = [[] for _ in queries]
+    for row in rows:
+        results[int(row.pop("query_index")) - 1].append(row)
+    return results[0] if single else results
+
+class LocalRetriever:
+    """
+    Answers `knn` from a local `VectorIndex` instead of scanning the `Chunk` table, and only goes
+    to the database for the chunks it returns. Takes the same arguments as `knn` and returns results
+    of the same shape.
+
+    A `where` filter is evaluated in the database and the ids passing it are searched in the index.
+    When more than `max_candidates` chunks pass, the search goes to `knn` instead, which applies the
+    filter within Postgres' own scan rather than pulling most of the table into Python.
+    """
+    def __init__(self, index: VectorIndex, n_probe: Optional[int] = None, max_candidates: int = 20000):
+        self.index = index
+        self.n_probe = n_probe
+        self.max_candidates = max_candidates
+
+    @classmethod
+    def build(cls, path: str, dtype: str = "float32", page_size: int = 5000) -> 'LocalRetriever':
+        """Builds (or tops up) the index at `path` from every embedded chunk in the database."""
+        index = VectorIndex(path, dtype=dtype)
+        prisma = get_prisma()
+        last_id = ""
+        while True:
+            rows = prisma.query_raw('SELECT id, embedding::text AS embedding FROM "Chunk" WHERE embedding IS NOT NULL AND id > $1 ORDER BY id LIMIT $2', last_id, page_size)
+            if not rows:
+                break
+            new_rows = [row for row in rows if row["id"] not in index.rows]
+            if new_rows:
+                index.add([row["id"] for row in new_rows], [from_pgvector(row["embedding"]) for row in new_rows])
+            last_id = rows[-1]["id"]
+            logging.info(f"LocalRetriever: Indexed {len(index)} chunks")
+        return cls(index)
+
+    def candidate_ids(self, where: Optional[ChunkFilter]) -> Optional[List[str]]:
+        """
+        Ids of the chunks passing `where`, so the local indexes only score those. None without a
+        filter, and also when more than `max_candidates` chunks pass it.
+        """
+        if not where:
+            return None
+        args = [self.max_candidates + 1]
+        conditions = where.to_sql(args)
+        rows = get_prisma().query_raw(f'SELECT c."id" AS id FROM "Chunk" c LEFT JOIN "Document" d ON d."id" = c."document_id" WHERE {conditions} LIMIT $1', *args)
+        if len(rows) > self.max_candidates:
+            return None
+        return [row["id"] for row in rows]
+
+    def passing_ids(self, where: ChunkFilter, ids) -> set:
+        """Which of `ids` pass `where`."""
+        ids = list(ids)
+        if not ids:
+            return set()
+        args = [to_pg_array(ids)]
+        conditions = where.to_sql(args)
+        return {row["id"] for row in get_prisma().query_raw(f'SELECT c."id" AS id FROM "Chunk" c LEFT JOIN "Document" d ON d."id" = c."document_id" WHERE c."id" = ANY($1::text[]) AND {conditions}', *args)}
+
+    def fetch_chunks(self, ids) -> dict:
+        ids = list(ids)
+        if not ids:
+            return {}
+        rows = get_prisma().query_raw("""
+            SELECT c."id" AS id, c."content" AS content, c."type" AS type, c."topics" AS topics, c."document_id" AS document_id, d."url" AS url, d."title" AS title
+            FROM "Chunk" c LEFT JOIN "Document" d ON d."id" = c."document_id"
+            WHERE c."id" = ANY($1::text[])
+        """, to_pg_array(ids))
+        return {row["id"]: row for row in rows}
+
+    def knn(self, search_strings: Union[str, List[str]], k: int = 20, where: Optional[ChunkFilter] = None):
+        single = isinstance(search_strings, str)
+        queries = [search_strings] if single else list(search_strings)
+        if not queries:
+            return []
+        candidate_ids = self.candidate_ids(where)
+        if where and candidate_ids is None:
+            return knn(search_strings, k, where)
+        matches = self.index.search_many(embed(queries), k=k, n_probe=self.n_probe, ids=candidate_ids)
+        chunks = self.fetch_chunks({id for query_matches in matches for id, _ in query_matches})
+        # chunks deleted from the database since they were indexed are skipped
+        results = [[{**chunks[id], "distance": 1 - similarity} for id, similarity in query_matches if id in chunks] for query_matches in matches]
+        return results[0] if single else results
+
+class HybridRetriever(LocalRetriever):
+    """
+    Combines the vector index with a BM25 `LexicalIndex`, so exact terms like form names, deadlines
+    and statute numbers are found even when their embedding isn't close to the query's. The two
+    rankings are merged with reciprocal rank fusion over the top `candidates` of each.
+    """
+    def __init__(self, index: VectorIndex, lexical: LexicalIndex, n_probe: Optional[int] = None, candidates: int = 50, rrf_k: int = 60, max_candidates: int = 20000, broad_filter_factor: int = 8):
+        super().__init__(index, n_probe, max_candidates)
+        self.lexical = lexical
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self.broad_filter_factor = broad_filter_factor
+
+    @classmethod
+    def build(cls, path: str, dtype: str = "float32", page_size: int = 5000) -> 'HybridRetriever':
+        """Builds (or tops up) the vector index at `path` and the lexical index next to it."""
+        index = LocalRetriever.build(path, dtype, page_size).index
+        lexical = LexicalIndex(os.path.join(path, "lexical"))
+        prisma = get_prisma()
+        last_id = ""
+        while True:
+            rows = prisma.query_raw('SELECT id, content FROM "Chunk" WHERE id > $1 ORDER BY id LIMIT $2', last_id, page_size)
+            if not rows:
+                break
+            new_rows = [row for row in rows if row["id"] not in lexical.rows]
+            lexical.add([row["id"] for row in new_rows], [row["content"] for row in new_rows])
+            last_id = rows[-1]["id"]
+        lexical.flush()
+        return cls(index, lexical)
+
+    def search(self, search_strings: Union[str, List[str]], k: int = 20, where: Optional[ChunkFilter] = None, keyword_only: bool = False):
+        """
+        Hybrid top-k per search string, each result with its fused `score`. With `keyword_only`
+        nothing is embedded and results are ranked by BM25 alone.
+
+        With a filter too broad for `candidate_ids`, the vector ranking comes from `knn`, and the
+        lexical ranking is the best matches among BM25's top `broad_filter_factor` times as many that
+        pass the filter.
+        """
+        single = isinstance(search_strings, str)
+        queries = [search_strings] if single else list(search_strings)
+        if not queries:
+            return []
+        candidate_ids = self.candidate_ids(where)
+        broad = bool(where) and candidate_ids is None
+        limit = k if keyword_only else self.candidates
+        if broad:
+            lexical_matches = [self.lexical.search(query, k=limit * self.broad_filter_factor) for query in queries]
+            passing = self.passing_ids(where, {id for matches in lexical_matches for id, _ in matches})
+            lexical_matches = [[(id, score) for id, score in matches if id in passing][:limit] for matches in lexical_matches]
+        else:
+            lexical_matches = [self.lexical.search(query, k=limit, ids=candidate_ids) for query in queries]
+        if keyword_only:
+            rankings = lexical_matches
+        elif broad:
+            vector_matches = [[(row["id"], 1 - row["distance"]) for row in rows] for rows in knn(queries, k=self.candidates, where=where)]
+            rankings = [self.fuse(lexical, vector)[:k] for lexical, vector in zip(lexical_matches, vector_matches)]
+        else:
+            vector_matches = self.index.search_many(embed(queries), k=self.candidates, n_probe=self.n_probe, ids=candidate_ids)
+            rankings = [self.fuse(lexical, vector)[:k] for lexical, vector in zip(lexical_matches, vector_matches)]
+
+        chunks = self.fetch_chunks({id for ranking in rankings for id, _ in ranking})
+        results = [[{**chunks[id], "score": score} for id, score in ranking if id in chunks] for ranking in rankings]
+        return results[0] if single else results
+
+    def fuse(self, *rankings: List[Tuple[str, float]]) -> List[Tuple[str, float]]:
+        """Reciprocal rank fusion: every ranking adds 1 / (rrf_k + rank) to each id it contains."""
+        scores = {}
+        for ranking in rankings:
+            for rank, (id, _) in enumerate(ranking):
+                scores[id] = scores.get(id, 0.0) + 1 / (self.rrf_k + rank + 1)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
 
 def test_knn():
     k=20
     results = knn("Nikki Haley views on abortion", k=k)
     print("Results: ", results)
     assert len(results) == k, f"Expected 5 results, got {len(results)}"
-    # assert "url" in results[0], "Expected 'url' in first result"
+    assert "url" in results[0], "Expected 'url' in first result"
     assert "content" in results[0], "Expected 'content' in first result"
+
+    batched = knn(["Nikki Haley views on abortion", "How do I register to vote?"], k=3, where=ChunkFilter(types=[results[0]["type"]]))
+    assert len(batched) == 2, f"Expected one result list per query, got {len(batched)}"
+    assert all(result["type"] == results[0]["type"] for query_results in batched for result in query_results), "Expected only chunks of the filtered type"
     print("knn.py: All tests passed!")
 
+def test_local_retriever():
+    import tempfile
+    retriever = LocalRetriever.build(tempfile.mkdtemp())
+    local_results = retriever.knn("Nikki Haley views on abortion", k=5)
+    results = knn("Nikki Haley views on abortion", k=5)
+    assert local_results[0]["content"] == results[0]["content"], "Expected the local index to find the same closest chunk"
+    print("LocalRetriever: All tests passed!")
+
+def test_hybrid_retriever():
+    import tempfile
+    retriever = HybridRetriever.build(tempfile.mkdtemp())
+    keyword_results = retriever.search("voter registration deadline", k=5, keyword_only=True)
+    assert keyword_results and all("score" in result for result in keyword_results)
+    results = retriever.search(["voter registration deadline", "Nikki Haley views on abortion"], k=5)
+    assert len(results) == 2 and all(len(query_results) <= 5 for query_results in results)
+    print("HybridRetriever: All tests passed!")
+
 if __name__ == "__main__":
-    test_knn()
\ No newline at end of file
+    test_knn()
+    test_local_retriever()
+    test_hybrid_retriever()
@@ -1,9 +1,14 @@
 from datetime import datetime
-from typing import List, Optional
+import time
+import tracemalloc
+from typing import List, Optional, Sequence
+
+import numpy as np
 
 from utils import get_chunk_id, get_document_id
 from prisma import Prisma
 from embed import embed 
+from vectors import DTYPE, Vector, as_matrix, to_pgvector
 
 from pydantic import BaseModel, Field
 from typing import List, Optional
@@ -22,7 +27,8 @@ class Chunk(BaseModel):
     id: str
     document_id: Optional[str] = None
     index_in_doc: int
-    embedding: Optional[List[float]] = None
+    # float32 array, see vectors.py
+    embedding: Vector = None
     content: str
     surrounding_content: Optional[str] = ''
     Document: Optional[Document] = None
@@ -31,6 +37,98 @@ class Chunk(BaseModel):
 
 Document.update_forward_refs()
 
+class ChunkBatch:
+    """
+    Chunks stored column by column, with their embeddings as one contiguous float32 matrix.
+
+    This is what the engine passes between cleaning, embedding and saving, so that holding tens of
+    thousands of chunks costs a few Python lists and one array instead of a pydantic model per chunk.
+    `Chunk`s are only built, with `to_chunks`, where something outside the engine needs them. A batch
+    either has an embedding for every chunk or for none of them.
+    """
+    __slots__ = ("ids", "document_ids", "index_in_doc", "contents", "surrounding_contents", "types", "topics", "embeddings")
+
+    # `Chunk` field -> column holding it
+    FIELDS = {"id": "ids", "document_id": "document_ids", "index_in_doc": "index_in_doc", "content": "contents", "surrounding_content": "surrounding_contents", "type": "types", "topics": "topics", "embedding": "embeddings"}
+
+    def __init__(self, ids: List[str] = None, document_ids: List[Optional[str]] = None, index_in_doc: List[int] = None, contents: List[str] = None, surrounding_contents: List[str] = None, types: List[Optional[str]] = None, topics: List[List[str]] = None, embeddings: Optional[Sequence] = None):
+        self.ids = ids or []
+        count = len(self.ids)
+        self.document_ids = document_ids or [None] * count
+        self.index_in_doc = index_in_doc or list(range(count))
+        self.contents = contents or [""] * count
+        self.surrounding_contents = surrounding_contents or [""] * count
+        self.types = types or [None] * count
+        self.topics = topics or [[] for _ in range(count)]
+        self.embeddings = as_matrix(embeddings) if embeddings is not None else None
+        if self.embeddings is not None and len(self.embeddings) != count:
+            raise ValueError(f"Expected {count} embeddings, got {len(self.embeddings)}")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        # for code written against List[Chunk]; this builds every Chunk, so prefer `column` internally
+        return iter(self.to_chunks())
+
+    def column(self, field: str) -> Sequence:
+        """The values of one `Chunk` field, in chunk order."""
+        if field == "embedding" and self.embeddings is None:
+            return [None] * len(self)
+        return getattr(self, self.FIELDS[field])
+
+    def to_chunks(self) -> List[Chunk]:
+        embeddings = self.column("embedding")
+        return [
+            Chunk(id=id, document_id=document_id, index_in_doc=index, content=content, surrounding_content=surrounding_content, type=type, topics=topics, embedding=embedding)
+            for id, document_id, index, content, surrounding_content, type, topics, embedding
+            in zip(self.ids, self.document_ids, self.index_in_doc, self.contents, self.surrounding_contents, self.types, self.topics, embeddings)
+        ]
+
+    @classmethod
+    def from_chunks(cls, chunks: List[Chunk]) -> 'ChunkBatch':
+        if not chunks:
+            return cls()
+        embeddings = [chunk.embedding for chunk in chunks]
+        if any(embedding is None for embedding in embeddings):
+            if any(embedding is not None for embedding in embeddings):
+                raise ValueError("Expected either all or none of the chunks to have an embedding")
+            embeddings = None
+        return cls(
+            ids=[chunk.id for chunk in chunks],
+            document_ids=[chunk.document_id for chunk in chunks],
+            index_in_doc=[chunk.index_in_doc for chunk in chunks],
+            contents=[chunk.content for chunk in chunks],
+            surrounding_contents=[chunk.surrounding_content for chunk in chunks],
+            types=[chunk.type for chunk in chunks],
+            topics=[chunk.topics for chunk in chunks],
+            embeddings=embeddings,
+        )
+
+    @classmethod
+    def concat(cls, batches: List['ChunkBatch']) -> 'ChunkBatch':
+        batches = [batch for batch in batches if len(batch)]
+        if len(batches) == 1:
+            return batches[0]
+        if not batches:
+            return cls()
+        has_embeddings = [batch.embeddings is not None for batch in batches]
+        if any(has_embeddings) and not all(has_embeddings):
+            raise ValueError("Expected either all or none of the batches to have embeddings")
+        return cls(
+            ids=[id for batch in batches for id in batch.ids],
+            document_ids=[id for batch in batches for id in batch.document_ids],
+            index_in_doc=[index for batch in batches for index in batch.index_in_doc],
+            contents=[content for batch in batches for content in batch.contents],
+            surrounding_contents=[content for batch in batches for content in batch.surrounding_contents],
+            types=[type for batch in batches for type in batch.types],
+            topics=[topics for batch in batches for topics in batch.topics],
+            embeddings=np.concatenate([batch.embeddings for batch in batches]) if all(has_embeddings) else None,
+        )
+
+def as_chunk_batch(chunks) -> ChunkBatch:
+    return chunks if isinstance(chunks, ChunkBatch) else ChunkBatch.from_chunks(list(chunks))
+
 
 def test_schema():
     prisma = Prisma()
@@ -56,7 +154,7 @@ def test_schema():
     new_chunk_id = get_chunk_id("Test Chunk")
     chunk_insertion_query = f"""
     INSERT INTO "Chunk" ("id", "content", "document_id", "index_in_doc", "embedding") 
-    VALUES ('{new_chunk_id}', 'Test Chunk', '{document.id}', 0, '{embedding}')
+    VALUES ('{new_chunk_id}', 'Test Chunk', '{document.id}', 0, '{to_pgvector(embedding)}')
     """
     prisma.execute_raw(chunk_insertion_query)
 
@@ -91,5 +189,58 @@ def test_schema():
     prisma.disconnect()
     print("schema.py: All tests passed!")
 
+def test_chunk_batch():
+    embeddings = np.arange(6, dtype=DTYPE).reshape(3, 2)
+    batch = ChunkBatch(ids=["a", "b", "c"], document_ids=["doc"] * 3, contents=["x", "y", "z"], topics=[["t"], [], []], embeddings=embeddings)
+    chunks = batch.to_chunks()
+    assert [chunk.index_in_doc for chunk in chunks] == [0, 1, 2] and chunks[1].embedding.tolist() == [2, 3]
+    assert ChunkBatch.from_chunks(chunks).column("topics") == [["t"], [], []]
+
+    merged = ChunkBatch.concat([batch, ChunkBatch(), ChunkBatch.from_chunks(chunks[:1])])
+    assert len(merged) == 4 and merged.embeddings.shape == (4, 2) and merged.ids[3] == "a"
+    assert ChunkBatch(ids=["a"]).column("embedding") == [None]
+    print("schema.py: ChunkBatch tests passed!")
+
+def benchmark_chunk_memory(count: int = 5000, dimensions: int = 1536):
+    """Bytes and construction time per chunk for list-backed `Chunk`s, array-backed `Chunk`s and a `ChunkBatch`."""
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((count, dimensions)).astype(DTYPE)
+    contents = [f"chunk {i} " * 50 for i in range(count)]
+    ids = [get_chunk_id(content) for content in contents]
+
+    def build_list_chunks():
+        # the old representation: every float boxed, as the JSON response used to be, and validated by pydantic
+        class ListChunk(BaseModel):
+            id: str
+            document_id: Optional[str] = None
+            index_in_doc: int
+            embedding: Optional[List[float]] = None
+            content: str
+            surrounding_content: Optional[str] = ''
+            topics: List[str] = []
+            type: Optional[str] = None
+        return [ListChunk(id=ids[i], document_id="doc", index_in_doc=i, embedding=embeddings[i].tolist(), content=contents[i], topics=["topic"]) for i in range(count)]
+
+    def build_array_chunks():
+        return [Chunk(id=ids[i], document_id="doc", index_in_doc=i, embedding=embeddings[i].copy(), content=contents[i], topics=["topic"]) for i in range(count)]
+
+    def build_batch():
+        return ChunkBatch(ids=list(ids), document_ids=["doc"] * count, contents=list(contents), topics=[["topic"] for _ in range(count)], embeddings=embeddings.copy())
+
+    for name, build in (("List[float] Chunk", build_list_chunks), ("float32 Chunk", build_array_chunks), ("ChunkBatch", build_batch)):
+        start = time.perf_counter()
+        built = build()
+        elapsed = time.perf_counter() - start
+        del built
+        # measured separately, since tracing every allocation slows the build down
+        tracemalloc.start()
+        built = build()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del built
+        print(f"{name:>18}: {size / count:8.0f} bytes/chunk, {elapsed / count * 1e6:7.1f}µs/chunk to build")
+
 if __name__ == "__main__":
+    test_chunk_batch()
+    benchmark_chunk_memory()
     test_schema()
\ No newline at end of file
@@ -0,0 +1,176 @@
+import time
+from typing import Tuple
+
+import numpy as np
+
+from vectors import DTYPE, as_matrix, as_vector
+
+# rows scored per block by the chunked functions, which bounds their scratch memory to
+# about block_size * (number of queries) floats however large the matrix is
+BLOCK_SIZE = 8192
+
+def normalize(vectors) -> np.ndarray:
+    """Scales vectors (or the rows of a matrix) to unit length; zero vectors stay zero."""
+    vectors = np.asarray(vectors, dtype=DTYPE)
+    norms = np.sqrt(np.einsum("...i,...i->...", vectors, vectors))[..., None]
+    return vectors / np.maximum(norms, 1e-12)
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the `k` highest scores, best first."""
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+def cosine_similarity(vec1, vec2) -> float:
+    vec1, vec2 = as_vector(vec1), as_vector(vec2)
+    magnitude = float(np.linalg.norm(vec1) * np.linalg.norm(vec2))
+    if magnitude == 0:
+        return 0.0
+    return float(vec1 @ vec2) / magnitude
+
+def dot_one_vs_many(query, matrix) -> np.ndarray:
+    return as_matrix(matrix) @ as_vector(query)
+
+def cosine_one_vs_many(query, matrix, normalized: bool = False) -> np.ndarray:
+    """Cosine similarity of `query` to every row of `matrix`. Pass `normalized` when the rows already have unit length."""
+    matrix = as_matrix(matrix)
+    query = normalize(as_vector(query))
+    if normalized:
+        return matrix @ query
+    scores = np.empty(len(matrix), dtype=DTYPE)
+    for start in range(0, len(matrix), BLOCK_SIZE):
+        block = matrix[start:start + BLOCK_SIZE]
+        norms = np.sqrt(np.einsum("ij,ij->i", block, block))
+        scores[start:start + BLOCK_SIZE] = (block @ query) / np.maximum(norms, 1e-12)
+    return scores
+
+def cosine_many_vs_many(queries, matrix, normalized: bool = False) -> np.ndarray:
+    """The full (queries, rows) cosine similarity matrix. For large inputs use `top_k_many` instead."""
+    queries = normalize(as_matrix(queries))
+    matrix = as_matrix(matrix)
+    return queries @ (matrix if normalized else normalize(matrix)).T
+
+def top_k_many(queries, matrix, k: int = 10, metric: str = "cosine", normalized: bool = False, block_size: int = BLOCK_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The `k` best rows of `matrix` for each query, as (indices, scores) arrays of shape (queries, k),
+    best first. The matrix is scored `block_size` rows at a time and only the running best `k` per
+    query are kept, so the full similarity matrix never exists.
+    """
+    if metric not in ("cosine", "dot"):
+        raise ValueError(f"Unsupported metric {metric}")
+    queries = as_matrix(queries)
+    matrix = as_matrix(matrix)
+    if metric == "cosine":
+        queries = normalize(queries)
+    k = min(k, len(matrix))
+    best_indices = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=DTYPE)
+    for start in range(0, len(matrix), block_size):
+        block = matrix[start:start + block_size]
+        if metric == "cosine" and not normalized:
+            block = normalize(block)
+        scores = np.concatenate([best_scores, queries @ block.T], axis=1)
+        indices = np.concatenate([best_indices, np.broadcast_to(np.arange(start, start + len(block)), (len(queries), len(block)))], axis=1)
+        if scores.shape[1] > k:
+            keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            scores = np.take_along_axis(scores, keep, axis=1)
+            indices = np.take_along_axis(indices, keep, axis=1)
+        best_scores, best_indices = scores, indices
+    order = np.argsort(-best_scores, axis=1, kind="stable")
+    return np.take_along_axis(best_indices, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+class NormalizedVectors:
+    """
+    A float32 matrix whose rows are normalized once when added, so cosine similarity against it is
+    a single matrix product. Grows by doubling its capacity, for callers that add rows as they go.
+    """
+    def __init__(self, dimensions: int, capacity: int = 1024):
+        self.matrix = np.empty((capacity, dimensions), dtype=DTYPE)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self.matrix[:self.size]
+
+    def add(self, vectors) -> np.ndarray:
+        """Adds rows, returning their indices."""
+        vectors = normalize(as_matrix(vectors, self.matrix.shape[1]))
+        if self.size + len(vectors) > len(self.matrix):
+            grown = np.empty((max(2 * len(self.matrix), self.size + len(vectors)), self.matrix.shape[1]), dtype=DTYPE)
+            grown[:self.size] = self.vectors
+            self.matrix = grown
+        self.matrix[self.size:self.size + len(vectors)] = vectors
+        self.size += len(vectors)
+        return np.arange(self.size - len(vectors), self.size)
+
+    def cosine(self, query) -> np.ndarray:
+        return cosine_one_vs_many(query, self.vectors, normalized=True)
+
+    def top_k(self, queries, k: int = 10) -> Tuple[np.ndarray, np.ndarray]:
+        return top_k_many(queries, self.vectors, k, normalized=True)
+
+def test_similarity():
+    rng = np.random.default_rng(0)
+    matrix = rng.standard_normal((1000, 32)).astype(DTYPE)
+    queries = rng.standard_normal((3, 32)).astype(DTYPE)
+
+    scores = cosine_one_vs_many(queries[0], matrix)
+    assert np.isclose(scores[7], cosine_similarity(queries[0], matrix[7]), atol=1e-5)
+    assert np.allclose(cosine_many_vs_many(queries, matrix)[0], scores, atol=1e-5)
+    assert np.allclose(dot_one_vs_many(queries[0], matrix), matrix @ queries[0], atol=1e-4)
+    assert cosine_similarity([0, 0], [1, 0]) == 0.0
+
+    indices, top_scores = top_k_many(queries, matrix, k=5, block_size=64)
+    assert indices.shape == (3, 5) and list(indices[0]) == list(top_k(scores, 5)), "Expected the chunked top-k to match the exact one"
+    assert np.all(np.diff(top_scores, axis=1) <= 0)
+
+    store = NormalizedVectors(32, capacity=4)
+    store.add(matrix[:10])
+    store.add(matrix[10:20])
+    assert len(store) == 20 and np.allclose(store.cosine(queries[0]), scores[:20], atol=1e-5)
+    print("similarity.py: All tests passed!")
+
+def benchmark_similarity(count: int = 100000, dimensions: int = 1536, queries: int = 16, python_pairs: int = 200):
+    """The old pure-Python pairwise cosine against the vectorized functions on a 10^5 x 1536 matrix."""
+    rng = np.random.default_rng(0)
+    matrix = rng.standard_normal((count, dimensions)).astype(DTYPE)
+    query_matrix = rng.standard_normal((queries, dimensions)).astype(DTYPE)
+
+    def python_cosine(vec1, vec2):
+        dot_product = sum(p*q for p, q in zip(vec1, vec2))
+        magnitude_vec1 = sum(p**2 for p in vec1) ** 0.5
+        magnitude_vec2 = sum(q**2 for q in vec2) ** 0.5
+        if magnitude_vec1 == 0 or magnitude_vec2 == 0:
+            return 0.0
+        return dot_product / (magnitude_vec1 * magnitude_vec2)
+
+    # too slow to run on every row, so timed on a few pairs and extrapolated
+    query_list = query_matrix[0].tolist()
+    rows = [row.tolist() for row in matrix[:python_pairs]]
+    start = time.perf_counter()
+    for row in rows:
+        python_cosine(query_list, row)
+    python_seconds = (time.perf_counter() - start) / python_pairs * count
+    print(f"pure Python, one vs {count}:  {python_seconds:9.3f}s (extrapolated from {python_pairs} pairs)")
+
+    start = time.perf_counter()
+    cosine_one_vs_many(query_matrix[0], matrix)
+    print(f"cosine_one_vs_many:          {time.perf_counter() - start:9.3f}s")
+
+    store = NormalizedVectors(dimensions, capacity=count)
+    store.add(matrix)
+    start = time.perf_counter()
+    store.cosine(query_matrix[0])
+    print(f"pre-normalized, one vs many: {time.perf_counter() - start:9.3f}s")
+
+    start = time.perf_counter()
+    top_k_many(query_matrix, store.vectors, k=10, normalized=True)
+    print(f"top_k_many, {queries} vs {count}:   {time.perf_counter() - start:9.3f}s ({queries * python_seconds:.0f}s in pure Python)")
+
+if __name__ == "__main__":
+    test_similarity()
+    benchmark_similarity()
@@ -0,0 +1,278 @@
+import io
+import re
+import time
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from utils import count_tokens
+
+# a sentence runs up to and including its closing punctuation, or to the end of the line. Punctuation
+# opening a line ("...and then") stays with the sentence after it, and a line of only punctuation is
+# a sentence of its own, so no character is ever left out
+_SENTENCE = re.compile(r"[.!?]*[^.!?]+(?:[.!?]+|$)|[.!?]+")
+_WORD = re.compile(r"\S+")
+# what `str.split()` splits on
+_WHITESPACE_CODE_POINTS = np.array([code for code in range(0x3001) if chr(code).isspace()], dtype=np.uint32)
+
+class TextSpan(NamedTuple):
+    """A piece of a text and where it sits in it, `text == source[start:end]`."""
+    text: str
+    start: int
+    end: int
+
+class _Unit(NamedTuple):
+    start: int
+    end: int
+    tokens: int
+
+class TokenSplitter:
+    """
+    Splits text into pieces of at most `max_tokens` tokens for the LLM, cutting only between
+    paragraphs (lines) where it can, between sentences when a paragraph is too long on its own,
+    between words only for a sentence longer than the budget, and inside a word only for a word
+    (a long url, say) longer than the budget. Paragraphs and sentences are packed
+    greedily, and each piece can repeat up to `overlap_tokens` of whole units from the end of the
+    previous one, so a fact at a seam is seen whole at least once.
+
+    `split` takes a string or any iterable of lines, and yields pieces as it goes while holding only
+    the current piece in memory, so it can stream over documents of any size.
+    """
+    def __init__(self, max_tokens: int = 3000, overlap_tokens: int = 0, count: Callable[[str], int] = count_tokens):
+        if overlap_tokens >= max_tokens:
+            raise ValueError(f"overlap_tokens ({overlap_tokens}) must be less than max_tokens ({max_tokens})")
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.count = count
+
+    def _units(self, line: str, offset: int) -> Iterator[_Unit]:
+        # the +1 leaves room for the separator that joins each unit to the previous one
+        stripped = line.strip()
+        if not stripped:
+            return
+        start = offset + len(line) - len(line.lstrip())
+        tokens = self.count(stripped) + 1
+        if tokens <= self.max_tokens:
+            yield _Unit(start, start + len(stripped), tokens)
+            return
+        for sentence in _SENTENCE.finditer(line):
+            text = sentence.group().strip()
+            if not text:
+                continue
+            sentence_start = offset + sentence.start() + len(sentence.group()) - len(sentence.group().lstrip())
+            tokens = self.count(text) + 1
+            if tokens <= self.max_tokens:
+                yield _Unit(sentence_start, sentence_start + len(text), tokens)
+                continue
+            for word in _WORD.finditer(text):
+                yield from self._word_units(word.group(), sentence_start + word.start())
+
+    def _word_units(self, word: str, start: int) -> Iterator[_Unit]:
+        tokens = self.count(word) + 1
+        if tokens <= self.max_tokens:
+            yield _Unit(start, start + len(word), tokens)
+            return
+        # cut between characters, guessing each piece's length from the word's characters per token
+        # and halving it until the piece fits
+        guess = max(1, len(word) * (self.max_tokens - 1) // (tokens - 1))
+        offset = 0
+        while offset < len(word):
+            end = min(len(word), offset + guess)
+            while end - offset > 1 and self.count(word[offset:end]) + 1 > self.max_tokens:
+                end = offset + (end - offset) // 2
+            yield _Unit(start + offset, start + end, self.count(word[offset:end]) + 1)
+            offset = end
+
+    def split(self, text: Union[str, Iterable[str]]) -> Iterator[TextSpan]:
+        lines = io.StringIO(text) if isinstance(text, str) else text
+        # the source text from `buffer_start` on, trimmed every time a piece is emitted
+        buffer = ""
+        buffer_start = 0
+        offset = 0
+        window: List[_Unit] = []
+        window_tokens = 0
+
+        def emit() -> TextSpan:
+            start, end = window[0].start, window[-1].end
+            return TextSpan(buffer[start - buffer_start:end - buffer_start], start, end)
+
+        for line in lines:
+            buffer += line
+            for unit in self._units(line, offset):
+                if window and window_tokens + unit.tokens > self.max_tokens:
+                    yield emit()
+                    # carry whole units from the end of this piece into the next one, within the overlap
+                    kept = []
+                    kept_tokens = 0
+                    for previous in reversed(window):
+                        if kept_tokens + previous.tokens > self.overlap_tokens:
+                            break
+                        kept.insert(0, previous)
+                        kept_tokens += previous.tokens
+                    while kept and kept_tokens + unit.tokens > self.max_tokens:
+                        kept_tokens -= kept.pop(0).tokens
+                    window, window_tokens = kept, kept_tokens
+                    trim_to = window[0].start if window else unit.start
+                    buffer = buffer[trim_to - buffer_start:]
+                    buffer_start = trim_to
+                window.append(unit)
+                window_tokens += unit.tokens
+            offset += len(line)
+        if window:
+            yield emit()
+
+def split_text(text: Union[str, Iterable[str]], max_tokens: int = 3000, overlap_tokens: int = 0) -> List[str]:
+    return [span.text for span in TokenSplitter(max_tokens, overlap_tokens).split(text)]
+
+class TextAligner:
+    """
+    Finds pieces copied out of a text (like the chunks the LLM returns) in it, ignoring whitespace,
+    since the model often turns newlines into spaces or drops a space between sentences.
+
+    The text is indexed once with its whitespace removed, along with the offset of every remaining
+    character in the original, so a match is found with one `str.find` and mapped back to an exact
+    span. `align` searches forward from where the previous piece of the same part ended, so pieces
+    returned in order cost one pass over the text between them, and a repeated passage matches the
+    occurrence after the previous piece rather than always the first one.
+    """
+    def __init__(self, text: str):
+        self.text = text
+        self.normalized = "".join(text.split())
+        # offset in `text` of each character of `normalized`: the positions of the non-whitespace code points
+        code_points = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+        self.offsets = np.flatnonzero(~np.isin(code_points, _WHITESPACE_CODE_POINTS))
+
+    def _normalized_index(self, offset: int) -> int:
+        return int(np.searchsorted(self.offsets, offset))
+
+    def align(self, pieces: Sequence[str], within: Optional[TextSpan] = None) -> List[Optional[Tuple[int, int]]]:
+        """
+        The (start, end) span in the text of each piece, or None for a piece that isn't in it.
+        Pieces are looked for in `within` (e.g. the part of the text they were extracted from), in
+        order, then anywhere in it, then anywhere in the text.
+        """
+        start = self._normalized_index(within.start) if within else 0
+        end = self._normalized_index(within.end) if within else len(self.normalized)
+        cursor = start
+        spans = []
+        for piece in pieces:
+            needle = "".join(piece.split())
+            if not needle:
+                spans.append(None)
+                continue
+            index = self.normalized.find(needle, cursor, end)
+            if index < 0:
+                index = self.normalized.find(needle, start, end)
+            if index < 0:
+                index = self.normalized.find(needle)
+            if index < 0:
+                spans.append(None)
+                continue
+            if start <= index < end:
+                cursor = index + len(needle)
+            spans.append((int(self.offsets[index]), int(self.offsets[index + len(needle) - 1]) + 1))
+        return spans
+
+def test_token_splitter():
+    words = lambda text: len(text.split())
+    text = "First paragraph. It has two sentences.\nSecond paragraph is here.\n\nThird one, which is a little longer than the others. And a second sentence!\nFourth."
+    splitter = TokenSplitter(max_tokens=12, count=words)
+    spans = list(splitter.split(text))
+    assert all(text[span.start:span.end] == span.text for span in spans), "Expected spans to point back into the text"
+    assert all(words(span.text) + span.text.count("\n") <= 12 for span in spans)
+    assert spans[0].text == "First paragraph. It has two sentences.\nSecond paragraph is here."
+    assert "Third one, which is a little longer than the others." in [span.text for span in spans], "Expected a long paragraph to be split between sentences"
+    assert " ".join(" ".join(span.text.split()) for span in spans).split() == text.split(), "Expected every word exactly once without overlap"
+
+    # streaming lines gives the same pieces as the whole string
+    assert list(splitter.split(io.StringIO(text))) == spans
+
+    overlapping = list(TokenSplitter(max_tokens=20, overlap_tokens=6, count=words).split(text))
+    assert len(overlapping) > len(list(TokenSplitter(max_tokens=20, count=words).split(text))) and overlapping[1].text.startswith("Second paragraph is here."), "Expected the last paragraph of a piece to open the next one"
+
+    long_sentence = " ".join(["word"] * 50)
+    assert all(words(piece) <= 11 for piece in split_text(long_sentence, max_tokens=12)), "Expected a sentence over budget to be split between words"
+    assert split_text("") == [] and split_text("\n\n") == []
+
+    leading = "...abc def ghi jkl mno.\n?!"
+    pieces = [span.text for span in TokenSplitter(max_tokens=3, count=words).split(leading)]
+    assert "".join("".join(pieces).split()) == "".join(leading.split()), f"Expected punctuation opening or making up a line to be kept, got {pieces}"
+
+    characters = lambda text: (len(text) + 3) // 4
+    url = "https://www.sos.state.example.gov/elections/" + "a" * 200
+    pieces = [span.text for span in TokenSplitter(max_tokens=4, count=characters).split(f"Visit {url} today")]
+    assert all(characters(piece) + 1 <= 4 for piece in pieces), f"Expected a word over budget to be cut to fit, got {pieces}"
+    assert "".join("".join(pieces).split()) == f"Visit{url}today"
+    print("split.py: All tests passed!")
+
+def test_text_aligner():
+    text = "Voting hours\nPolls are open 7am to 8pm.  Bring an ID.\nPolls are open 7am to 8pm.  Bring an ID.\nCall   your county clerk."
+    aligner = TextAligner(text)
+    first, second, clerk, missing = aligner.align(["Polls are open 7am to 8pm. Bring an ID.", "Polls are open 7am to 8pm.Bring an ID.", "Call your county\nclerk.", "Not in the page at all."])
+    assert text[first[0]:first[1]] == "Polls are open 7am to 8pm.  Bring an ID." and first[0] == text.index("Polls")
+    assert second[0] == text.rindex("Polls"), "Expected a repeated passage to match its next occurrence"
+    assert text[clerk[0]:clerk[1]] == "Call   your county clerk."
+    assert missing is None
+
+    # within a part, pieces are matched in that part even when the same text appears earlier
+    second_start = text.rindex("Polls")
+    later = TextSpan(text[second_start:], second_start, len(text))
+    assert aligner.align(["Polls are open 7am to 8pm."], within=later)[0][0] == text.rindex("Polls")
+    assert aligner.align(["Voting hours"], within=later)[0] == (0, 12), "Expected a piece outside its part to be found anywhere"
+    print("split.py: TextAligner tests passed!")
+
+def benchmark_text_aligner(paragraphs: int = 2000, chunks: int = 400):
+    """`str.find` per chunk, as `get_chunks` used to, against `TextAligner` on a long page."""
+    import random
+    rng = random.Random(0)
+    words = ["vote", "ballot", "register", "county", "election", "deadline", "absentee", "polling", "official", "state"]
+    sentences = [" ".join(rng.choices(words, k=rng.randint(10, 30))) + "." for _ in range(paragraphs)]
+    text = "\n".join(sentences)
+    picked = sorted(rng.sample(range(paragraphs), chunks))
+    # what the model sends back: the same sentences with their whitespace changed
+    pieces = [sentences[i].replace(" ", "  ", 1) for i in picked]
+
+    start = time.perf_counter()
+    found = sum(1 for piece in pieces if text.find(piece) >= 0)
+    old = time.perf_counter() - start
+    start = time.perf_counter()
+    aligned = sum(1 for span in TextAligner(text).align(pieces) if span)
+    new = time.perf_counter() - start
+    print(f"{len(text)} characters, {chunks} chunks with altered whitespace")
+    print(f"str.find:    {1000 * old:7.2f} ms, {found} found")
+    print(f"TextAligner: {1000 * new:7.2f} ms, {aligned} found")
+
+def benchmark_splitter(corpus_dir: Optional[str] = None, max_tokens: int = 3000, system_prompt_tokens: int = 250):
+    """
+    LLM calls per page and total prompt tokens for `LLMDataCleaner.get_chunks`, with the old
+    split by halving at 3000 characters against `TokenSplitter`, over the clean text of a page corpus.
+    `system_prompt_tokens` is about the size of the cleaner's system prompt, which every call resends.
+    """
+    import glob
+    import os
+    from parse import _synthetic_corpus, parse_html
+
+    def halving_split(text, limit=3000):
+        if len(text) <= limit:
+            return [text]
+        midpoint = len(text) // 2
+        return halving_split(text[:midpoint], limit) + halving_split(text[midpoint:], limit)
+
+    if corpus_dir:
+        corpus = [open(path, "rb").read() for path in sorted(glob.glob(os.path.join(corpus_dir, "*.html")))]
+    else:
+        corpus = _synthetic_corpus()
+    texts = [parse_html(html).clean_text for html in corpus]
+    splitter = TokenSplitter(max_tokens)
+    for name, split in [("halving at 3000 chars", halving_split), (f"TokenSplitter({max_tokens})", lambda text: [span.text for span in splitter.split(text)])]:
+        parts = [split(text) for text in texts]
+        calls = sum(len(page_parts) for page_parts in parts)
+        tokens = sum(system_prompt_tokens + count_tokens(part) for page_parts in parts for part in page_parts)
+        cut = sum(1 for page_parts in parts for part in page_parts[:-1] if not part.rstrip().endswith((".", "!", "?")))
+        print(f"{name:24s} {calls / len(texts):6.2f} calls/page, {tokens:9d} prompt tokens, {cut} pieces ending mid-sentence")
+
+if __name__ == "__main__":
+    test_token_splitter()
+    test_text_aligner()
+    benchmark_splitter()
+    benchmark_text_aligner()
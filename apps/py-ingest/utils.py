@@ -1,5 +1,7 @@
 import hashlib
+import logging
 import uuid
+from functools import lru_cache
 
 
 def get_document_id(url):
@@ -11,4 +13,25 @@ def get_chunk_id(contents):
     return chunk_id
 
 def get_uuid():
-    return str(uuid.uuid4())
\ No newline at end of file
+    return str(uuid.uuid4())
+
+def estimate_tokens(text):
+    # OpenAI's rule of thumb for English is ~4 characters per token; round up so budgets stay safe
+    return len(text) // 4 + 1
+
+@lru_cache(maxsize=4)
+def get_encoding(name: str = "cl100k_base"):
+    # tiktoken downloads the encoding the first time it's used, which fails on hosts without internet
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        logging.warning(f"Could not load the {name} tokenizer, estimating token counts instead: {e}")
+        return None
+
+def count_tokens(text, encoding: str = "cl100k_base"):
+    """Exact token count with the GPT-3.5/GPT-4 tokenizer, falling back to `estimate_tokens` without it."""
+    tokenizer = get_encoding(encoding)
+    if tokenizer is None:
+        return estimate_tokens(text)
+    return len(tokenizer.encode(text, disallowed_special=()))
@@ -0,0 +1,351 @@
+import json
+import logging
+import os
+import time
+from threading import RLock
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from similarity import normalize, top_k
+from vectors import DTYPE, as_matrix, as_vector
+
+def quantize(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-vector int8 quantization; `vectors ≈ codes * scales[:, None]`."""
+    scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(DTYPE)
+
+def train_centroids(vectors: np.ndarray, n_lists: int, iterations: int = 8, sample_size: int = 32, seed: int = 0) -> np.ndarray:
+    """Spherical k-means on a sample of at most `sample_size` vectors per list."""
+    rng = np.random.default_rng(seed)
+    sample = vectors[np.sort(rng.choice(len(vectors), min(len(vectors), n_lists * sample_size), replace=False))]
+    sample = np.asarray(sample, dtype=DTYPE)
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        # sum each list's members with one sort and reduceat; np.add.at is far slower at this width
+        order = np.argsort(assignments, kind="stable")
+        starts = np.searchsorted(assignments[order], np.arange(n_lists))
+        sums = np.zeros_like(centroids)
+        filled = np.bincount(assignments, minlength=n_lists) > 0
+        sums[filled] = np.add.reduceat(sample[order], starts[filled])
+        empty = ~filled
+        # restart empty lists from random points instead of letting them die
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids
+
+class VectorIndex:
+    """
+    An on-disk IVF index over unit-normalized vectors, scored by cosine similarity.
+
+    Rows are appended to flat files under `path` (ids, float32 or int8 vectors plus per-row int8
+    scales, and the inverted list each row belongs to), which are memory-mapped for search, so
+    loading an index reads almost nothing and `add` is cheap enough to call from the ingest
+    pipeline. Until the index holds `exact_below` vectors every search is an exact brute-force
+    scan. After that, k-means centroids are trained and a search only scores the rows in the
+    `n_probe` lists closest to the query. Centroids are retrained whenever the index has grown
+    `retrain_factor` times since they were last trained. Adding an id again replaces its vector.
+    """
+    def __init__(self, path: str, dimensions: int = 1536, dtype: str = "float32", exact_below: int = 20000, n_probe: int = 16, retrain_factor: float = 4.0):
+        if dtype not in ("float32", "int8"):
+            raise ValueError(f"Unsupported index dtype {dtype}")
+        self.path = path
+        self.exact_below = exact_below
+        self.n_probe = n_probe
+        self.retrain_factor = retrain_factor
+        self.lock = RLock()
+        os.makedirs(path, exist_ok=True)
+
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as file:
+                meta = json.load(file)
+        else:
+            meta = {"dimensions": dimensions, "dtype": dtype, "trained_count": 0}
+        self.dimensions = meta["dimensions"]
+        self.dtype = meta["dtype"]
+        self.trained_count = meta["trained_count"]
+        self.centroids = np.load(self._file("centroids.npy")) if self.trained_count else None
+
+        ids = []
+        if os.path.exists(self._file("ids.txt")):
+            with open(self._file("ids.txt")) as file:
+                content = file.read()
+            ids = content.splitlines()
+            if not content.endswith("\n") and ids:
+                # half written when the process died
+                ids.pop()
+        # `add` appends to the row files before ids.txt, so rows past the last id belong to an add that never finished
+        count = min([len(ids)] + [os.path.getsize(self._file(name)) // row_size for name, row_size in self._row_files() if os.path.exists(self._file(name))])
+        self._truncate(ids[:count])
+
+        self.ids: List[str] = []
+        self.rows: Dict[str, int] = {}
+        for id in ids[:count]:
+            self._track(id)
+        self.live = np.ones(len(self.ids), dtype=bool)
+        for row, id in enumerate(self.ids):
+            if self.rows[id] != row:
+                self.live[row] = False
+        self._maps = None
+        self._lists = None
+        self._write_meta()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _row_files(self) -> List[Tuple[str, int]]:
+        """The files holding one fixed-size record per row, with the size of a record in bytes."""
+        if self.dtype == "int8":
+            return [("vectors.bin", self.dimensions), ("scales.bin", 4), ("lists.bin", 4)]
+        return [("vectors.bin", self.dimensions * 4), ("lists.bin", 4)]
+
+    def _truncate(self, ids: List[str]):
+        with open(self._file("ids.txt"), "a") as file:
+            file.truncate(sum(len(id.encode("utf-8")) + 1 for id in ids))
+        for name, row_size in self._row_files():
+            with open(self._file(name), "ab") as file:
+                file.truncate(len(ids) * row_size)
+
+    def _track(self, id: str) -> Optional[int]:
+        """Records a new row for `id`, returning the row it replaces."""
+        replaced = self.rows.get(id)
+        self.rows[id] = len(self.ids)
+        self.ids.append(id)
+        return replaced
+
+    def _write_meta(self):
+        with open(self._file("meta.json"), "w") as file:
+            json.dump({"dimensions": self.dimensions, "dtype": self.dtype, "trained_count": self.trained_count}, file)
+
+    def __len__(self):
+        return int(self.live.sum())
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def _memmap(self, name: str, dtype, shape) -> np.ndarray:
+        if not shape[0]:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self._file(name), dtype=dtype, mode="r", shape=shape)
+
+    def _mapped(self):
+        """Memory maps of (vectors, scales, lists), reopened after every write."""
+        if self._maps is None:
+            count = len(self.ids)
+            vectors = self._memmap("vectors.bin", np.int8 if self.dtype == "int8" else DTYPE, (count, self.dimensions))
+            scales = self._memmap("scales.bin", DTYPE, (count,)) if self.dtype == "int8" else None
+            lists = self._memmap("lists.bin", np.int32, (count,))
+            self._maps = (vectors, scales, lists)
+        return self._maps
+
+    def _score(self, rows, query: np.ndarray) -> np.ndarray:
+        """Scores of `rows` for one query, or a (rows, queries) matrix of them for several."""
+        vectors, scales, _ = self._mapped()
+        if self.dtype == "float32":
+            return vectors[rows] @ query.T
+        return (vectors[rows].astype(DTYPE) @ query.T) * (scales[rows] if query.ndim == 1 else scales[rows, None])
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def add(self, ids: Sequence[str], vectors) -> None:
+        vectors = normalize(as_matrix(vectors, self.dimensions))
+        if len(ids) != len(vectors):
+            raise ValueError(f"Expected {len(ids)} vectors, got {len(vectors)}")
+        if not len(ids):
+            return
+        if not self.ids and vectors.shape[1] != self.dimensions:
+            # an empty index takes the dimensions of whatever is added first
+            self.dimensions = vectors.shape[1]
+            self._write_meta()
+        if vectors.shape[1] != self.dimensions:
+            raise ValueError(f"Expected {self.dimensions}-dimensional vectors, got {vectors.shape[1]}")
+        with self.lock:
+            lists = self._assign(vectors) if self.trained else np.full(len(vectors), -1, dtype=np.int32)
+            with open(self._file("vectors.bin"), "ab") as file:
+                if self.dtype == "int8":
+                    codes, scales = quantize(vectors)
+                    file.write(codes.tobytes())
+                    with open(self._file("scales.bin"), "ab") as scales_file:
+                        scales_file.write(scales.tobytes())
+                else:
+                    file.write(vectors.tobytes())
+            with open(self._file("lists.bin"), "ab") as file:
+                file.write(lists.tobytes())
+            with open(self._file("ids.txt"), "a") as file:
+                file.write("".join(f"{id}\n" for id in ids))
+
+            live = np.ones(len(ids), dtype=bool)
+            for id in ids:
+                replaced = self._track(id)
+                if replaced is None:
+                    continue
+                if replaced >= len(self.live):
+                    live[replaced - len(self.live)] = False
+                else:
+                    self.live[replaced] = False
+            self.live = np.concatenate([self.live, live])
+            self._maps = None
+            self._lists = None
+
+            if len(self) >= self.exact_below and (not self.trained or len(self) >= self.trained_count * self.retrain_factor):
+                self.train()
+
+    def train(self, n_lists: Optional[int] = None) -> None:
+        """(Re)trains the centroids on the live vectors and reassigns every row to its closest list."""
+        with self.lock:
+            vectors, scales, _ = self._mapped()
+            live_rows = np.flatnonzero(self.live)
+            n_lists = n_lists or max(1, min(len(live_rows) // 39, int(2 * np.sqrt(len(live_rows)))))
+            start = time.perf_counter()
+            sample = vectors[live_rows] if self.dtype == "float32" else vectors[live_rows].astype(DTYPE) * scales[live_rows, None]
+            self.centroids = train_centroids(sample, n_lists)
+            lists = np.empty(len(self.ids), dtype=np.int32)
+            # assign in blocks so an int8 index is never fully expanded to float32 at once
+            for block in range(0, len(self.ids), 65536):
+                rows = slice(block, block + 65536)
+                block_vectors = vectors[rows] if self.dtype == "float32" else vectors[rows].astype(DTYPE) * scales[rows, None]
+                lists[rows] = self._assign(block_vectors)
+            np.save(self._file("centroids.npy"), self.centroids)
+            with open(self._file("lists.bin"), "wb") as file:
+                file.write(lists.tobytes())
+            self.trained_count = len(live_rows)
+            self._write_meta()
+            self._maps = None
+            self._lists = None
+            logging.info(f"VectorIndex: Trained {n_lists} lists over {len(live_rows)} vectors in {time.perf_counter() - start:.1f}s")
+
+    def _inverted_lists(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Rows grouped by list, and where each list starts within them."""
+        if self._lists is None:
+            _, _, lists = self._mapped()
+            lists = np.where(self.live, lists, -1)
+            order = np.argsort(lists, kind="stable")
+            bounds = np.searchsorted(lists[order], np.arange(len(self.centroids) + 1))
+            self._lists = (order, bounds)
+        return self._lists
+
+    def search(self, query, k: int = 20, n_probe: Optional[int] = None, exact: bool = False, ids: Optional[Sequence[str]] = None) -> List[Tuple[str, float]]:
+        """The `k` closest ids to `query` with their cosine similarity, best first."""
+        return self.search_many(as_vector(query)[None, :], k, n_probe, exact, ids)[0]
+
+    def search_many(self, queries, k: int = 20, n_probe: Optional[int] = None, exact: bool = False, ids: Optional[Sequence[str]] = None) -> List[List[Tuple[str, float]]]:
+        """
+        Searches for several queries at once. When `ids` is given only those ids are candidates,
+        e.g. the chunks matching a metadata filter. Up to `exact_below` of them are all scored
+        exactly, in one product for every query. More are filtered inside the IVF scan by a row mask,
+        falling back to scoring every candidate for a query whose probed lists hold fewer than `k`.
+        """
+        queries = normalize(as_matrix(queries, self.dimensions))
+        with self.lock:
+            if not len(self):
+                return [[] for _ in queries]
+            mask = None
+            if ids is not None:
+                candidates = np.fromiter((self.rows[id] for id in set(ids) if id in self.rows), dtype=np.int64)
+                if not len(candidates):
+                    return [[] for _ in queries]
+                candidates.sort()
+                if exact or not self.trained or len(candidates) <= self.exact_below:
+                    scores = self._score(candidates, queries).T
+                    return [[(self.ids[candidates[i]], float(query_scores[i])) for i in top_k(query_scores, k)] for query_scores in scores]
+                mask = np.zeros(len(self.ids), dtype=bool)
+                mask[candidates] = True
+            elif exact or not self.trained or len(self) < self.exact_below:
+                return [self._exact(query, k) for query in queries]
+            order, bounds = self._inverted_lists()
+            n_probe = min(n_probe or self.n_probe, len(self.centroids))
+            results = []
+            for query in queries:
+                probed = top_k(self.centroids @ query, n_probe)
+                rows = np.concatenate([order[bounds[list_id]:bounds[list_id + 1]] for list_id in probed])
+                if mask is not None:
+                    rows = rows[mask[rows]]
+                    if len(rows) < k:
+                        rows = candidates
+                if not len(rows):
+                    results.append([])
+                    continue
+                rows.sort()
+                scores = self._score(rows, query)
+                best = top_k(scores, k)
+                results.append([(self.ids[rows[i]], float(scores[i])) for i in best])
+            return results
+
+    def _exact(self, query: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        vectors, _, _ = self._mapped()
+        scores = np.empty(len(vectors), dtype=DTYPE)
+        for block in range(0, len(vectors), 65536):
+            rows = slice(block, block + 65536)
+            scores[rows] = self._score(rows, query)
+        scores[~self.live] = -np.inf
+        best = top_k(scores, min(k, len(self)))
+        return [(self.ids[i], float(scores[i])) for i in best]
+
+def test_vector_index():
+    import tempfile
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((300, 16)).astype(DTYPE)
+    ids = [f"chunk-{i}" for i in range(300)]
+    for dtype in ("float32", "int8"):
+        path = tempfile.mkdtemp()
+        index = VectorIndex(path, dimensions=16, dtype=dtype, exact_below=200)
+        index.add(ids[:100], vectors[:100])
+        assert not index.trained and index.search(vectors[5], k=1)[0][0] == "chunk-5"
+        index.add(ids[100:], vectors[100:])
+        assert index.trained, "Expected the index to train once it grew past exact_below"
+        assert index.search(vectors[250], k=3, n_probe=len(index.centroids))[0][0] == "chunk-250"
+
+        # re-adding an id replaces its vector, and everything survives a reload
+        index.add(["chunk-0"], vectors[1:2])
+        reloaded = VectorIndex(path)
+        assert len(reloaded) == 300 and reloaded.dtype == dtype and reloaded.trained
+        top = [id for id, _ in reloaded.search(vectors[1], k=2, exact=True)]
+        assert set(top) == {"chunk-0", "chunk-1"}, f"Expected the replaced vector to be found, got {top}"
+        assert [id for id, _ in reloaded.search(vectors[1], k=5, ids=["chunk-7", "chunk-1", "missing"])] == ["chunk-1", "chunk-7"]
+
+        # a crash mid-add leaves rows without ids, and maybe half an id: they're dropped on load
+        for name, row_size in reloaded._row_files():
+            with open(os.path.join(path, name), "ab") as file:
+                file.write(b"\0" * row_size * 2)
+        with open(os.path.join(path, "ids.txt"), "a") as file:
+            file.write("chunk-crash")
+        recovered = VectorIndex(path)
+        assert len(recovered.ids) == 301 and len(recovered) == 300
+        recovered.add(["chunk-new"], vectors[42:43])
+        assert VectorIndex(path).search(vectors[42], k=1, ids=["chunk-new", "chunk-3"])[0][0] == "chunk-new", "Expected rows added after a crash to line up with their ids"
+    print("vector_index.py: All tests passed!")
+
+def benchmark_vector_index(count: int = 50000, dimensions: int = 1536, queries: int = 200, k: int = 10):
+    """recall@k and latency of the IVF index, float32 and int8, against exact search."""
+    import tempfile
+    rng = np.random.default_rng(0)
+    # embeddings cluster by topic, so sample around a few hundred topic centers
+    centers = normalize(rng.standard_normal((256, dimensions)).astype(DTYPE))
+    vectors = normalize(centers[rng.integers(0, 256, count)] + rng.standard_normal((count, dimensions)).astype(DTYPE) * 0.07)
+    query_vectors = normalize(vectors[rng.integers(0, count, queries)] + rng.standard_normal((queries, dimensions)).astype(DTYPE) * 0.02)
+    ids = [str(i) for i in range(count)]
+
+    exact = normalize(vectors) @ query_vectors.T
+    truth = [set(str(i) for i in top_k(exact[:, q], k)) for q in range(queries)]
+    for dtype in ("float32", "int8"):
+        index = VectorIndex(tempfile.mkdtemp(), dimensions=dimensions, dtype=dtype, exact_below=count)
+        start = time.perf_counter()
+        for block in range(0, count, 5000):
+            index.add(ids[block:block + 5000], vectors[block:block + 5000])
+        build = time.perf_counter() - start
+        for n_probe in (0, 4, 16, 32):
+            start = time.perf_counter()
+            results = [index.search(query, k, n_probe=n_probe or None, exact=not n_probe) for query in query_vectors]
+            latency = (time.perf_counter() - start) / queries * 1000
+            recall = np.mean([len(truth[q] & {id for id, _ in results[q]}) / k for q in range(queries)])
+            label = "exact" if not n_probe else f"n_probe={n_probe}"
+            print(f"{dtype:>7} {label:>11}: recall@{k} {recall:.3f}, {latency:6.2f}ms/query (built in {build:.1f}s, {len(index.centroids)} lists)")
+
+if __name__ == "__main__":
+    test_vector_index()
+    benchmark_vector_index()
@@ -0,0 +1,92 @@
+import base64
+import time
+from functools import lru_cache
+from typing import Any, Optional, Sequence
+
+import numpy as np
+from pydantic import BeforeValidator, PlainSerializer
+from typing_extensions import Annotated
+
+# Embeddings are float32 everywhere: that's what the embeddings endpoint returns in base64 mode and
+# what pgvector stores, so there's nothing to gain from carrying 8-byte Python floats around.
+DTYPE = np.float32
+
+def as_vector(value: Any) -> Optional[np.ndarray]:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return from_pgvector(value)
+    return np.ascontiguousarray(value, dtype=DTYPE).reshape(-1)
+
+def as_matrix(values: Sequence, dimensions: int = 0) -> np.ndarray:
+    """Stacks vectors into a contiguous (n, dimensions) float32 matrix."""
+    if isinstance(values, np.ndarray) and values.ndim == 2:
+        return np.ascontiguousarray(values, dtype=DTYPE)
+    if len(values) == 0:
+        return np.empty((0, dimensions), dtype=DTYPE)
+    return np.ascontiguousarray(np.stack([as_vector(value) for value in values]), dtype=DTYPE)
+
+def from_base64(data: str) -> np.ndarray:
+    # the embeddings endpoint's base64 format is little-endian float32
+    return np.frombuffer(base64.b64decode(data), dtype="<f4").astype(DTYPE, copy=False)
+
+@lru_cache(maxsize=8)
+def _pgvector_format(dimensions: int) -> str:
+    # 9 significant digits round-trip any float32 exactly
+    return "[" + ",".join(["%.9g"] * dimensions) + "]"
+
+def to_pgvector(vector) -> str:
+    """Formats a vector as a pgvector text literal, e.g. `[0.1,0.2]`."""
+    vector = as_vector(vector)
+    return _pgvector_format(len(vector)) % tuple(vector.tolist())
+
+def from_pgvector(text: str) -> np.ndarray:
+    return np.fromstring(text.strip()[1:-1], sep=",", dtype=DTYPE)
+
+# pydantic field type for embeddings: validated as one float32 array rather than float by float,
+# and serialized back to a plain list only when a model is dumped
+Vector = Annotated[Any, BeforeValidator(as_vector), PlainSerializer(lambda vector: vector.tolist() if vector is not None else None, return_type=Optional[list])]
+
+def test_vectors():
+    vector = np.random.default_rng(0).standard_normal(1536).astype(DTYPE)
+    assert np.array_equal(from_pgvector(to_pgvector(vector)), vector), "Expected the text literal to round-trip exactly"
+    assert np.array_equal(from_base64(base64.b64encode(vector.tobytes()).decode()), vector)
+    assert as_vector([1, 2]).dtype == DTYPE and as_vector("[1,2]").tolist() == [1.0, 2.0]
+    assert as_matrix([[1, 2], [3, 4]]).shape == (2, 2) and as_matrix([], 1536).shape == (0, 1536)
+    print("vectors.py: All tests passed!")
+
+def benchmark_vectors(count: int = 2000, dimensions: int = 1536):
+    """Compares the old List[float] text path with the float32 path, per vector, end to end."""
+    rng = np.random.default_rng(0)
+    vectors = (rng.standard_normal((count, dimensions)) / 30).astype(DTYPE)
+    encoded = [base64.b64encode(vector.tobytes()).decode() for vector in vectors]
+    # what the API client used to hand us: float64 lists parsed out of JSON
+    lists = [vector.astype(np.float64).tolist() for vector in vectors]
+
+    start = time.perf_counter()
+    old_literals = [f"{value}" for value in lists]
+    old_format = time.perf_counter() - start
+    start = time.perf_counter()
+    for literal in old_literals:
+        [float(x) for x in literal[1:-1].split(",")]
+    old_parse = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decoded = [from_base64(data) for data in encoded]
+    decode = time.perf_counter() - start
+    start = time.perf_counter()
+    new_literals = [to_pgvector(vector) for vector in decoded]
+    new_format = time.perf_counter() - start
+    start = time.perf_counter()
+    for literal in new_literals:
+        from_pgvector(literal)
+    new_parse = time.perf_counter() - start
+
+    old_bytes = sum(len(literal) for literal in old_literals) / count
+    new_bytes = sum(len(literal) for literal in new_literals) / count
+    print(f"list path:    format {count / old_format:8.0f} vectors/s, parse {count / old_parse:8.0f} vectors/s, {old_bytes:.0f} bytes/literal, {8 * dimensions + 56} bytes/list payload")
+    print(f"float32 path: format {count / new_format:8.0f} vectors/s, parse {count / new_parse:8.0f} vectors/s, {new_bytes:.0f} bytes/literal, {4 * dimensions} bytes/vector, base64 decode {count / decode:.0f} vectors/s")
+
+if __name__ == "__main__":
+    test_vectors()
+    benchmark_vectors()